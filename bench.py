@@ -0,0 +1,234 @@
+"""
+熱點函式 micro-benchmark（含回歸門檻）
+
+在合成的當日資料（10 ~ 1,000 個時段、10 ~ 10,000 筆預約）上計時：
+generate_latest_shift_list、safe_modify_today_file（冷啟動含 queue 合併 / 快照已建立）、merge_shifts、
+find_shift、generate_unique_name、預約選單 keyboard_page("reserve")（清空快取 / 命中快取），
+以及檔案格式：舊版 indent=2 JSON（v1）與含標頭的緊湊格式（v2）的序列化 / 解析時間和檔案大小。
+
+    python bench.py                                   # 跑完整矩陣，結果寫到 bench_results.json
+    python bench.py --quick                           # 只跑小矩陣
+    python bench.py --baseline bench_baseline.json    # 與基準比較，超過容忍值則 exit 1
+    python bench.py --baseline bench_baseline.json --update-baseline
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SHIFT_SIZES = [10, 100, 1000]
+BOOKING_SIZES = [10, 1000, 10000]
+QUICK_SHIFT_SIZES = [10, 100]
+QUICK_BOOKING_SIZES = [10, 1000]
+QUEUED_WRITES = 3  # 冷啟動前對同一檔排入的寫入次數（WriteQueue 會合併成一筆）
+
+
+def import_bot():
+    """在暫存目錄下載入 main（DATA_DIR 是相對路徑），不會連線"""
+    os.environ.setdefault("BOT_TOKEN", "bench")
+    os.environ.setdefault("TELEGRAM_API_BASE", "http://127.0.0.1:9")
+    os.chdir(tempfile.mkdtemp(prefix="bench-"))
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE)
+    import main
+    return main
+
+
+def make_day(bot, n_shifts, n_bookings, group_ids=(-2001, -2002, -2003, -2004)):
+    """合成當日資料：時段平均分布在一天中，預約平均分到各時段，約 1/5 已報到"""
+    today = bot.datetime.now(bot.TZ).date().isoformat()
+    shifts = []
+    for i in range(n_shifts):
+        minute = i * 1440 // n_shifts
+        shifts.append({"time": f"{minute // 60:02d}:{minute % 60:02d}", "limit": 3, "bookings": [], "in_progress": []})
+    for j in range(n_bookings):
+        s = shifts[j % n_shifts]
+        name = f"客{j}"
+        if j % 5 == 4:
+            s["in_progress"].append({"name": name, "amount": 3000.0})
+        else:
+            s["bookings"].append({"name": name, "chat_id": group_ids[j % len(group_ids)]})
+    for s in shifts:
+        s["limit"] = max(s["limit"], len(s["bookings"]) + len(s["in_progress"]) + 1)
+    return {"date": today, "shifts": shifts, "候補": []}
+
+
+def write_day(bot, day):
+    path = bot.data_path_for(day["date"])
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(day, f, ensure_ascii=False, indent=2)
+    return path
+
+
+def drain_queue(bot):
+    q = bot.write_queue
+    with q.mutex:
+        q.queue.clear()
+        q.latest_data.clear()
+        q.writing.clear()
+        q.enqueued_at.clear()
+        q.unfinished_tasks = 0
+        q.all_tasks_done.notify_all()
+
+
+def timeit(fn, setup=None, min_time=0.2, min_runs=3, max_runs=1000):
+    """每次呼叫前執行 setup（不計時），回傳每次呼叫的秒數"""
+    times = []
+    total = 0.0
+    while len(times) < min_runs or (total < min_time and len(times) < max_runs):
+        args = setup() if setup else ()
+        t0 = time.perf_counter()
+        fn(*args)
+        dt = time.perf_counter() - t0
+        times.append(dt)
+        total += dt
+    return times
+
+
+def cases(bot, n_shifts, n_bookings):
+    """回傳 [(名稱, fn, setup)]，每組規模都先把資料寫到當日檔"""
+    day = make_day(bot, n_shifts, n_bookings)
+    path = write_day(bot, day)
+    bot.day_snapshot = None  # 檔案是直接寫的，讓快照從檔案重建
+    shifts = bot.Day.from_raw(day).shifts
+    last_time = shifts[-1].time
+    dup_bookings = [bot.Booking("小美" if i == 0 else f"小美({i + 1})", -2001)
+                    for i in range(min(n_bookings, 1000))]
+    v1_raw, v2_raw = encode_v1(day), bot.encode_document(day)
+
+    def queued_setup():
+        drain_queue(bot)
+        bot.day_snapshot = None  # 沒有快照時才會讀檔並合併 queue
+        for _ in range(QUEUED_WRITES):
+            bot.write_queue.put((path, copy.deepcopy(day)))
+        return ()
+
+    return [
+        ("generate_latest_shift_list", bot.generate_latest_shift_list, None),
+        ("safe_modify_today_file", lambda: bot.safe_modify_today_file(lambda data: None), queued_setup),
+        ("safe_modify_today_file_warm", lambda: bot.safe_modify_today_file(lambda data: None), lambda: drain_queue(bot) or ()),
+        ("merge_shifts", bot.merge_shifts, lambda: (bot.Day.from_raw(day).shifts, bot.Day.from_raw(day).shifts)),
+        ("find_shift", lambda: bot.find_shift(shifts, last_time), None),
+        ("generate_unique_name", lambda: bot.generate_unique_name(dup_bookings, "小美"), None),
+        ("keyboard_page_reserve", lambda: bot.keyboard_page("reserve", -2001), lambda: clear_keyboard_cache(bot)),
+        ("keyboard_page_reserve_cached", lambda: bot.keyboard_page("reserve", -2001), None),
+        ("dump_v1", lambda: encode_v1(day), None),
+        ("dump_v2", lambda: bot.encode_document(day), None),
+        ("load_v1", lambda: bot.decode_document(v1_raw), None),
+        ("load_v2", lambda: bot.decode_document(v2_raw), None),
+    ]
+
+
+def clear_keyboard_cache(bot):
+    with bot.keyboard_cache_lock:
+        bot.keyboard_cache.clear()
+    return ()
+
+
+def encode_v1(day):
+    """改版前的寫檔格式"""
+    return json.dumps(day, ensure_ascii=False, indent=2).encode("utf-8")
+
+
+def format_sizes(bot, n_shifts, n_bookings):
+    day = make_day(bot, n_shifts, n_bookings)
+    v1, v2 = len(encode_v1(day)), len(bot.encode_document(day))
+    return {"v1_bytes": v1, "v2_bytes": v2, "ratio": round(v2 / v1, 3)}
+
+
+def run(shift_sizes, booking_sizes, min_time):
+    bot = import_bot()
+    results = {}
+    sizes = {}
+    for n_shifts in shift_sizes:
+        for n_bookings in booking_sizes:
+            sizes[f"shifts={n_shifts},bookings={n_bookings}"] = size = format_sizes(bot, n_shifts, n_bookings)
+            print(f"檔案大小[shifts={n_shifts},bookings={n_bookings}] v1 {size['v1_bytes']} B → v2 {size['v2_bytes']} B"
+                  f"（x{size['ratio']}）", file=sys.stderr)
+            for name, fn, setup in cases(bot, n_shifts, n_bookings):
+                times = timeit(fn, setup, min_time=min_time)
+                drain_queue(bot)
+                key = f"{name}[shifts={n_shifts},bookings={n_bookings}]"
+                results[key] = {
+                    "runs": len(times),
+                    "median_s": statistics.median(times),
+                    "min_s": min(times),
+                }
+                print(f"{key:<70} {results[key]['median_s'] * 1000:10.3f} ms  (n={len(times)})", file=sys.stderr)
+    return {
+        "meta": {"python": platform.python_version(), "platform": platform.platform(),
+                 "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results,
+        "file_sizes": sizes,
+    }
+
+
+def compare(current, baseline, tolerance):
+    """回傳 [(名稱, 基準, 目前, 比例)] 中超過容忍值的項目"""
+    regressions = []
+    for key, cur in current["results"].items():
+        base = baseline.get("results", {}).get(key)
+        if not base or not base.get("median_s"):
+            continue
+        ratio = cur["median_s"] / base["median_s"]
+        if ratio > 1 + tolerance:
+            regressions.append((key, base["median_s"], cur["median_s"], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="熱點函式 micro-benchmark")
+    parser.add_argument("--quick", action="store_true", help="只跑小規模矩陣")
+    parser.add_argument("--min-time", type=float, default=0.2, help="每項最少累計計時（秒）")
+    parser.add_argument("--output", default="bench_results.json", help="結果 JSON 路徑")
+    parser.add_argument("--baseline", help="基準 JSON 路徑")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="容許變慢比例（0.25 = 25%%）")
+    parser.add_argument("--update-baseline", action="store_true", help="把本次結果寫成新的基準")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")  # main.py 的 DEBUG 輸出
+    try:
+        if args.quick:
+            current = run(QUICK_SHIFT_SIZES, QUICK_BOOKING_SIZES, args.min_time)
+        else:
+            current = run(SHIFT_SIZES, BOOKING_SIZES, args.min_time)
+    finally:
+        sys.stdout = stdout
+
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(current, f, ensure_ascii=False, indent=2)
+    print(f"結果已寫入 {output}")
+
+    if not baseline_path:
+        return
+    if args.update_baseline or not os.path.exists(baseline_path):
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+        print(f"基準已更新 {baseline_path}")
+        return
+
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(current, baseline, args.tolerance)
+    if not regressions:
+        print(f"✅ 無回歸（容忍 {args.tolerance:.0%}）")
+        return
+    print(f"❌ {len(regressions)} 項超過容忍值 {args.tolerance:.0%}：")
+    for key, base, cur, ratio in sorted(regressions, key=lambda r: -r[3]):
+        print(f"  {key:<70} {base * 1000:.3f} ms → {cur * 1000:.3f} ms（x{ratio:.2f}）")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""
+本機假 Telegram Bot API（離線壓測 / 重播用）
+
+實作 sendMessage、answerCallbackQuery、editMessageText、sendDocument（multipart，可為 chunked 上傳；
+其他方法一律回 ok），
+記錄所有呼叫，並可注入延遲與 429。
+
+單獨啟動：
+    python fake_telegram.py --port 8081 --latency 0.05 --rate-429 0.01
+    TELEGRAM_API_BASE=http://127.0.0.1:8081 BOT_TOKEN=test python main.py
+
+GET /_calls 取得已記錄的呼叫，POST /_reset 清空。
+"""
+import argparse
+import json
+import re
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Server(ThreadingHTTPServer):
+    # 預設 listen backlog 只有 5，壓測時大量併發連線會在 accept 前就被拒
+    request_queue_size = 128
+
+
+class FakeTelegram:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0, rate_429=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = []          # [{"method", "payload", "ts", "status"}]
+        self.messages = {}       # (chat_id, message_id) -> message
+        self.kicked = set()      # 這些 chat_id 的 sendMessage 一律回 403（模擬機器人被踢）
+        self.next_message_id = 1
+        self.server = _Server((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True, name="fake-telegram")
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.messages.clear()
+
+    # -------------------------------
+    # 查詢紀錄
+    # -------------------------------
+    def sent(self, method="sendMessage", chat_id=None):
+        with self.lock:
+            calls = list(self.calls)
+        return [c["payload"] for c in calls
+                if c["method"] == method and c["status"] == 200
+                and (chat_id is None or c["payload"].get("chat_id") == chat_id)]
+
+    def find_text(self, text, chat_id=None):
+        return any(p.get("text") == text for p in self.sent("sendMessage", chat_id))
+
+    def find_button(self, button_text, chat_id=None, message_text=None):
+        """最近一則（含 message_text 的）訊息上，文字為 button_text 的按鈕 callback_data"""
+        for p in reversed(self.sent("sendMessage", chat_id)):
+            if message_text is not None and message_text not in p.get("text", ""):
+                continue
+            for row in (p.get("reply_markup") or {}).get("inline_keyboard", []):
+                for b in row:
+                    if b.get("text") == button_text:
+                        return b.get("callback_data")
+        return None
+
+    def counts(self):
+        out = {}
+        with self.lock:
+            for c in self.calls:
+                key = c["method"] if c["status"] == 200 else f"{c['method']}({c['status']})"
+                out[key] = out.get(key, 0) + 1
+        return out
+
+    # -------------------------------
+    # Bot API 方法
+    # -------------------------------
+    def handle(self, method, payload):
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        with self.lock:
+            if self.rate_429 and self.random.random() < self.rate_429:
+                self.calls.append({"method": method, "payload": payload, "ts": time.time(), "status": 429})
+                return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry later",
+                             "parameters": {"retry_after": self.retry_after}}
+            if method == "sendMessage" and payload.get("chat_id") in self.kicked:
+                self.calls.append({"method": method, "payload": payload, "ts": time.time(), "status": 403})
+                return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was kicked from the group chat"}
+            self.calls.append({"method": method, "payload": payload, "ts": time.time(), "status": 200})
+
+            if method == "sendMessage":
+                message = {
+                    "message_id": self.next_message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": payload.get("chat_id")},
+                    "text": payload.get("text", ""),
+                }
+                if "reply_markup" in payload:
+                    message["reply_markup"] = payload["reply_markup"]
+                self.next_message_id += 1
+                self.messages[(payload.get("chat_id"), message["message_id"])] = message
+                return 200, {"ok": True, "result": message}
+
+            if method in ("editMessageText", "editMessageReplyMarkup"):
+                key = (payload.get("chat_id"), payload.get("message_id"))
+                message = self.messages.get(key)
+                if message is None:
+                    return 400, {"ok": False, "error_code": 400, "description": "Bad Request: message to edit not found"}
+                if "text" in payload:
+                    message["text"] = payload["text"]
+                if "reply_markup" in payload:
+                    message["reply_markup"] = payload["reply_markup"]
+                return 200, {"ok": True, "result": message}
+
+            # answerCallbackQuery 與其他方法
+            return 200, {"ok": True, "result": True}
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body):
+                raw = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+            def _read_body(self):
+                if self.headers.get("Transfer-Encoding", "").lower() != "chunked":
+                    return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                parts = []
+                while True:
+                    size = int(self.rfile.readline().split(b";")[0].strip() or b"0", 16)
+                    if size == 0:
+                        self.rfile.readline()
+                        return b"".join(parts)
+                    parts.append(self.rfile.read(size))
+                    self.rfile.readline()
+
+            def do_GET(self):
+                if self.path == "/_calls":
+                    with fake.lock:
+                        return self._reply(200, {"calls": list(fake.calls)})
+                self._reply(404, {"ok": False})
+
+            def do_POST(self):
+                if self.path == "/_reset":
+                    fake.reset()
+                    return self._reply(200, {"ok": True})
+
+                # /bot<token>/<method>
+                parts = self.path.strip("/").split("/")
+                if len(parts) != 2 or not parts[0].startswith("bot"):
+                    return self._reply(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+                raw = self._read_body()
+                if self.headers.get("Content-Type", "").startswith("multipart/form-data"):
+                    payload = parse_multipart(raw, self.headers["Content-Type"])
+                else:
+                    try:
+                        payload = json.loads(raw or b"{}")
+                    except ValueError:
+                        return self._reply(400, {"ok": False, "error_code": 400, "description": "Bad Request: invalid JSON"})
+                status, body = fake.handle(parts[1], payload)
+                self._reply(status, body)
+
+        return Handler
+
+
+def parse_multipart(raw, content_type):
+    """簡易 multipart 解析：一般欄位轉成字串（數字轉 int）；檔案欄位存成 {"filename", "content"}"""
+    boundary = content_type.split("boundary=", 1)[1].strip('"').encode()
+    payload = {}
+    for part in raw.split(b"--" + boundary):
+        if b"\r\n\r\n" not in part:
+            continue
+        head, _, body = part.partition(b"\r\n\r\n")
+        name = re.search(rb'name="([^"]*)"', head)
+        if not name:
+            continue
+        body = body[:-2] if body.endswith(b"\r\n") else body
+        filename = re.search(rb'filename="([^"]*)"', head)
+        if filename:
+            payload[name.group(1).decode()] = {"filename": filename.group(1).decode(), "content": body.decode("utf-8", "replace")}
+        else:
+            value = body.decode("utf-8")
+            payload[name.group(1).decode()] = int(value) if re.fullmatch(r"-?\d+", value) else value
+    return payload
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本機假 Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="每次呼叫固定延遲（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="額外隨機延遲上限（秒）")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="回 429 的機率（0~1）")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+
+    fake = FakeTelegram(args.host, args.port, args.latency, args.jitter, args.rate_429, args.retry_after)
+    print(f"fake telegram listening on {fake.base_url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+"""
+端到端壓測（完全離線）
+
+啟動 fake_telegram.py 的假 Telegram 伺服器，對 main.webhook() 送出合成的
+message / callback_query update，模擬 N 個業務群與 M 位服務員跑完整流程：
+預約 → 客到 → 上 → 輸入客資 → 完成服務。
+
+    python loadtest.py --groups 10 --staff 4 --bookings 5 --limit 3 --latency 0.01
+
+結束後回報吞吐量、p50/p95/p99 延遲，並檢查正確性（不超過 limit、已確認的預約沒有遺失）。
+"""
+import argparse
+import contextlib
+import json
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from fake_telegram import FakeTelegram
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+def import_bot(api_base, data_root):
+    """在暫存目錄下載入 main（DATA_DIR 是相對路徑），並指向假伺服器"""
+    os.environ.setdefault("BOT_TOKEN", "loadtest")
+    os.environ.setdefault("RATE_LIMIT", "0")  # 壓測的連發不是濫用，不限流
+    os.environ["TELEGRAM_API_BASE"] = api_base
+    os.chdir(data_root)
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE)
+    import main
+    return main
+
+
+class Driver:
+    """對 webhook 送 update 並記錄每次延遲"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.lock = threading.Lock()
+        self.latencies = {}  # kind -> [秒]
+        self.errors = {}     # step -> 次數
+        self.update_id = 0
+
+    def _post(self, kind, update):
+        client = self.bot.app.test_client()
+        with self.lock:
+            self.update_id += 1
+            update["update_id"] = self.update_id
+        t0 = time.perf_counter()
+        client.post("/", json=update)
+        dt = time.perf_counter() - t0
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(dt)
+
+    def message(self, user_id, chat_id, text):
+        kind = "message:" + (text.split()[0] if text.startswith("/") else "text")
+        self._post(kind, {"message": {
+            "message_id": 1, "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": "group"},
+            "from": {"id": user_id, "first_name": f"u{user_id}"},
+        }})
+
+    def callback(self, user_id, chat_id, data):
+        self._post("callback:" + data.split("|", 1)[0], {"callback_query": {
+            "id": f"cq{user_id}-{time.perf_counter_ns()}", "data": data,
+            "from": {"id": user_id, "first_name": f"u{user_id}"},
+            "message": {"message_id": 1, "chat": {"id": chat_id, "type": "group"}},
+        }})
+
+    def error(self, step):
+        with self.lock:
+            self.errors[step] = self.errors.get(step, 0) + 1
+
+
+def seed_day(bot, shift_times, limit, business_ids):
+    today = bot.datetime.now(bot.TZ).date().isoformat()
+    shifts = [{"time": t, "limit": limit, "bookings": [], "in_progress": []} for t in shift_times]
+    with open(bot.data_path_for(today), "w", encoding="utf-8") as f:
+        json.dump({"date": today, "shifts": shifts, "候補": []}, f, ensure_ascii=False)
+    groups = [{"id": bot.STAFF_GROUP_ID, "type": "staff"}] + [{"id": gid, "type": "business"} for gid in business_ids]
+    with open(bot.GROUP_FILE, "w", encoding="utf-8") as f:
+        json.dump(groups, f)
+    return bot.data_path_for(today)
+
+
+def run(args):
+    fake = FakeTelegram(latency=args.latency, jitter=args.jitter, rate_429=args.rate_429, seed=args.seed).start()
+    data_root = tempfile.mkdtemp(prefix="loadtest-")
+    bot = import_bot(fake.base_url, data_root)
+    rnd = random.Random(args.seed)
+
+    shift_times = [f"{(13 + i) % 24:02d}:00" for i in range(args.shifts)]
+    business_ids = [-2000 - g for g in range(args.groups)]
+    day_path = seed_day(bot, shift_times, args.limit, business_ids)
+
+    threading.Thread(target=bot.background_writer, daemon=True).start()
+    driver = Driver(bot)
+    staff_queue = queue.Queue()
+    outcome_lock = threading.Lock()
+    confirmed, arrived, staffed_up, completed = set(), set(), set(), set()
+
+    def business_worker(g):
+        gid = business_ids[g]
+        user_id = 1000 + g
+        for b in range(args.bookings):
+            hhmm = rnd.choice(shift_times)
+            name = f"g{g}b{b}"
+            driver.callback(user_id, gid, "main|reserve")
+            driver.callback(user_id, gid, f"reserve_pick|{hhmm}")
+            driver.message(user_id, gid, name)
+            if not fake.find_text(f"✅ {name} 已預約 {hhmm}", gid):
+                waitlisted = f"⏳ {hhmm} 已滿額，{name} 已加入候補"
+                if not any(p.get("text", "").startswith(waitlisted) for p in fake.sent("sendMessage", gid)):
+                    driver.error("reserve")
+                continue
+            with outcome_lock:
+                confirmed.add((hhmm, name, gid))
+
+            driver.callback(user_id, gid, "main|arrive")
+            # 按實際送出的按鈕（callback token）；找不到按鈕代表 token 發放 / 查找有問題，算錯誤
+            data = fake.find_button(f"{hhmm} {name}", gid, "請選擇要報到的預約")
+            if not data:
+                driver.error("arrive_button")
+                continue
+            driver.callback(user_id, gid, data)
+            driver.message(user_id, gid, "3000")
+            if not fake.find_text(f"✅ {hhmm} {name} 已客到，金額：3000.0", gid):
+                driver.error("arrive")
+                continue
+            with outcome_lock:
+                arrived.add((hhmm, name, gid))
+            staff_queue.put((hhmm, name, gid))
+
+    def staff_worker(s):
+        user_id = 5000 + s
+        chat_id = bot.STAFF_GROUP_ID
+        staff_name = f"staff{s}"
+        while True:
+            task = staff_queue.get()
+            if task is None:
+                break
+            hhmm, name, gid = task
+            data = fake.find_button("上", chat_id, f"時間：{hhmm}\n業務名：{name}\n")
+            if not data:
+                driver.error("staff_up_button")
+                continue
+            driver.callback(user_id, chat_id, data)
+            if not fake.find_text(f"⬆️ 上 {hhmm} {name}", gid):
+                driver.error("staff_up")
+                continue
+            with outcome_lock:
+                staffed_up.add(task)
+            data = fake.find_button("輸入客資", chat_id, f"✅ 已通知業務 {name}")
+            if not data:
+                driver.error("input_client_button")
+                continue
+            driver.callback(user_id, chat_id, data)
+            driver.message(user_id, chat_id, f"客{name} 25 {staff_name} 3000")
+            data = fake.find_button("完成服務", chat_id, f"{hhmm} 客{name}25 {name}3000")
+            if not data:
+                driver.error("complete_button")
+                continue
+            driver.callback(user_id, chat_id, data)
+            driver.message(user_id, chat_id, "3000")
+            done_text = f"✅ 完成服務通知\n{hhmm} {name}\n服務人員: {staff_name}\n金額: 3000.0"
+            if not fake.find_text(done_text, gid):
+                driver.error("complete")
+                continue
+            with outcome_lock:
+                completed.add(task)
+
+    quiet = open(os.devnull, "w") if not args.verbose else sys.stdout
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(quiet):
+        staff_threads = [threading.Thread(target=staff_worker, args=(s,)) for s in range(args.staff)]
+        business_threads = [threading.Thread(target=business_worker, args=(g,)) for g in range(args.groups)]
+        for t in staff_threads + business_threads:
+            t.start()
+        for t in business_threads:
+            t.join()
+        for _ in staff_threads:
+            staff_queue.put(None)
+        for t in staff_threads:
+            t.join()
+        elapsed = time.perf_counter() - t0
+        bot.write_queue.join()
+
+    # -------------------------------
+    # 正確性檢查
+    # -------------------------------
+    day = bot.load_day(day_path)
+    violations = []
+    for s in day.shifts:
+        used = s.count_used()
+        if used > s.limit:
+            violations.append(f"{s.time} 超額：used={used} limit={s.limit}")
+    for t, counted, actual in bot.check_capacity_counters(day, repair=False):
+        violations.append(f"{t} 名額計數偏差：計數器 {counted}，實際 {actual}")
+
+    in_file_bookings = {(s.time, b.name, b.chat_id) for s in day.shifts for b in s.bookings}
+    in_file_progress = {(s.time, a.name) for s in day.shifts for a in s.in_progress}
+    lost_bookings = sorted(confirmed - arrived - in_file_bookings)
+    lost_arrivals = sorted((h, n) for h, n, _ in arrived - staffed_up if (h, n) not in in_file_progress)
+    if lost_bookings:
+        violations.append(f"已確認但遺失的預約 {len(lost_bookings)} 筆：{lost_bookings[:5]}")
+    if lost_arrivals:
+        violations.append(f"已客到但遺失的報到 {len(lost_arrivals)} 筆：{lost_arrivals[:5]}")
+
+    all_latencies = [x for v in driver.latencies.values() for x in v]
+    report = {
+        "groups": args.groups, "staff": args.staff, "bookings_per_group": args.bookings,
+        "shifts": args.shifts, "limit": args.limit,
+        "updates": len(all_latencies),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_ups": round(len(all_latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(all_latencies, 50) * 1000, 2),
+            "p95": round(percentile(all_latencies, 95) * 1000, 2),
+            "p99": round(percentile(all_latencies, 99) * 1000, 2),
+        },
+        "by_kind": {k: {"n": len(v),
+                        "p50_ms": round(percentile(v, 50) * 1000, 2),
+                        "p95_ms": round(percentile(v, 95) * 1000, 2),
+                        "p99_ms": round(percentile(v, 99) * 1000, 2)}
+                    for k, v in sorted(driver.latencies.items())},
+        "flows": {"confirmed": len(confirmed), "arrived": len(arrived),
+                  "staff_up": len(staffed_up), "completed": len(completed)},
+        "flow_errors": driver.errors,
+        "telegram_calls": fake.counts(),
+        "violations": violations,
+    }
+    fake.stop()
+    return report
+
+
+def passed(r):
+    """沒有正確性違規、也沒有流程錯誤才算通過"""
+    return not r["violations"] and not r["flow_errors"]
+
+
+def print_report(r):
+    print(f"更新數 {r['updates']}，耗時 {r['elapsed_s']}s，吞吐量 {r['throughput_ups']} updates/s")
+    lat = r["latency_ms"]
+    print(f"延遲 p50={lat['p50']}ms p95={lat['p95']}ms p99={lat['p99']}ms")
+    for kind, v in r["by_kind"].items():
+        print(f"  {kind:<28} n={v['n']:<6} p50={v['p50_ms']:<8} p95={v['p95_ms']:<8} p99={v['p99_ms']}")
+    print(f"流程：{r['flows']}  錯誤：{r['flow_errors'] or '無'}")
+    print(f"Telegram 呼叫：{r['telegram_calls']}")
+    if not passed(r):
+        print("❌ 正確性檢查失敗：")
+        for v in r["violations"]:
+            print(f"  - {v}")
+        if r["flow_errors"]:
+            print(f"  - 流程錯誤：{r['flow_errors']}")
+    else:
+        print("✅ 正確性檢查通過")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="離線端到端壓測")
+    parser.add_argument("--groups", type=int, default=5, help="業務群數量 N")
+    parser.add_argument("--staff", type=int, default=3, help="服務員數量 M")
+    parser.add_argument("--bookings", type=int, default=4, help="每個業務群的預約次數")
+    parser.add_argument("--shifts", type=int, default=10, help="時段數")
+    parser.add_argument("--limit", type=int, default=3, help="每個時段名額")
+    parser.add_argument("--latency", type=float, default=0.0, help="假 Telegram 固定延遲（秒）")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="另存 JSON 報告的路徑")
+    parser.add_argument("--verbose", action="store_true", help="顯示 main.py 的 DEBUG 輸出")
+    args = parser.parse_args()
+
+    json_path = os.path.abspath(args.json) if args.json else None
+    report = run(args)
+    print_report(report)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(0 if passed(report) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,104 +1,610 @@
 import os
+import copy
 import json
 import requests
 import queue
-from flask import Flask, request
-from datetime import datetime, time as dt_time
+from flask import Flask, Response, request, stream_with_context
+from datetime import datetime, timedelta, time as dt_time
 import threading
 import time
 import traceback
+import sys
+import re
+import importlib.util
+import signal
+import heapq
+import csv
+import io
+import gzip
+import zlib
+import hashlib
+import hmac
+import base64
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from collections import Counter, OrderedDict, deque
 
 try:
     from zoneinfo import ZoneInfo
 except ImportError:
     from backports.zoneinfo import ZoneInfo  # pip install backports.zoneinfo
 
+try:
+    import fcntl
+except ImportError:  # Windows 沒有 fcntl：按鈕防重複只在單一行程內有效
+    fcntl = None
+
 # -------------------------------
 # 設定區
+# 多租戶模式下，每家店是本檔的另一份模組，載入前由 load_tenant 注入
+# TENANT_CONFIG（該店設定）與 TENANT_SHARED（共用的連線池、群發執行緒池、寫檔佇列、背景執行緒表）；單店模式兩者皆無
 # -------------------------------
-BOT_TOKEN = os.getenv("BOT_TOKEN")
-if not BOT_TOKEN:
+TENANT = globals().get("TENANT_CONFIG") or {}
+SHARED = globals().get("TENANT_SHARED") or {}
+TENANTS_FILE = os.getenv("TENANTS_FILE")  # 多租戶設定檔（JSON），見「多租戶」
+TENANT_HOST = bool(TENANTS_FILE) and not TENANT  # 多租戶的主模組：只載入各店、提供共用資源，本身不服務任何一家店
+
+BOT_TOKEN = TENANT.get("token") or os.getenv("BOT_TOKEN")
+if not BOT_TOKEN and not TENANTS_FILE:
     raise ValueError("❌ 請在 Render/Zeabur 環境變數設定 BOT_TOKEN")
 
-API_URL = f"https://api.telegram.org/bot{BOT_TOKEN}/"
-DATA_DIR = "data"
+# 可指向本機的假 Telegram 伺服器（fake_telegram.py）做離線壓測
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+API_URL = f"{TELEGRAM_API_BASE}/bot{BOT_TOKEN}/"
+DATA_DIR = TENANT.get("data_dir", "data")
 os.makedirs(DATA_DIR, exist_ok=True)
 
 PENDING_FILE = os.path.join(DATA_DIR, "pending.json")
 
 app = Flask(__name__)
-ADMIN_IDS = [7236880214, 7807558825, 7502175264]  # 管理員 Telegram ID，自行修改
+ADMIN_IDS = TENANT.get("admin_ids", [7236880214, 7807558825, 7502175264])  # 管理員 Telegram ID，自行修改
+SHIFT_HOURS = range(*TENANT.get("shift_hours", (13, 23)))  # 每天自動建立的整點時段（13:00 ~ 22:00）
 TZ = ZoneInfo("Asia/Taipei")  # 台灣時區
 
-double_staffs = {}  # 用於紀錄雙人服務
-asked_shifts = set()
+
+def get_now():
+    """目前台灣時間（重播時會被 replay.py 換成固定時鐘）"""
+    return datetime.now(TZ)
 
 pending_lock = threading.Lock()
-double_lock = threading.Lock()
 staff_buttons_lock = threading.Lock()
 file_modify_lock = threading.Lock()
-write_queue = queue.Queue()
+# -------------------------------
+# 當日暫存狀態（雙人服務名單、已詢問客到的時段），不寫檔
+# 依日期分區，只留 EPHEMERAL_KEEP_DAYS 天（跨午夜的服務流程還查得到昨天），換日時整區丟掉；
+# 雙人服務 key = (時段, 業務群, 預約名)，每天最多 EPHEMERAL_MAX_PER_DAY 筆，超過淘汰最舊的
+# -------------------------------
+EPHEMERAL_KEEP_DAYS = 2
+EPHEMERAL_MAX_PER_DAY = 5000
+
+
+class DoubleService:
+    """一次雙人服務的服務員名單"""
+    __slots__ = ("staff", "updated_at")
+
+    def __init__(self, staff, updated_at):
+        self.staff = staff
+        self.updated_at = updated_at
+
+
+class DayPartition:
+    __slots__ = ("doubles", "asked")
+
+    def __init__(self):
+        self.doubles = OrderedDict()  # (hhmm, business_chat_id, 預約名) -> DoubleService
+        self.asked = set()            # 已詢問過客到的 hhmm
+
+
+class EphemeralState:
+    def __init__(self, keep_days=EPHEMERAL_KEEP_DAYS, max_per_day=EPHEMERAL_MAX_PER_DAY):
+        self.keep_days = keep_days
+        self.max_per_day = max_per_day
+        self.lock = threading.Lock()
+        self.days = {}  # 日期字串 -> DayPartition
+
+    def _partition(self, day):
+        """取得（必要時建立）某天的分區；建立新的一天時淘汰太舊的分區（須持有 lock）"""
+        part = self.days.get(day)
+        if part is None:
+            part = self.days[day] = DayPartition()
+            cutoff = (datetime.strptime(day, "%Y-%m-%d").date() - timedelta(days=self.keep_days - 1)).isoformat()
+            for old in [d for d in self.days if d < cutoff]:
+                del self.days[old]
+        return part
+
+    def _recent_days(self, now):
+        today = now.date()
+        return [(today - timedelta(days=i)).isoformat() for i in range(self.keep_days)]
+
+    def set_double(self, hhmm, business_chat_id, name, staff, now=None):
+        now = now or get_now()
+        key = (hhmm, business_chat_id, name)
+        with self.lock:
+            doubles = self._partition(now.date().isoformat()).doubles
+            doubles[key] = DoubleService(list(staff), now.timestamp())
+            doubles.move_to_end(key)
+            while len(doubles) > self.max_per_day:
+                doubles.popitem(last=False)
+
+    def get_double(self, hhmm, business_chat_id, name, now=None):
+        """今天（沒有再找昨天）記錄的雙人服務名單，沒有回傳 None"""
+        key = (hhmm, business_chat_id, name)
+        with self.lock:
+            for day in self._recent_days(now or get_now()):
+                part = self.days.get(day)
+                if part is not None and key in part.doubles:
+                    return list(part.doubles[key].staff)
+        return None
+
+    def mark_asked(self, day, hhmm):
+        """第一次標記回傳 True，已標記過回傳 False"""
+        with self.lock:
+            asked = self._partition(day).asked
+            if hhmm in asked:
+                return False
+            asked.add(hhmm)
+            return True
+
+    def rollover(self, today):
+        with self.lock:
+            self._partition(today)
+
+
+day_state = EphemeralState()
 # -------------------------------
 # 已使用的服務員群按鈕（防止重複點擊）
+# key = callback_data 的 8 bytes 雜湊；每天一個 append-only 紀錄檔 data/used_buttons-YYYY-MM-DD.log，
+# check-and-set 在檔案鎖內完成，多個 worker 行程與重啟後都有效；
+# 紀錄檔和 callback token 一樣保留 CALLBACK_TTL_DAYS 天（昨天發出的按鈕過了午夜仍按得到，也仍要擋重複），
+# 換日時載入前幾天的紀錄、刪除更舊的檔
+# 記憶體中最多保留 USED_BUTTONS_MAX 個 key，超過時淘汰最舊的
 # -------------------------------
-USED_STAFF_BUTTONS = set()
+USED_BUTTONS_MAX = 50000
+used_buttons = {"date": None, "keys": OrderedDict(), "offset": 0}  # offset：紀錄檔已讀到的位置
+
+
+def used_buttons_path(day):
+    return os.path.join(DATA_DIR, f"used_buttons-{day}.log")
+
+
+def _button_key(callback_data):
+    return hashlib.blake2b(callback_data.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _remember_button(key):
+    keys = used_buttons["keys"]
+    keys[key] = True
+    if len(keys) > USED_BUTTONS_MAX:
+        keys.popitem(last=False)
+
+
+def _rollover_used_buttons(today):
+    used_buttons["date"] = today
+    used_buttons["keys"] = OrderedDict()
+    used_buttons["offset"] = 0
+    start = datetime.fromisoformat(today).date()
+    days = [(start - timedelta(days=i)).isoformat() for i in range(CALLBACK_TTL_DAYS)]
+    keep = {os.path.basename(used_buttons_path(day)) for day in days}
+    for fname in os.listdir(DATA_DIR):
+        if fname.startswith("used_buttons-") and fname not in keep:
+            try:
+                os.remove(os.path.join(DATA_DIR, fname))
+            except OSError as e:
+                print(f"WARNING: 刪除舊的按鈕紀錄失敗 {fname}: {e}")
+    # 前幾天的紀錄已不會再寫入，整份讀進來；今天的檔之後照 offset 增量讀
+    for day in reversed(days[1:]):
+        try:
+            with open(used_buttons_path(day), "rb") as f:
+                for line in f:
+                    _remember_button(line.strip().decode("ascii", "ignore"))
+        except FileNotFoundError:
+            pass
+
 
 def staff_button_used(callback_data):
+    """已用過回傳 True；否則記下來並回傳 False"""
+    key = _button_key(callback_data)
+    today = get_now().date().isoformat()
     with staff_buttons_lock:
-        if callback_data in USED_STAFF_BUTTONS:
+        if used_buttons["date"] != today:
+            _rollover_used_buttons(today)
+        if key in used_buttons["keys"]:
             return True
-        USED_STAFF_BUTTONS.add(callback_data)
-        return False
 
-def clear_used_staff_buttons():
-    with staff_buttons_lock:
-        USED_STAFF_BUTTONS.clear()
+        with open(used_buttons_path(today), "a+b") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                # 先讀入其他行程在上次之後寫的紀錄
+                f.seek(used_buttons["offset"])
+                for line in f:
+                    _remember_button(line.strip().decode("ascii", "ignore"))
+                if key in used_buttons["keys"]:
+                    used_buttons["offset"] = f.tell()
+                    return True
+                f.write(key.encode("ascii") + b"\n")
+                f.flush()
+                used_buttons["offset"] = f.tell()
+                _remember_button(key)
+                return False
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+# -------------------------------
+# 按鈕 callback token
+# callback_data 只放「動作|token」，內容（時段、姓名、群組 ID…）存在伺服器端：
+# token = 內容的雜湊，同內容同 token（按鈕防重複也以此為 key）。
+# 每天一個 append-only 紀錄檔 data/callbacks-YYYY-MM-DD.log（一行「token JSON」），
+# 保留 CALLBACK_TTL_DAYS 天，前面有一層 LRU 快取。
+# 舊格式「動作|欄位|欄位…」仍可解析（已發出的舊按鈕、重播用）。
+# -------------------------------
+CALLBACK_TTL_DAYS = 2        # 今天 + 昨天：跨午夜的服務流程還按得到
+CALLBACK_CACHE_MAX = 5000
+CALLBACK_DATA_LIMIT = 64     # Telegram callback_data 上限（bytes）
+
+# 每個動作的欄位（依舊格式的順序）
+CALLBACK_FIELDS = {
+    "main": ("menu",),
+    "reserve_pick": ("hhmm",),
+    "arrive_select": ("hhmm", "name"),
+    "modify_pick": ("hhmm", "name"),
+    "modify_to": ("old_hhmm", "old_name", "new_hhmm"),
+    "cancel_pick": ("hhmm", "name"),
+    "confirm_cancel": ("hhmm", "name"),
+    "staff_up": ("hhmm", "name", "business_chat_id"),
+    "input_client": ("hhmm", "name", "business_chat_id"),
+    "not_consumed": ("hhmm", "name", "business_chat_id"),
+    "double": ("hhmm", "business_name", "business_chat_id", "staff_name"),
+    "complete": ("hhmm", "business_name", "business_chat_id", "staff_name"),
+    "fix": ("hhmm", "business_name", "business_chat_id", "staff_name"),
+    "page": ("menu", "page"),
+    "modify_page": ("hhmm", "name", "page"),
+}
+CALLBACK_INT_FIELDS = {"business_chat_id", "page"}
+CALLBACK_TOKEN_LEN = 8
+
+callback_lock = threading.Lock()
+callback_cache = OrderedDict()  # token -> (日期, 動作, 欄位)
+callback_logs = {}              # 日期 -> {"offset": 紀錄檔已讀到的位置, "index": {token: 該行位置}}
+
+
+def callbacks_path(day):
+    return os.path.join(DATA_DIR, f"callbacks-{day}.log")
+
+
+def _callback_token(action, args):
+    raw = json.dumps([action, args], ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return base64.urlsafe_b64encode(hashlib.blake2b(raw, digest_size=6).digest()).decode("ascii")
+
+
+def callback_key(action, args):
+    """內容對應的 callback_data（不登記），舊格式按鈕也換算成同一個 key"""
+    return f"{action}|{_callback_token(action, args)}"
+
+
+def _callback_days():
+    """仍有效的日期（今天在前）；換日時丟掉過期的索引與紀錄檔"""
+    today = get_now().date()
+    days = [(today - timedelta(days=i)).isoformat() for i in range(CALLBACK_TTL_DAYS)]
+    if days[0] not in callback_logs:
+        for day in list(callback_logs):
+            if day not in days:
+                del callback_logs[day]
+        for fname in os.listdir(DATA_DIR):
+            if fname.startswith("callbacks-") and fname[len("callbacks-"):-len(".log")] not in days:
+                try:
+                    os.remove(os.path.join(DATA_DIR, fname))
+                except OSError as e:
+                    print(f"WARNING: 刪除過期的 callback 紀錄失敗 {fname}: {e}")
+        callback_logs[days[0]] = {"offset": 0, "index": {}}
+    return days
+
+
+def _cache_callback(token, day, action, args):
+    callback_cache[token] = (day, action, args)
+    callback_cache.move_to_end(token)
+    if len(callback_cache) > CALLBACK_CACHE_MAX:
+        callback_cache.popitem(last=False)
+
+
+def _sync_callback_log(day, f):
+    """把紀錄檔中上次之後新增的行（包含其他行程寫的）加入索引"""
+    log = callback_logs.setdefault(day, {"offset": 0, "index": {}})
+    f.seek(log["offset"])
+    while True:
+        pos = f.tell()
+        line = f.readline()
+        if not line.endswith(b"\n"):
+            break
+        log["index"][line[:CALLBACK_TOKEN_LEN].decode("ascii", "ignore")] = pos
+        log["offset"] = f.tell()
+    return log
+
+
+def make_callback(action, **args):
+    """登記按鈕內容並回傳 callback_data（「動作|token」）"""
+    token = _callback_token(action, args)
+    data = f"{action}|{token}"
+    assert len(data.encode("utf-8")) <= CALLBACK_DATA_LIMIT, data
+    with callback_lock:
+        today = _callback_days()[0]
+        cached = callback_cache.get(token)
+        if cached and cached[0] == today:
+            callback_cache.move_to_end(token)
+            return data
+        if token not in callback_logs[today]["index"]:
+            with open(callbacks_path(today), "a+b") as f:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    log = _sync_callback_log(today, f)
+                    if token not in log["index"]:
+                        line = token + " " + json.dumps([action, args], ensure_ascii=False) + "\n"
+                        f.write(line.encode("utf-8"))
+                        f.flush()
+                        _sync_callback_log(today, f)
+                finally:
+                    if fcntl:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+        _cache_callback(token, today, action, args)
+    return data
+
+
+def _lookup_callback(token):
+    """token → (動作, 欄位)；找不到或已過期回傳 None"""
+    with callback_lock:
+        days = _callback_days()
+        cached = callback_cache.get(token)
+        if cached and cached[0] in days:
+            callback_cache.move_to_end(token)
+            return cached[1], cached[2]
+        for day in days:
+            path = callbacks_path(day)
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb") as f:
+                log = _sync_callback_log(day, f)
+                pos = log["index"].get(token)
+                if pos is None:
+                    continue
+                f.seek(pos)
+                action, args = json.loads(f.readline()[CALLBACK_TOKEN_LEN + 1:].decode("utf-8"))
+            _cache_callback(token, day, action, args)
+            return action, args
+    return None
+
+
+def parse_callback(data):
+    """
+    callback_data → (動作, 欄位 dict)。
+    token 找不到（過期）時欄位為 None；舊格式依 CALLBACK_FIELDS 拆開，缺少的欄位不放。
+    """
+    action, _, rest = (data or "").partition("|")
+    fields = CALLBACK_FIELDS.get(action)
+    if fields is None:
+        return action, {}
+    if len(rest) == CALLBACK_TOKEN_LEN and "|" not in rest and len(fields) > 1:
+        found = _lookup_callback(rest)
+        if found is None or found[0] != action:
+            return action, None
+        return action, found[1]
+
+    args = dict(zip(fields, rest.split("|", len(fields) - 1)))
+    if action in ("double", "complete", "fix") and "staff_name" not in args:
+        # 更舊的按鈕沒有 staff_name 欄位
+        args["staff_name"] = "未知服務員"
+    for k in CALLBACK_INT_FIELDS & args.keys():
+        try:
+            args[k] = int(args[k])
+        except ValueError:
+            return action, None
+    return action, args
+
+
+def expand_callback(data):
+    """token 換回舊格式的完整 callback_data（錄製用，重播時不依賴 token 紀錄檔）"""
+    action, args = parse_callback(data)
+    fields = CALLBACK_FIELDS.get(action)
+    if not fields or not args:
+        return data
+    return "|".join([action] + [str(args[f]) for f in fields if f in args])
+
+# -------------------------------
+# 背景寫檔佇列
+# 每次寫入都是整個檔案，所以同一路徑還沒寫出時只保留最新一份（coalesce），
+# 佇列長度最多是「不同檔案數」，查某檔最新的待寫內容是 O(1)。
+# 滿了（WRITE_QUEUE_MAX 個不同檔案）時 put 會等待，已接受的資料不丟；
+# WRITE_QUEUE_POLICY=shed 時，佇列滿或寫檔落後超過 WRITER_LAG_SHED 秒，webhook 直接回「忙碌中」不處理新 update
+# -------------------------------
+WRITE_QUEUE_MAX = int(os.getenv("WRITE_QUEUE_MAX", "256"))
+WRITE_QUEUE_POLICY = os.getenv("WRITE_QUEUE_POLICY", "block")  # block / shed
+WRITER_LAG_SHED = float(os.getenv("WRITER_LAG_SHED", "5"))
+WRITER_LAG_UNHEALTHY = float(os.getenv("WRITER_LAG_UNHEALTHY", "60"))
+
+
+FILE_UPGRADE = SHARED.get("FILE_UPGRADE") or object()  # write_queue 的特殊資料：由 writer 把舊格式檔改寫成目前格式
+
+
+class WriteQueue(queue.Queue):
+    """
+    queue.Queue 的 (path, data) 版本，put 同一路徑時取代尚未寫出的舊資料。
+    data 為 FILE_UPGRADE 時只在該檔沒有待寫資料時排入（有的話寫出時就是新格式）
+    """
+
+    def _init(self, maxsize):
+        self.queue = deque()   # 待寫路徑（依排入順序），None 代表停止
+        self.latest_data = {}  # 路徑 -> 最新資料
+        self.writing = {}      # 路徑 -> writer 已取出、還沒寫完的資料（這段期間讀檔仍是舊內容）
+        self.enqueued_at = {}  # 路徑 -> 排入時間（monotonic），算寫檔落後多久
+
+    def _put(self, item):
+        if item is None:
+            self.queue.append(None)
+            return
+        path, data = item
+        if path in self.latest_data:
+            if data is not FILE_UPGRADE:
+                self.latest_data[path] = data
+            self.unfinished_tasks -= 1  # put 會再 +1，合併的不算新工作
+            return
+        self.queue.append(path)
+        self.latest_data[path] = data
+        self.enqueued_at[path] = time.monotonic()
+
+    def _get(self):
+        path = self.queue.popleft()
+        if path is None:
+            return None
+        self.enqueued_at.pop(path, None)
+        data = self.latest_data.pop(path)
+        if data is not FILE_UPGRADE:
+            self.writing[path] = data
+        return path, data
+
+    def put(self, item, block=True, timeout=None):
+        if item is not None:
+            with self.mutex:
+                if item[0] in self.latest_data:  # 合併不佔新位置，佇列滿了也不用等
+                    if item[1] is not FILE_UPGRADE:
+                        self.latest_data[item[0]] = item[1]
+                    return
+        super().put(item, block, timeout)
+
+    def latest(self, path):
+        """該路徑尚未寫出（含正在寫）的最新資料（沒有回傳 None）；回傳的物件不可修改"""
+        with self.mutex:
+            data = self.latest_data.get(path)
+            if data is None or data is FILE_UPGRADE:
+                data = self.writing.get(path)
+        return data
+
+    def written(self, path, data):
+        """writer 寫完 get() 取出的資料後呼叫；之後讀檔就是這份內容"""
+        with self.mutex:
+            if self.writing.get(path) is data:
+                del self.writing[path]
+
+    def paths(self):
+        with self.mutex:
+            return set(self.latest_data) | set(self.writing)
+
+    def lag(self):
+        """最舊一筆待寫資料已等了幾秒"""
+        with self.mutex:
+            oldest = min(self.enqueued_at.values(), default=None)
+        return time.monotonic() - oldest if oldest is not None else 0.0
+
+
+write_queue = SHARED.get("write_queue") or WriteQueue(WRITE_QUEUE_MAX)
+
 
 def background_writer():
     """統一背景寫檔執行緒"""
     while True:
-        task = write_queue.get()
+        heartbeat("writer")
+        try:
+            task = write_queue.get(timeout=HEARTBEAT_INTERVAL)
+        except queue.Empty:
+            continue
         if task is None:  # 遇到 None 可以停止執行緒
+            write_queue.task_done()
             break
         path, data = task
-        try:
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            print(f"DEBUG: 背景寫檔完成 {path}")
-        except Exception as e:
-            print(f"ERROR: 背景寫檔失敗 {path}: {e}")
+        if data is FILE_UPGRADE:
+            upgrade_file(path)
+        else:
+            write_json_atomic(path, data)
+            write_queue.written(path, data)
         write_queue.task_done()
+
+
 # -------------------------------
-# pending 狀態（persist 到檔案，key = user_id 字串）
+# 檔案格式
+# v2：第一行標頭「#TGB 版本 crc32 內容長度」，接著是沒有縮排的 JSON
+# v1：舊版 indent=2 的 JSON（沒有標頭），照樣讀得到，並排入 writer 改寫成 v2
 # -------------------------------
-def load_pending():
-    if not os.path.exists(PENDING_FILE):
-        return {}
+FILE_MAGIC = b"#TGB "
+FILE_SCHEMA_VERSION = 2
+FILE_UPGRADES = {1: lambda data: data}  # 版本 n → n+1 的內容轉換（v1 → v2 只改外層格式）
+
+
+def encode_document(data):
+    """序列化失敗（例如混入 datetime.time）會直接丟 TypeError，不會寫出壞檔"""
+    body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return b"%s%d %08x %d\n" % (FILE_MAGIC, FILE_SCHEMA_VERSION, zlib.crc32(body), len(body)) + body
+
+
+class FileVersionError(ValueError):
+    """檔案是較新版本的程式寫的：不能當成空檔，也不能覆寫"""
+
+
+def decode_document(raw):
+    """回傳 (資料, 檔案版本)；標頭與內容不符丟 ValueError，版本比程式新丟 FileVersionError"""
+    if not raw.startswith(FILE_MAGIC):
+        return json.loads(raw.decode("utf-8")), 1
+    header, _, body = raw.partition(b"\n")
     try:
-        with open(PENDING_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception as e:
-        print(f"ERROR: 讀取 pending 檔案失敗: {e}")
-        return {}
+        _, version, crc, length = header.split()
+        version, crc, length = int(version), int(crc, 16), int(length)
+    except ValueError:
+        raise ValueError(f"檔案標頭格式錯誤：{header[:40]!r}")
+    if version > FILE_SCHEMA_VERSION:
+        raise FileVersionError(f"檔案格式 v{version} 比程式支援的 v{FILE_SCHEMA_VERSION} 新")
+    if len(body) != length or zlib.crc32(body) != crc:
+        raise ValueError("檔案校驗失敗（內容不完整或已損毀）")
+    return json.loads(body), version
 
-def save_pending(new_data):
-    """將 new_data 合併到 pending.json 再推入 queue 背景寫入"""
-    path = PENDING_FILE
 
-    # 讀取現有檔案
-    existing = {}
-    if os.path.exists(path):
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                existing = json.load(f)
-        except Exception as e:
-            print(f"WARNING: 讀取現有 pending.json 失敗: {e}")
+def upgrade_document(data, version):
+    while version < FILE_SCHEMA_VERSION:
+        data = FILE_UPGRADES[version](data)
+        version += 1
+    return data
 
-    # 合併新的資料
-    existing.update(new_data)
 
-    # 推入背景寫檔 queue
-    write_queue.put((path, existing))
+def upgrade_file(path):
+    """在 writer 執行緒裡把舊格式檔改寫成目前格式（只有 writer 寫檔，不會和其他寫入互相覆蓋）"""
+    try:
+        with open(path, "rb") as f:
+            data, version = decode_document(f.read())
+    except (OSError, ValueError) as e:
+        print(f"ERROR: 升級檔案格式失敗 {path}: {e}")
+        return
+    if version < FILE_SCHEMA_VERSION and write_json_atomic(path, upgrade_document(data, version)):
+        print(f"DEBUG: {path} 已由 v{version} 升級為 v{FILE_SCHEMA_VERSION}")
+
+
+def write_json_atomic(path, data):
+    try:
+        raw = encode_document(data)
+        # 先寫暫存檔再 os.replace，讀取端不會讀到寫一半的檔案
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(raw)
+        os.replace(tmp, path)
+        print(f"DEBUG: 背景寫檔完成 {path}")
+        return True
+    except Exception as e:
+        print(f"ERROR: 背景寫檔失敗 {path}: {e}")
+        return False
+# -------------------------------
+# pending 狀態（persist 到檔案，key = user_id 字串）
+# -------------------------------
+def load_pending():
+    return load_json_file(PENDING_FILE, {})
+
+def _current_pending():
+    """最新的 pending：queue 中還沒寫出的那份優先，否則讀檔（回傳可修改的副本）"""
+    queued = write_queue.latest(PENDING_FILE)
+    return dict(queued) if queued is not None else load_pending()
+
+
+def save_pending(new_data):
+    """將 new_data 合併到最新的 pending 再推入 queue 背景寫入"""
+    with pending_lock:
+        existing = _current_pending()
+        existing.update(new_data)
+        write_queue.put((PENDING_FILE, existing))
 
 
 def set_pending_for(user_id, payload):
@@ -106,20 +612,16 @@ def set_pending_for(user_id, payload):
 
     
 def get_pending_for(user_id):
-    pending = load_pending()
-    # 合併 queue 中未寫入的 pending.json
-    for path, data in list(write_queue.queue):
-        if path == PENDING_FILE:
-            pending.update(data)
-    return pending.get(str(user_id))
+    return _current_pending().get(str(user_id))
 
 
 
 def clear_pending_for(user_id):
-    p = load_pending()
-    if str(user_id) in p:
-        del p[str(user_id)]
-        save_pending(p)
+    with pending_lock:
+        p = _current_pending()
+        if str(user_id) in p:
+            del p[str(user_id)]
+            write_queue.put((PENDING_FILE, p))
 
 def has_pending_for(user_id):
     return get_pending_for(user_id) is not None
@@ -128,10 +630,15 @@ def has_pending_for(user_id):
 # 群組管理
 # -------------------------------
 GROUP_FILE = os.path.join(DATA_DIR, "groups.json")
-STAFF_GROUP_ID = -1003119493503
+STAFF_GROUP_ID = TENANT.get("staff_group_id", -1003119493503)
+groups_lock = threading.Lock()  # groups.json 的「讀 → 改 → 存」要整段互斥，否則會蓋掉彼此的修改
 
 def load_groups():
     groups = load_json_file(GROUP_FILE, default=[])
+    # queue 中還沒寫入的 groups.json 比檔案新
+    queued = write_queue.latest(GROUP_FILE)
+    if queued is not None:
+        groups = list(queued)
     if not isinstance(groups, list):
         groups = []
     if not any(g.get("id") == STAFF_GROUP_ID for g in groups):
@@ -143,12 +650,15 @@ def save_groups(groups):
     write_queue.put((GROUP_FILE, groups))
 
 def add_group(chat_id, chat_type, group_role=None):
-    groups = load_groups()
-    if any(g.get("id") == chat_id for g in groups):
-        return
-    role = group_role or ("staff" if chat_id == STAFF_GROUP_ID else "business")
-    groups.append({"id": chat_id, "type": role})
-    save_groups(groups)
+    if any(g.get("id") == chat_id for g in load_groups()):
+        return  # 每則訊息都會呼叫，已登記的群組不必拿鎖
+    with groups_lock:
+        groups = load_groups()
+        if any(g.get("id") == chat_id for g in groups):
+            return
+        role = group_role or ("staff" if chat_id == STAFF_GROUP_ID else "business")
+        groups.append({"id": chat_id, "type": role})
+        save_groups(groups)
 
 def get_group_ids_by_type(group_type=None):
     """取得指定角色的群組ID"""
@@ -157,25 +667,534 @@ def get_group_ids_by_type(group_type=None):
         return [g.get("id") for g in groups if g.get("type") == group_type]
     return [g.get("id") for g in groups]
 
+
+GROUP_PRUNE_AFTER = 3  # 連續幾次永久失敗（被踢、群組不存在）後從 groups.json 移除
+
+
+def record_group_outcomes(outcomes):
+    """依群發結果更新各群組的 failures；成功歸零，永久失敗累加，達上限即移除（服務員群不移除）"""
+    with groups_lock:
+        groups = load_groups()
+        changed = False
+        kept = []
+        for g in groups:
+            o = outcomes.get(g.get("id"))
+            if o is None or (not o["ok"] and not o["permanent"]):
+                kept.append(g)
+                continue
+            g = dict(g)  # 原本的 dict 可能還在 write_queue 裡等 writer 序列化，不能原地修改
+            if o["ok"]:
+                if g.pop("failures", None) is not None:
+                    g.pop("last_error", None)
+                    changed = True
+                kept.append(g)
+                continue
+            g["failures"] = g.get("failures", 0) + 1
+            g["last_error"] = o["error"]
+            changed = True
+            if g["failures"] >= GROUP_PRUNE_AFTER and g.get("id") != STAFF_GROUP_ID:
+                print(f"WARNING: 群組 {g.get('id')} 連續 {g['failures']} 次無法送達（{o['error']}），已移除")
+                continue
+            kept.append(g)
+        if changed:
+            save_groups(kept)
+
 # -------------------------------
 # JSON 存取（每日檔）
 # -------------------------------
 def data_path_for(day):
     return os.path.join(DATA_DIR, f"{day}.json")
 
+def quarantine_file(path, reason):
+    """把解不開的檔案改名成 *.corrupt 留著人工處理；原路徑之後會重建，壞檔不會被刪除或覆寫"""
+    dest = path + ".corrupt"
+    if os.path.exists(dest):
+        dest = f"{path}.{int(time.time())}.corrupt"
+    try:
+        os.replace(path, dest)
+    except FileNotFoundError:
+        return  # 其他執行緒已經移走
+    print(f"ERROR: {path} 無法讀取（{reason}），已移到 {dest}")
+
+
 def load_json_file(path, default=None):
+    """
+    讀取資料檔；檔案不存在回傳 default。
+    內容損毀（校驗失敗、不是 JSON）時隔離成 *.corrupt 再回傳 default；
+    版本比程式新（FileVersionError）或讀不到（OSError）直接丟出，不能當成空檔而被覆寫
+    """
     if not os.path.exists(path):
         return default or {}
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception as e:
-        print(f"ERROR: 讀取檔案失敗 {path}: {e}")
+        with open(path, "rb") as f:
+            data, version = decode_document(f.read())
+    except FileVersionError as e:
+        print(f"ERROR: {path}：{e}，請更新程式；不會覆寫此檔")
+        raise
+    except ValueError as e:  # 含 JSONDecodeError、UnicodeDecodeError
+        quarantine_file(path, e)
         return default or {}
+    if version < FILE_SCHEMA_VERSION:
+        data = upgrade_document(data, version)
+        write_queue.put((path, FILE_UPGRADE))  # 第一次讀到舊格式：背景改寫
+    return data
 
 def save_json_file(path, data):
     write_queue.put((path, data))  # 推入 Queue 背景寫檔
 
+# -------------------------------
+# 服務帳本（append-only）與統計
+# 客到、客資（客人、年齡、服務員、報價）、完成服務、未消、雙人服務各寫一行到 ledger.jsonl；
+# 寫入時同步累加 日 / 週 / 月 彙總（含各業務群、各服務員），/report 直接查彙總
+# -------------------------------
+LEDGER_FILE = os.path.join(DATA_DIR, "ledger.jsonl")
+LEDGER_ROLLUP_FILE = os.path.join(DATA_DIR, "ledger_rollup.json")
+LEDGER_ROLLUP_SAVE_EVERY = 20  # 每幾筆存一次彙總；重啟時從彙總記下的位置補讀帳本
+LEDGER_KINDS = ("arrive", "client_info", "complete", "not_consumed", "double")
+
+ledger_lock = threading.Lock()
+ledger = {"loaded": False, "offset": 0, "unsaved": 0, "rollups": {}}  # rollups：期間 key -> 彙總
+
+
+def ledger_periods(day):
+    """一天所屬的彙總期間：day:YYYY-MM-DD、week:YYYY-Www、month:YYYY-MM"""
+    d = datetime.strptime(day, "%Y-%m-%d").date() if isinstance(day, str) else day
+    year, week, _ = d.isocalendar()
+    return (f"day:{d.isoformat()}", f"week:{year}-W{week:02d}", f"month:{d.isoformat()[:7]}")
+
+
+def _add_stat(stats, kind, amount):
+    count, total = stats.get(kind, (0, 0.0))
+    stats[kind] = [count + 1, total + amount]
+
+
+def _apply_ledger_entry(entry):
+    """把一筆帳累加到所屬的日 / 週 / 月彙總"""
+    kind = entry["kind"]
+    amount = entry.get("amount") or 0.0
+    staff = entry.get("staff") or []
+    gid = str(entry.get("business_chat_id"))
+    for key in ledger_periods(entry["date"]):
+        bucket = ledger["rollups"].setdefault(key, {"total": {}, "groups": {}, "staff": {}})
+        _add_stat(bucket["total"], kind, amount)
+        _add_stat(bucket["groups"].setdefault(gid, {}), kind, amount)
+        for name in staff:  # 多人服務時金額平分
+            _add_stat(bucket["staff"].setdefault(name, {}), kind, amount / len(staff))
+
+
+def _load_ledger():
+    """第一次使用時載入彙總，並補讀彙總之後才寫入帳本的部分（須持有 ledger_lock）"""
+    saved = load_json_file(LEDGER_ROLLUP_FILE, {})
+    ledger["rollups"] = saved.get("rollups", {})
+    ledger["offset"] = saved.get("offset", 0)
+    if os.path.exists(LEDGER_FILE):
+        with open(LEDGER_FILE, "rb") as f:
+            if ledger["offset"] > os.path.getsize(LEDGER_FILE):  # 帳本被換過：整份重算
+                ledger["rollups"], ledger["offset"] = {}, 0
+            f.seek(ledger["offset"])
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break  # 寫到一半的最後一行，下次再讀
+                ledger["offset"] += len(raw)
+                try:
+                    _apply_ledger_entry(json.loads(raw))
+                except (ValueError, KeyError) as e:
+                    print(f"ERROR: 帳本格式錯誤，略過：{raw[:80]!r} {e}")
+    ledger["loaded"] = True
+
+
+def record_service(kind, hhmm, name, business_chat_id, amount=None, staff=None, **extra):
+    """寫一筆帳並更新彙總；帳本寫失敗只記錄錯誤，不影響服務流程"""
+    now = get_now()
+    entry = {"ts": now.isoformat(timespec="seconds"), "date": now.date().isoformat(), "kind": kind,
+             "hhmm": hhmm, "name": name, "business_chat_id": business_chat_id,
+             "amount": amount, "staff": staff or []}
+    entry.update(extra)
+    line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+    with ledger_lock:
+        if not ledger["loaded"]:
+            _load_ledger()
+        try:
+            with open(LEDGER_FILE, "ab") as f:
+                f.write(line)
+        except OSError as e:
+            print(f"ERROR: 帳本寫入失敗：{e}")
+            return
+        ledger["offset"] += len(line)
+        _apply_ledger_entry(entry)
+        ledger["unsaved"] += 1
+        if ledger["unsaved"] >= LEDGER_ROLLUP_SAVE_EVERY:
+            ledger["unsaved"] = 0
+            save_json_file(LEDGER_ROLLUP_FILE, copy.deepcopy({"offset": ledger["offset"], "rollups": ledger["rollups"]}))
+
+
+def ledger_report(period="day", day=None):
+    """回傳某期間的彙總 {"total", "groups", "staff"}（沒有資料回傳 None）"""
+    index = {"day": 0, "week": 1, "month": 2}[period]
+    key = ledger_periods(day or get_now().date())[index]
+    with ledger_lock:
+        if not ledger["loaded"]:
+            _load_ledger()
+        bucket = ledger["rollups"].get(key)
+        return key, copy.deepcopy(bucket)
+
+# -------------------------------
+# 當日排班資料模型
+# 時間存成「當天第幾分鐘」整數，候補以 waitlist 旗標表示（舊檔的 "名字(候補)" 字串讀入時轉換）
+# 磁碟上仍是原本的 JSON 結構：load_day / Day.to_raw 負責轉換
+# -------------------------------
+WAITLIST_SUFFIX = "(候補)"
+
+
+def parse_hhmm(value):
+    """'HH:MM' / datetime.time / 分鐘數 → 當天第幾分鐘，格式錯誤丟 ValueError"""
+    if isinstance(value, int):
+        return value
+    if isinstance(value, dt_time):
+        return value.hour * 60 + value.minute
+    hh, mm = map(int, str(value).split(":"))
+    if not (0 <= hh < 24 and 0 <= mm < 60):
+        raise ValueError(f"invalid time {value!r}")
+    return hh * 60 + mm
+
+
+def format_hhmm(minute):
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+
+class Booking:
+    """未報到的預約"""
+    __slots__ = ("name", "chat_id")
+
+    def __init__(self, name, chat_id=None):
+        self.name = name
+        self.chat_id = chat_id
+
+    def __eq__(self, other):
+        return isinstance(other, Booking) and (self.name, self.chat_id) == (other.name, other.chat_id)
+
+    def __repr__(self):
+        return f"Booking({self.name!r}, {self.chat_id!r})"
+
+    @classmethod
+    def from_raw(cls, raw):
+        if isinstance(raw, dict):
+            return cls(raw.get("name", ""), raw.get("chat_id"))
+        return cls(str(raw))
+
+    def to_raw(self):
+        return {"name": self.name, "chat_id": self.chat_id}
+
+
+class Arrival:
+    """已報到（in_progress）"""
+    __slots__ = ("name", "amount", "waitlist")
+
+    def __init__(self, name, amount=None, waitlist=False):
+        self.name = name
+        self.amount = amount
+        self.waitlist = waitlist
+
+    def __eq__(self, other):
+        return isinstance(other, Arrival) and (self.name, self.amount, self.waitlist) == (other.name, other.amount, other.waitlist)
+
+    def __repr__(self):
+        return f"Arrival({self.name!r}, {self.amount!r}, waitlist={self.waitlist})"
+
+    @classmethod
+    def from_raw(cls, raw):
+        if isinstance(raw, dict):
+            return cls(raw.get("name", ""), raw.get("amount"), bool(raw.get("waitlist")))
+        name = str(raw)
+        if name.endswith(WAITLIST_SUFFIX):
+            return cls(name[:-len(WAITLIST_SUFFIX)], waitlist=True)
+        return cls(name)
+
+    def to_raw(self):
+        raw = {"name": self.name, "amount": self.amount}
+        if self.waitlist:
+            raw["waitlist"] = True
+        return raw
+
+
+class Shift:
+    """
+    一個時段。used（佔用名額：未報到 + 已報到，候補不算）是隨增刪即時維護的計數器，
+    只存在記憶體：讀檔時由名單重算、寫檔不落地。名單請一律透過 add_booking / remove_bookings / add_arrival / remove_arrival / clear 修改，
+    不要直接改 bookings / in_progress 串列；check_capacity_counters 可重算並找出偏差。
+    """
+    __slots__ = ("minute", "limit", "bookings", "in_progress", "used")
+
+    def __init__(self, minute, limit=1, bookings=None, in_progress=None, used=None):
+        self.minute = minute
+        self.limit = limit
+        self.bookings = bookings if bookings is not None else []
+        self.in_progress = in_progress if in_progress is not None else []
+        self.used = used if used is not None else self.count_used()
+
+    def __repr__(self):
+        return f"Shift({self.time}, limit={self.limit}, used={self.used}, bookings={len(self.bookings)}, in_progress={len(self.in_progress)})"
+
+    def copy(self):
+        """新的串列、共用裡面的 Booking / Arrival（它們建立後不會再被修改）"""
+        return Shift(self.minute, self.limit, list(self.bookings), list(self.in_progress), self.used)
+
+    @property
+    def time(self):
+        return format_hhmm(self.minute)
+
+    @property
+    def remaining(self):
+        return max(0, self.limit - self.used)
+
+    def count_used(self):
+        """由原始名單重算佔用名額（只給載入與一致性檢查用）"""
+        return len(self.bookings) + sum(1 for a in self.in_progress if not a.waitlist)
+
+    def add_booking(self, booking):
+        self.bookings.append(booking)
+        self.used += 1
+
+    def remove_bookings(self, match):
+        """移除 match(booking) 為真的預約，回傳被移除的清單"""
+        kept, removed = [], []
+        for b in self.bookings:
+            (removed if match(b) else kept).append(b)
+        if removed:
+            self.bookings = kept
+            self.used -= len(removed)
+        return removed
+
+    def add_arrival(self, arrival):
+        self.in_progress.append(arrival)
+        if not arrival.waitlist:
+            self.used += 1
+
+    def remove_arrival(self, arrival):
+        self.in_progress.remove(arrival)
+        if not arrival.waitlist:
+            self.used -= 1
+
+    def clear(self):
+        self.bookings = []
+        self.in_progress = []
+        self.used = 0
+
+    def find_booking(self, name, chat_id=None):
+        return next((b for b in self.bookings if b.name == name and (chat_id is None or b.chat_id == chat_id)), None)
+
+    def find_arrival(self, name):
+        """候補也可用「名字(候補)」找到"""
+        return next((a for a in self.in_progress
+                     if a.name == name or (a.waitlist and a.name + WAITLIST_SUFFIX == name)), None)
+
+    @classmethod
+    def from_raw(cls, raw):
+        # 計數器一律由名單重算；舊檔裡殘留的 "used" 直接忽略
+        return cls(
+            parse_hhmm(raw.get("time", "00:00")),
+            raw.get("limit", 1),
+            [Booking.from_raw(b) for b in raw.get("bookings", [])],
+            [Arrival.from_raw(a) for a in raw.get("in_progress", [])],
+        )
+
+    def to_raw(self):
+        return {
+            "time": self.time,
+            "limit": self.limit,
+            "bookings": [b.to_raw() for b in self.bookings],
+            "in_progress": [a.to_raw() for a in self.in_progress],
+        }
+
+
+class WaitEntry:
+    """候補名單（data["候補"]）；requested_at 是申請時間（epoch 秒），先申請先遞補"""
+    __slots__ = ("minute", "name", "chat_id", "requested_at")
+
+    def __init__(self, minute, name, chat_id=None, requested_at=0.0):
+        self.minute = minute
+        self.name = name
+        self.chat_id = chat_id
+        self.requested_at = requested_at
+
+    def __eq__(self, other):
+        return isinstance(other, WaitEntry) and (self.minute, self.name, self.chat_id) == (other.minute, other.name, other.chat_id)
+
+    def __lt__(self, other):  # heapq 排序用
+        return (self.requested_at, self.name) < (other.requested_at, other.name)
+
+    @property
+    def time(self):
+        return format_hhmm(self.minute)
+
+    @classmethod
+    def from_raw(cls, raw):
+        return cls(parse_hhmm(raw.get("time", "00:00")), raw.get("name", ""), raw.get("chat_id"), raw.get("requested_at", 0.0))
+
+    def to_raw(self):
+        return {"time": self.time, "name": self.name, "chat_id": self.chat_id, "requested_at": self.requested_at}
+
+
+class Day:
+    """
+    一天的排班；extra 保留檔案中其他未知欄位，寫回時原樣保存。
+    候補依時段分開，各自是以申請時間排序的 heap（waitlists：分鐘 -> [WaitEntry]），
+    名額空出時 promote_waiting 以 O(log n) 取出最早的一位
+    """
+    __slots__ = ("date", "shifts", "waitlists", "extra")
+
+    def __init__(self, date, shifts=None, waitlists=None, extra=None):
+        self.date = date
+        self.shifts = shifts if shifts is not None else []
+        self.waitlists = waitlists if waitlists is not None else {}
+        self.extra = extra if extra is not None else {}
+
+    def copy(self):
+        """寫入端用：複製容器做出下一版，原本已發布的快照不受影響"""
+        return Day(self.date, [s.copy() for s in self.shifts],
+                   {m: list(heap) for m, heap in self.waitlists.items()}, dict(self.extra))
+
+    def iter_waiting(self):
+        for heap in self.waitlists.values():
+            yield from heap
+
+    def add_waiting(self, entry):
+        """加入候補，回傳該時段目前排第幾位"""
+        heap = self.waitlists.setdefault(entry.minute, [])
+        heapq.heappush(heap, entry)
+        return sum(1 for c in heap if not entry < c)
+
+    def remove_waiting(self, minute, name):
+        heap = self.waitlists.get(minute) or []
+        kept = [c for c in heap if c.name != name]
+        if len(kept) == len(heap):
+            return False
+        heapq.heapify(kept)
+        if kept:
+            self.waitlists[minute] = kept
+        else:
+            self.waitlists.pop(minute, None)
+        return True
+
+    def promote_waiting(self, shift):
+        """依申請先後把候補補進空出的名額，回傳 [(WaitEntry, 實際預約名)]"""
+        heap = self.waitlists.get(shift.minute)
+        promoted = []
+        while heap and shift.remaining > 0:
+            entry = heapq.heappop(heap)
+            name = generate_unique_name(shift.bookings, entry.name)
+            shift.add_booking(Booking(name, entry.chat_id))
+            promoted.append((entry, name))
+        if heap is not None and not heap:
+            del self.waitlists[shift.minute]
+        return promoted
+
+    @classmethod
+    def from_raw(cls, raw):
+        shifts = []
+        for s in raw.get("shifts", []) if isinstance(raw.get("shifts"), list) else []:
+            try:
+                shifts.append(Shift.from_raw(s))
+            except (ValueError, AttributeError) as e:
+                print(f"WARNING: 略過格式錯誤的時段 {s}: {e}")
+        waitlists = {}
+        for c in raw.get("候補", []) if isinstance(raw.get("候補"), list) else []:
+            try:
+                entry = WaitEntry.from_raw(c)
+            except (ValueError, AttributeError) as e:
+                print(f"WARNING: 略過格式錯誤的候補 {c}: {e}")
+                continue
+            waitlists.setdefault(entry.minute, []).append(entry)
+        for heap in waitlists.values():
+            heapq.heapify(heap)
+        extra = {k: v for k, v in raw.items() if k not in ("date", "shifts", "候補")}
+        return cls(raw.get("date"), shifts, waitlists, extra)
+
+    def to_raw(self):
+        raw = {"date": self.date, "shifts": [s.to_raw() for s in self.shifts], "候補": [c.to_raw() for c in self.iter_waiting()]}
+        raw.update(self.extra)
+        return raw
+
+
+def load_day(path):
+    return Day.from_raw(load_json_file(path))
+
+
+def check_capacity_counters(day, repair=True):
+    """以原始名單重算每個時段的 used，回傳偏差 [(時段, 計數器, 實際)]；repair 時順便修正"""
+    drift = []
+    for s in day.shifts:
+        actual = s.count_used()
+        if s.used != actual:
+            drift.append((s.time, s.used, actual))
+            if repair:
+                s.used = actual
+    if drift:
+        print(f"WARNING: 名額計數器偏差 {day.date}: {drift}")
+    return drift
+
+
+def save_day(path, day):
+    """推入背景寫檔，並把 day 發布成新的當日快照（之後不可再修改 day）"""
+    if day.date == get_now().date().isoformat():
+        publish_day(path, day)
+    save_json_file(path, day.to_raw())
+
+# -------------------------------
+# 當日資料快照（copy-on-write）
+# 每次寫入後發布一個新的 Day；讀取端直接拿目前的參考，不加鎖也不讀檔。
+# 已發布的 Day 一律唯讀，要修改請用 safe_modify_today_file（會先 copy 再改）。
+# -------------------------------
+snapshot_lock = threading.Lock()  # 只保護發布（版本號遞增），讀取不需要
+day_snapshot = None  # (path, version, Day)，整組一次替換，讀到的一定是同一版
+
+
+def publish_day(path, day):
+    global day_snapshot
+    with snapshot_lock:
+        version = day_snapshot[1] + 1 if day_snapshot else 1
+        day_snapshot = (path, version, day)
+
+
+def get_day_snapshot(path=None):
+    """目前當日資料（唯讀）；只有還沒有快照或換日時才讀檔"""
+    path = path or ensure_today_file()
+    snap = day_snapshot
+    if snap is not None and snap[0] == path:
+        return snap[2]
+    with file_modify_lock:
+        snap = day_snapshot
+        if snap is None or snap[0] != path:
+            publish_day(path, _load_day_with_queue(path))
+            snap = day_snapshot
+    return snap[2]
+
+
+def get_versioned_snapshot():
+    """(版本號, 當日快照)，兩者保證是同一版"""
+    get_day_snapshot()
+    snap = day_snapshot
+    return snap[1], snap[2]
+
+
+def _load_day_with_queue(path):
+    """從檔案載入，並合併 queue 中尚未寫入的資料（冷啟動時用）"""
+    day = load_day(path)
+    qdata = write_queue.latest(path)
+    if qdata is not None:
+        queued = Day.from_raw(qdata)
+        # merge shifts 列表，避免覆蓋
+        merge_shifts(day.shifts, queued.shifts)
+        # merge 候補列表
+        for item in queued.iter_waiting():
+            if item not in day.waitlists.get(item.minute, []):
+                day.add_waiting(item)
+        # 可以合併其他 key 的字典
+        day.extra.update(queued.extra)
+        if queued.date:
+            day.date = queued.date
+    return day
+
 # -------------------------------
 # 安全檔案修改封裝（加鎖）
 # -------------------------------
@@ -183,62 +1202,48 @@ def safe_modify_today_file(callback):
     path = ensure_today_file()
 
     with file_modify_lock:  # 確保同一時間只有一個 callback 在修改
-        data = load_json_file(path)
+        snap = day_snapshot
+        if snap is not None and snap[0] == path:
+            base = snap[2]  # 快照已包含所有寫入，不必再讀檔或合併 queue
+        else:
+            base = _load_day_with_queue(path)
 
-        # 合併 queue 中尚未寫入的資料
-        for p, qdata in list(write_queue.queue):
-            if p == path:
-                # merge shifts 列表，避免覆蓋
-                merge_shifts(data.get("shifts", []), qdata.get("shifts", []))
-                # merge 候補列表
-                if "候補" in qdata:
-                    for item in qdata["候補"]:
-                        if item not in data["候補"]:
-                            data["候補"].append(item)
-                # 可以合併其他 key 的字典
-                for k, v in qdata.items():
-                    if k not in ("shifts", "候補"):
-                        data[k] = v
-
-        # 執行 callback 修改資料
-        callback(data)
-
-        # 推入 queue 背景寫檔
-        write_queue.put((path, data))
+        # 在副本上執行 callback，正在讀舊版的執行緒不受影響
+        day = base.copy()
+        callback(day)
+
+        # 發布新版並推入 queue 背景寫檔
+        save_day(path, day)
 
      
 # -------------------------------
 # 每日排班檔生成
 # -------------------------------
 def ensure_today_file(workers=3):
-    today = datetime.now(TZ).date().isoformat()
+    now = get_now()
+    today = now.date().isoformat()
     path = data_path_for(today)
-    now = datetime.now(TZ)
 
-    # 每天生成新檔時清空已使用按鈕
-    clear_used_staff_buttons()
+    # 今天的快照已存在，代表檔案已建立且格式正確
+    snap = day_snapshot
+    if snap is not None and snap[0] == path and snap[2].date == today:
+        return path
 
-    # 如果檔案存在，但日期不是今天，刪除舊檔
+    # 如果檔案存在，但日期不是今天，刪除舊檔（讀不出來的檔已被 load_json_file 隔離成 *.corrupt）
     if os.path.exists(path):
         data = load_json_file(path)
-        if data.get("date") != today:
+        if data.get("date") != today and os.path.exists(path):
             os.remove(path)
 
-    # 如果檔案不存在，建立今天的檔案
+    # 如果檔案不存在，建立今天的檔案（換日）；順便把過去的每日檔歸檔
     if not os.path.exists(path):
         shifts = []
-        for h in range(13, 23):  # 13:00 ~ 22:00
-            shift_time = dt_time(h, 0)
-            shift_dt = datetime.combine(now.date(), shift_time).replace(tzinfo=TZ)
-            if shift_dt > now:
-                shifts.append({
-                    "time": f"{h:02d}:00",
-                    "limit": workers,
-                    "bookings": [],
-                    "in_progress": []
-                })
-        data = {"date": today, "shifts": shifts, "候補": []}
-        save_json_file(path, data)
+        for h in SHIFT_HOURS:
+            if is_future_time(h * 60):
+                shifts.append(Shift(h * 60, workers))
+        save_day(path, Day(today, shifts))
+        day_state.rollover(today)
+        start_archiver(today)
     else:
         # 確保已存在的檔案裡的 "shifts" 和 "候補" 是列表
         data = load_json_file(path)
@@ -255,16 +1260,138 @@ def ensure_today_file(workers=3):
     return path
 
 
+# -------------------------------
+# 每日檔歸檔
+# 過去的 YYYY-MM-DD.json 每天各自 gzip 後附加到 archive/YYYY-MM.bundle，
+# 旁邊的 YYYY-MM.index.json 記錄 日期 -> [位置, 長度] 與 業務群 chat_id -> [日期]，
+# 查某一天或某群的歷史只需解壓那幾段；data/ 只留今天的檔案
+# -------------------------------
+ARCHIVE_DIR = os.path.join(DATA_DIR, "archive")
+_DAY_FILE_RE = re.compile(r"^(\d{4}-\d{2}-\d{2})\.json$")
+
+archive_lock = threading.Lock()
+
+
+def archive_paths(month):
+    return (os.path.join(ARCHIVE_DIR, f"{month}.bundle"), os.path.join(ARCHIVE_DIR, f"{month}.index.json"))
+
+
+def load_archive_index(month):
+    return load_json_file(archive_paths(month)[1], {"days": {}, "groups": {}})
+
+
+def _day_chat_ids(raw):
+    ids = set()
+    for s in raw.get("shifts", []) or []:
+        for b in s.get("bookings", []) or []:
+            if isinstance(b, dict) and b.get("chat_id") is not None:
+                ids.add(str(b["chat_id"]))
+    for c in raw.get("候補", []) or []:
+        if isinstance(c, dict) and c.get("chat_id") is not None:
+            ids.add(str(c["chat_id"]))
+    return ids
+
+
+def archive_past_days(today):
+    """把 today 之前的每日檔歸檔，回傳已歸檔的日期"""
+    pending = {}
+    queued = write_queue.paths()
+    for fname in os.listdir(DATA_DIR):
+        m = _DAY_FILE_RE.match(fname)
+        path = os.path.join(DATA_DIR, fname)
+        if m and m.group(1) < today and path not in queued:  # 還在 write_queue 的等下次
+            pending.setdefault(m.group(1)[:7], []).append(m.group(1))
+    if not pending:
+        return []
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    archived = []
+    for month, days in sorted(pending.items()):
+        bundle_path, index_path = archive_paths(month)
+        index = load_archive_index(month)
+        with open(bundle_path, "ab") as bundle:
+            for day in sorted(days):
+                path = data_path_for(day)
+                try:
+                    with open(path, "rb") as f:
+                        raw = upgrade_document(*decode_document(f.read()))
+                except (OSError, ValueError) as e:
+                    print(f"ERROR: 歸檔讀取失敗 {path}: {e}")
+                    continue
+                blob = gzip.compress(json.dumps(raw, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+                offset = bundle.tell()
+                bundle.write(blob)
+                index["days"][day] = [offset, len(blob)]  # 同一天重歸檔時指向新的一段
+                for gid in _day_chat_ids(raw):
+                    dates = index["groups"].setdefault(gid, [])
+                    if day not in dates:
+                        dates.append(day)
+                        dates.sort()
+                archived.append(day)
+            bundle.flush()
+            os.fsync(bundle.fileno())
+        # 索引寫好之後才刪每日檔；中途當機最多重複歸檔，不會遺失
+        if not write_json_atomic(index_path, index):
+            continue
+        for day in days:
+            if day in index["days"]:
+                try:
+                    os.remove(data_path_for(day))
+                except OSError as e:
+                    print(f"WARNING: 刪除已歸檔的每日檔失敗 {day}: {e}")
+    print(f"DEBUG: 歸檔 {len(archived)} 天：{archived}")
+    return archived
+
+
+def start_archiver(today):
+    """換日時在背景歸檔；已有一個在跑就略過"""
+    def run():
+        if not archive_lock.acquire(blocking=False):
+            return
+        try:
+            archive_past_days(today)
+        except Exception as e:
+            print(f"ERROR: 歸檔失敗: {e}")
+            traceback.print_exc()
+        finally:
+            archive_lock.release()
+
+    threading.Thread(target=run, daemon=True, name="archiver").start()
+
+
+def load_archived_day(day):
+    """讀取已歸檔的某一天（原始 dict），沒有回傳 None"""
+    bundle_path, _ = archive_paths(day[:7])
+    entry = load_archive_index(day[:7])["days"].get(day)
+    if not entry:
+        return None
+    offset, length = entry
+    with open(bundle_path, "rb") as f:
+        f.seek(offset)
+        return json.loads(gzip.decompress(f.read(length)))
+
+
+def iter_archived_group(chat_id, month):
+    """某業務群在某月份（YYYY-MM）有預約的每一天，逐天產生原始 dict"""
+    for day in load_archive_index(month)["groups"].get(str(chat_id), []):
+        raw = load_archived_day(day)
+        if raw is not None:
+            yield raw
+
+
 def find_shift(shifts, hhmm):
-    return next((s for s in shifts if s.get("time") == hhmm), None)
+    try:
+        minute = parse_hhmm(hhmm)
+    except ValueError:
+        return None
+    return next((s for s in shifts if s.minute == minute), None)
 
 
 def is_future_time(hhmm):
-    now = datetime.now(TZ)
+    """hhmm 可為 'HH:MM' 或當天第幾分鐘"""
+    now = get_now()
     try:
-        hh, mm = map(int, hhmm.split(":"))
-        shift_dt = datetime.combine(now.date(), dt_time(hh, mm)).replace(tzinfo=TZ)
-        return shift_dt > now
+        return parse_hhmm(hhmm) > now.hour * 60 + now.minute
     except ValueError:
         return False
 
@@ -272,8 +1399,30 @@ def is_future_time(hhmm):
 # -------------------------------
 # Telegram 發送（支援按鈕）
 # -------------------------------
+HTTP_POOL_SIZE = 16
+HTTP_TIMEOUT = 10                                              # 群發單次呼叫逾時（秒）
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))   # 群發同時送出的上限（1 = 依序）
+BROADCAST_DEADLINE = float(os.getenv("BROADCAST_DEADLINE", "15"))  # 整次群發最多等幾秒
+JSON_HEADERS = {"Content-Type": "application/json; charset=utf-8"}
+
+# 共用連線池（Keep-Alive），所有 Telegram 呼叫都走這裡
+http = SHARED.get("http")
+if http is None:
+    http = requests.Session()
+    http.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+    http.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+broadcast_pool = SHARED.get("broadcast_pool") or ThreadPoolExecutor(max_workers=max(1, BROADCAST_WORKERS), thread_name_prefix="broadcast")
+
+# 業務群主選單（公告、/list、預約/修改/取消後的看板共用）
+MAIN_MENU_BUTTONS = [
+    [{"text": "預約", "callback_data": "main|reserve"}, {"text": "客到", "callback_data": "main|arrive"}],
+    [{"text": "修改預約", "callback_data": "main|modify"}, {"text": "取消預約", "callback_data": "main|cancel"}],
+]
+MAIN_MENU_MARKUP_JSON = json.dumps({"inline_keyboard": MAIN_MENU_BUTTONS}, ensure_ascii=False)
+
+
 def send_request(method, payload):
-    return requests.post(API_URL + method, json=payload).json()
+    return http.post(API_URL + method, json=payload).json()
 
 
 def send_message(chat_id, text, buttons=None, parse_mode=None):
@@ -286,9 +1435,9 @@ def send_message(chat_id, text, buttons=None, parse_mode=None):
     if buttons:
         payload["reply_markup"] = {"inline_keyboard": buttons}
 
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+    url = API_URL + "sendMessage"
     print(f"DEBUG: send_message payload={payload}")
-    r = requests.post(url, json=payload)
+    r = http.post(url, json=payload)
     print(f"DEBUG: send_message response: {r.text}")
     return r.json()
 
@@ -300,75 +1449,534 @@ def answer_callback(callback_id, text=None, show_alert=False):
     return send_request("answerCallbackQuery", payload)
 
 
+def edit_message_text(chat_id, message_id, text, buttons=None):
+    payload = {"chat_id": chat_id, "message_id": message_id, "text": text}
+    if buttons:
+        payload["reply_markup"] = {"inline_keyboard": buttons}
+    return http.post(API_URL + "editMessageText", json=payload, timeout=HTTP_TIMEOUT).json()
+
+
+def edit_reply_markup(chat_id, message_id, buttons):
+    """只換掉既有訊息的按鈕（翻頁用）"""
+    return send_request("editMessageReplyMarkup", {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "reply_markup": {"inline_keyboard": buttons},
+    })
+
+
+def prepare_message(text, buttons=None, parse_mode=None):
+    """
+    先把 sendMessage 內容（不含 chat_id）序列化成 bytes，群發時每個群組只補上 chat_id。
+    主選單的 reply_markup 用預先序列化好的版本。
+    """
+    payload = {"text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    body = json.dumps(payload, ensure_ascii=False)[1:-1]
+    if buttons:
+        markup = MAIN_MENU_MARKUP_JSON if buttons is MAIN_MENU_BUTTONS else json.dumps({"inline_keyboard": buttons}, ensure_ascii=False)
+        body += ', "reply_markup": ' + markup
+    return body.encode("utf-8")
+
+
+def send_prepared(chat_id, body):
+    data = b'{"chat_id": ' + json.dumps(chat_id).encode("ascii") + b", " + body + b"}"
+    return http.post(API_URL + "sendMessage", data=data, headers=JSON_HEADERS, timeout=HTTP_TIMEOUT).json()
+
+
+def _is_permanent_failure(result):
+    """機器人被踢、被封鎖、群組不存在：之後再送也不會成功"""
+    code = result.get("error_code")
+    desc = (result.get("description") or "").lower()
+    return code == 403 or (code == 400 and ("chat not found" in desc or "group chat was upgraded" in desc))
+
+
+def fan_out(gids, body, deadline=None):
+    """
+    在共用的執行緒池平行送出同一則訊息，最多等 deadline 秒。
+    回傳 {gid: {"ok": bool, "error": 說明, "permanent": 是否為永久失敗}}，逾時的 error 為 "timeout"。
+    """
+    futures = {broadcast_pool.submit(send_prepared, gid, body): gid for gid in gids}
+    done, not_done = wait_futures(futures, timeout=deadline or BROADCAST_DEADLINE)
+    outcomes = {}
+    for fut, gid in futures.items():
+        if fut in not_done:
+            fut.cancel()
+            outcomes[gid] = {"ok": False, "error": "timeout", "permanent": False}
+            continue
+        try:
+            result = fut.result()
+        except Exception as e:
+            outcomes[gid] = {"ok": False, "error": repr(e), "permanent": False}
+            continue
+        if result.get("ok"):
+            outcomes[gid] = {"ok": True, "error": None, "permanent": False}
+        else:
+            outcomes[gid] = {"ok": False, "error": result.get("description") or str(result.get("error_code")),
+                             "permanent": _is_permanent_failure(result)}
+    return outcomes
+
+
 def broadcast_to_groups(message, group_type=None, buttons=None):
+    """群發並回傳各群組結果（見 fan_out）；永久失敗的群組會被記錄，累積過多則移除"""
     gids = get_group_ids_by_type(group_type)
-    for gid in gids:
-        try:
-            send_message(gid, message, buttons=buttons)
-        except Exception:
-            traceback.print_exc()
+    if not gids:
+        return {}
+    body = prepare_message(message, buttons)
+    outcomes = fan_out(gids, body)
+    failed = {gid: o["error"] for gid, o in outcomes.items() if not o["ok"]}
+    print(f"DEBUG: broadcast {group_type or 'all'} → {len(gids)} 個群組（{len(body)} bytes），失敗 {len(failed)}：{failed}")
+    record_group_outcomes(outcomes)
+    return outcomes
 
 
 # -------------------------------
-# 生成最新時段列表（文字）
+# 看板群發（超過 4096 字時分頁，主選單只放在最後一頁）
+# BOARD_EDIT_IN_PLACE=1 時改為編輯各群上次的看板訊息，只重送內容有變的頁
 # -------------------------------
-def generate_latest_shift_list():
-    path = ensure_today_file()
-    data = load_json_file(path)
+BOARD_EDIT_IN_PLACE = os.getenv("BOARD_EDIT_IN_PLACE") == "1"
+board_lock = threading.Lock()
+board_messages = {}  # gid -> [(message_id, 文字)]，上次送出的看板各頁
+
+
+def _page_buttons(i, n):
+    return MAIN_MENU_BUTTONS if i == n - 1 else None
+
+
+def send_board(chat_id):
+    """單一群組送出看板（/list）"""
+    pages = [text for _, text in board_pages()]
+    for i, text in enumerate(pages):
+        send_message(chat_id, text, buttons=_page_buttons(i, len(pages)))
+
+
+def _sync_group_board(gid, pages, previous):
+    """
+    把一個群組的看板更新成 pages：頁數相同時只編輯有變的頁，否則（或編輯失敗）整組重送。
+    回傳 (新的 [(message_id, 文字)] 或 None, 結果)
+    """
+    n = len(pages)
+    if previous and len(previous) == n:
+        current = list(previous)
+        for i, text in enumerate(pages):
+            if current[i][1] == text:
+                continue
+            result = edit_message_text(gid, current[i][0], text, _page_buttons(i, n))
+            if not result.get("ok"):
+                print(f"DEBUG: 看板編輯失敗 {gid} 第 {i + 1} 頁：{result.get('description')}，改為重送")
+                break
+            current[i] = (current[i][0], text)
+        else:
+            return current, {"ok": True, "error": None, "permanent": False}
 
-    msg_lines = []
-    checked_in_lines = []
-    now = datetime.now(TZ)
+    sent = []
+    for i, text in enumerate(pages):
+        result = send_prepared(gid, prepare_message(text, _page_buttons(i, n)))
+        if not result.get("ok"):
+            return None, {"ok": False, "error": result.get("description") or str(result.get("error_code")),
+                          "permanent": _is_permanent_failure(result)}
+        sent.append((result["result"]["message_id"], text))
+    return sent, {"ok": True, "error": None, "permanent": False}
 
-    shifts = sorted(data.get("shifts", []), key=lambda s: s.get("time", "00:00"))
 
-    for s in shifts:
-        time_label = s["time"]
-        limit = s.get("limit", 1)
-        bookings = s.get("bookings", [])
-        in_progress = s.get("in_progress", [])
-
-        shift_dt = datetime.combine(now.date(), datetime.strptime(time_label, "%H:%M").time()).replace(tzinfo=TZ)
-        shift_is_past = shift_dt < now
-
-        regular_in_progress = [x for x in in_progress if not str(x).endswith("(候補)")]
-        backup_in_progress = [x for x in in_progress if str(x).endswith("(候補)")]
-
-        for entry in regular_in_progress + backup_in_progress:
-            if isinstance(entry, dict):
-                name = entry.get("name", "")
-                amount = entry.get("amount", "")
-                checked_in_lines.append(f"{time_label} {name} ✅")
+def broadcast_board(group_type="business"):
+    """群發最新看板，回傳各群組結果（見 fan_out）"""
+    pages = [text for _, text in board_pages()]
+    gids = get_group_ids_by_type(group_type)
+    if not gids:
+        return {}
+    if not BOARD_EDIT_IN_PLACE:
+        outcomes = {}
+        for i, text in enumerate(pages):
+            # 逐頁群發：每個群組的頁序不會亂；前一頁失敗的群組不再送後面的頁，結果以第一個失敗為準
+            targets = [gid for gid in gids if outcomes.get(gid, {"ok": True})["ok"]]
+            if not targets:
+                break
+            outcomes.update(fan_out(targets, prepare_message(text, _page_buttons(i, len(pages)))))
+        failed = {gid: o["error"] for gid, o in outcomes.items() if not o["ok"]}
+        print(f"DEBUG: 看板 {len(pages)} 頁 → {len(gids)} 個群組，失敗 {len(failed)}：{failed}")
+        record_group_outcomes(outcomes)  # 一次看板更新只算一次成敗
+        return outcomes
+
+    with board_lock:  # 同時兩次更新會互相編輯到對方的訊息
+        futures = {broadcast_pool.submit(_sync_group_board, gid, pages, board_messages.get(gid)): gid for gid in gids}
+        done, not_done = wait_futures(futures, timeout=BROADCAST_DEADLINE)
+        outcomes = {}
+        for fut, gid in futures.items():
+            if fut in not_done:
+                fut.cancel()
+                board_messages.pop(gid, None)  # 不確定送到哪，下次整組重送
+                outcomes[gid] = {"ok": False, "error": "timeout", "permanent": False}
+                continue
+            try:
+                messages, outcomes[gid] = fut.result()
+            except Exception as e:
+                messages, outcomes[gid] = None, {"ok": False, "error": repr(e), "permanent": False}
+            if messages is None:
+                board_messages.pop(gid, None)
             else:
-                checked_in_lines.append(f"{time_label} {entry} ✅")
+                board_messages[gid] = messages
+    print(f"DEBUG: 看板 {len(pages)} 頁 → {len(gids)} 個群組，失敗 {sum(not o['ok'] for o in outcomes.values())}")
+    record_group_outcomes(outcomes)
+    return outcomes
+
+
+# -------------------------------
+# webhook 錄製（離線重播用，見 replay.py）
+# WEBHOOK_RECORD_FILE=data/capture.jsonl.gz 開啟
+# WEBHOOK_RECORD_REDACT：none / names / amounts / all（預設 all）
+# 姓名以雜湊假名取代（同名同假名，保留 (2)、(候補) 後綴），金額改成 0，ID 與時間保留
+# -------------------------------
+RECORD_FILE = os.getenv("WEBHOOK_RECORD_FILE")
+if TENANT and RECORD_FILE:  # 多租戶：各店錄到自己的資料目錄，避免多個 gzip 同時寫同一個檔
+    RECORD_FILE = os.path.join(DATA_DIR, os.path.basename(RECORD_FILE))
+RECORD_REDACT = os.getenv("WEBHOOK_RECORD_REDACT", "all")
+RECORD_SALT = os.getenv("WEBHOOK_RECORD_SALT", "")
+
+record_lock = threading.Lock()
+record_fp = None
+
+_HHMM_RE = re.compile(r"^\d{1,2}:\d{2}$")
+_INT_RE = re.compile(r"^-?\d+$")
+_AMOUNT_RE = re.compile(r"^-?[\d,]+(\.\d+)?$")
+_NAME_SUFFIX_RE = re.compile(r"^(.*?)((?:\(\d+\))?(?:\(候補\))?)$")
+_KEEP_WORDS = {"刪除", "all"}
+
+
+def _pseudonym(name):
+    base, suffix = _NAME_SUFFIX_RE.match(name).groups()
+    if not base:
+        return name
+    digest = hashlib.sha1((RECORD_SALT + base).encode("utf-8")).hexdigest()[:6]
+    return f"名{digest}{suffix}"
+
+
+def _redact_token(token, policy):
+    if not token or _HHMM_RE.match(token) or token in _KEEP_WORDS:
+        return token
+    if _AMOUNT_RE.match(token):
+        return "0" if policy in ("amounts", "all") else token
+    return _pseudonym(token) if policy in ("names", "all") else token
+
+
+def _redact_text(text, policy):
+    tokens = text.split(" ")
+    start = 1 if text.startswith("/") else 0
+    return " ".join(tokens[:start] + [_redact_token(t, policy) for t in tokens[start:]])
+
+
+def _redact_callback_data(data, policy):
+    parts = data.split("|")
+    if parts[0] == "main" or policy not in ("names", "all"):
+        return data
+    # 欄位內逐詞取代，與文字訊息的假名一致（"Amy 王" → 兩個假名）
+    return "|".join(parts[:1] + [p if (_HHMM_RE.match(p) or _INT_RE.match(p))
+                                 else " ".join(_pseudonym(t) if t else t for t in p.split(" "))
+                                 for p in parts[1:]])
+
+
+def _redact_user(user, policy):
+    if not user or policy not in ("names", "all"):
+        return user
+    user = dict(user)
+    for k in ("first_name", "last_name", "username"):
+        if user.get(k):
+            user[k] = _pseudonym(user[k])
+    return user
+
+
+def redact_update(update, policy=None):
+    """回傳去識別化後的 update 副本"""
+    policy = policy or RECORD_REDACT
+    if policy == "none":
+        return update
+    update = json.loads(json.dumps(update))
+    msg = update.get("message")
+    if msg:
+        if msg.get("text"):
+            msg["text"] = _redact_text(msg["text"], policy)
+        msg["from"] = _redact_user(msg.get("from"), policy)
+        if (msg.get("chat") or {}).get("title") and policy in ("names", "all"):
+            msg["chat"]["title"] = _pseudonym(msg["chat"]["title"])
+    cq = update.get("callback_query")
+    if cq:
+        if cq.get("data"):
+            cq["data"] = _redact_callback_data(cq["data"], policy)
+        cq["from"] = _redact_user(cq.get("from"), policy)
+        # 按鈕所在的原訊息（機器人自己發的）重播用不到，只留 chat
+        if cq.get("message"):
+            cq["message"] = {k: v for k, v in cq["message"].items() if k in ("message_id", "chat", "date")}
+    return update
+
+
+def record_update(update):
+    """把收到的 update 附上時間戳記，寫入壓縮 JSONL（每筆 flush）"""
+    global record_fp
+    if not RECORD_FILE or not update:
+        return
+    try:
+        cq = update.get("callback_query")
+        if cq and cq.get("data"):
+            # token 換回完整內容，重播時不需要當天的 callback 紀錄檔
+            update = dict(update, callback_query=dict(cq, data=expand_callback(cq["data"])))
+        line = json.dumps({"ts": get_now().timestamp(), "update": redact_update(update)}, ensure_ascii=False)
+        with record_lock:
+            if record_fp is None:
+                record_fp = gzip.open(RECORD_FILE, "at", encoding="utf-8")
+            record_fp.write(line + "\n")
+            record_fp.flush()
+    except Exception as e:
+        print(f"ERROR: 錄製 update 失敗: {e}")
 
-        for b in bookings:
-            name = b.get("name") if isinstance(b, dict) else b
-            msg_lines.append(f"{time_label} {name}")
 
-        used_slots = len(bookings) + len(regular_in_progress)
-        remaining = max(0, limit - used_slots)
+# -------------------------------
+# 線上效能分析（管理員 /profile）
+# 取樣所有執行緒的呼叫堆疊，結束後寫報告到 data/。常駐的背景迴圈（start_background 啟動的 writer / announce /
+# arrivals / scheduler）與收連線的主執行緒（app.run）大多在等待，不取樣；webhook 執行緒就算卡在
+# Event.wait、write_queue.put 或 socket 讀取也照樣計入，那正是要找的等待
+# -------------------------------
+PROFILE_SAMPLE_INTERVAL = 0.005   # 取樣間隔（秒）
+PROFILE_MAX_SECONDS = 300         # 單次分析最長時間，避免忘記停止
+PROFILE_TOP_N = 30                # 報告列出的函式數
+
+profile_lock = threading.Lock()
+profile_session = None  # 進行中的分析，同一時間只允許一個
+
+
+def start_profile(chat_id, seconds=None, updates=None):
+    """開始分析：seconds 秒後結束，或處理完 updates 個 update 後結束"""
+    global profile_session
+    with profile_lock:
+        if profile_session is not None:
+            return False
+        profile_session = {
+            "chat_id": chat_id,
+            "started": time.time(),
+            "deadline": time.time() + min(seconds or PROFILE_MAX_SECONDS, PROFILE_MAX_SECONDS),
+            "updates_target": updates,
+            "updates_seen": 0,
+            "samples": 0,
+            "self_counts": Counter(),
+            "cum_counts": Counter(),
+            "thread_counts": Counter(),
+            "stop": threading.Event(),
+        }
+        session = profile_session
+    threading.Thread(target=_profile_sampler, args=(session,), daemon=True, name="profiler").start()
+    return True
+
+
+def stop_profile():
+    with profile_lock:
+        session = profile_session
+    if session is None:
+        return False
+    session["stop"].set()
+    return True
+
 
-        if not shift_is_past:
-            msg_lines.extend(f"{time_label} " for _ in range(remaining))
+def profile_note_update():
+    """webhook 每處理完一個 update 呼叫一次（依次數結束的分析用）"""
+    session = profile_session
+    if session is None or not session["updates_target"]:
+        return
+    with profile_lock:
+        session["updates_seen"] += 1
+        if session["updates_seen"] >= session["updates_target"]:
+            session["stop"].set()
+
+
+def _profile_frame_key(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+
+
+def _profile_idle_threads():
+    """不取樣的執行緒：常駐背景迴圈與主執行緒（Flask 在這裡 accept 連線）"""
+    idle = {t.ident for t in background_threads.values()}
+    idle.add(threading.main_thread().ident)
+    return idle
+
+
+def _profile_sampler(session):
+    global profile_session
+    skip = _profile_idle_threads()
+    skip.add(threading.get_ident())
+    names = {}
+    while not session["stop"].is_set() and time.time() < session["deadline"]:
+        for t in threading.enumerate():
+            names[t.ident] = t.name
+        for ident, frame in sys._current_frames().items():
+            if ident in skip:
+                continue
+            session["samples"] += 1
+            session["thread_counts"][names.get(ident, str(ident))] += 1
+            session["self_counts"][_profile_frame_key(frame.f_code)] += 1
+            seen = set()
+            f = frame
+            while f is not None:
+                key = _profile_frame_key(f.f_code)
+                if key not in seen:
+                    seen.add(key)
+                    session["cum_counts"][key] += 1
+                f = f.f_back
+        time.sleep(PROFILE_SAMPLE_INTERVAL)
 
-    if not msg_lines and not checked_in_lines:
-        return "📅 今日所有時段已過"
+    try:
+        _finish_profile(session)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        with profile_lock:
+            if profile_session is session:
+                profile_session = None
+
+
+def _finish_profile(session):
+    elapsed = time.time() - session["started"]
+    total = session["samples"] or 1
+    stamp = datetime.now(TZ).strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(DATA_DIR, f"profile-{stamp}.txt")
+
+    lines = [
+        f"profile {stamp}",
+        f"經過 {elapsed:.1f} 秒，處理 update {session['updates_seen']} 個，取樣 {session['samples']} 次（間隔 {PROFILE_SAMPLE_INTERVAL}s）",
+        "",
+        "【執行緒】",
+    ]
+    for name, n in session["thread_counts"].most_common():
+        lines.append(f"{n:>8} {n * 100 / total:6.1f}%  {name}")
+    lines += ["", "【自身時間 self】"]
+    for key, n in session["self_counts"].most_common(PROFILE_TOP_N):
+        lines.append(f"{n:>8} {n * 100 / total:6.1f}%  {key}")
+    lines += ["", "【累計時間 cumulative】"]
+    for key, n in session["cum_counts"].most_common(PROFILE_TOP_N):
+        lines.append(f"{n:>8} {n * 100 / total:6.1f}%  {key}")
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    print(f"DEBUG: 效能分析報告已寫入 {path}")
+
+    summary = [f"📈 效能分析完成（{elapsed:.1f} 秒 / {session['updates_seen']} 個 update / {session['samples']} 次取樣）", "累計時間前 10 名："]
+    for key, n in session["cum_counts"].most_common(10):
+        summary.append(f"{n * 100 / total:5.1f}% {key}")
+    summary.append(f"完整報告：{path}")
+    send_message(session["chat_id"], "\n".join(summary))
+
+
+def _cmd_profile(chat_id, text):
+    parts = text.split()
+    arg = parts[1].lower() if len(parts) > 1 else "30s"
+
+    if arg == "stop":
+        if not stop_profile():
+            send_message(chat_id, "⚠️ 目前沒有進行中的效能分析")
+        return
+
+    try:
+        if arg.endswith("u"):
+            seconds, updates = None, int(arg[:-1])
+        else:
+            seconds, updates = int(arg.rstrip("s")), None
+        if (updates if updates is not None else seconds) <= 0:
+            raise ValueError(arg)
+    except ValueError:
+        send_message(chat_id, "⚠️ 格式：/profile 30s（秒數）或 /profile 100u（update 數）或 /profile stop，數字須大於 0")
+        return
+
+    if not start_profile(chat_id, seconds=seconds, updates=updates):
+        send_message(chat_id, "⚠️ 已有進行中的效能分析，可用 /profile stop 停止")
+        return
+    if updates is not None:
+        target = f"{updates} 個 update，最多 {PROFILE_MAX_SECONDS} 秒"
+    else:
+        target = f"{min(seconds, PROFILE_MAX_SECONDS)} 秒"
+    send_message(chat_id, f"📈 開始效能分析（{target}），結束後會回報結果")
+
+
+# -------------------------------
+# 生成最新時段列表（文字）
+# -------------------------------
+TELEGRAM_TEXT_LIMIT = 4096  # Telegram 單則訊息上限（字元）
+BOARD_OPEN_HEADER = "📅 今日最新時段列表（未到時段）："
+BOARD_CHECKED_HEADER = "【已報到】"
+BOARD_CONTINUED = "（續）"
+
+
+def iter_board_lines(day, now, section):
+    """逐行產生看板內容：section = "open"（未到時段）或 "checked_in"（已報到）"""
+    now_seconds = now.hour * 3600 + now.minute * 60 + now.second + now.microsecond / 1e6
+    for s in sorted(day.shifts, key=lambda s: s.minute):
+        time_label = s.time
+        if section == "checked_in":
+            # 一般報到在前，候補在後
+            for entry in sorted(s.in_progress, key=lambda a: a.waitlist):
+                suffix = WAITLIST_SUFFIX if entry.waitlist else ""
+                yield f"{time_label} {entry.name}{suffix} ✅"
+            continue
+        for b in s.bookings:
+            yield f"{time_label} {b.name}"
+        if not s.minute * 60 < now_seconds:
+            yield from (f"{time_label} " for _ in range(s.remaining))
+
+
+def paginate_lines(header, lines, limit=TELEGRAM_TEXT_LIMIT):
+    """把行依序裝進不超過 limit 字的頁，每頁以 header 開頭（第二頁起加「（續）」）"""
+    page = header
+    for line in lines:
+        room = limit - len(header) - len(BOARD_CONTINUED) - 1
+        if len(line) > room:
+            line = line[:room - 1] + "…"
+        if len(page) + 1 + len(line) > limit:
+            yield page
+            page = header + BOARD_CONTINUED
+        page += "\n" + line
+    yield page
+
+
+def board_pages(day=None, now=None, limit=TELEGRAM_TEXT_LIMIT):
+    """
+    看板分頁，逐頁產生 (區段, 文字)。放得進一則時只有一頁（與 generate_latest_shift_list 相同）；
+    超過上限時未到時段與已報到各自分頁，只有其中一區變動時另一區的頁不變。
+    """
+    day = day or get_day_snapshot()
+    now = now or get_now()
+    open_lines = list(iter_board_lines(day, now, "open"))
+    checked_lines = list(iter_board_lines(day, now, "checked_in"))
+    text = _board_text(open_lines, checked_lines)
+    if len(text) <= limit:
+        yield "all", text
+        return
 
-    text = "📅 今日最新時段列表（未到時段）：\n"
-    text += "\n".join(msg_lines) if msg_lines else "（目前無未到時段）"
-    if checked_in_lines:
-        text += "\n\n【已報到】\n" + "\n".join(checked_in_lines)
+    for page in paginate_lines(BOARD_OPEN_HEADER, open_lines or ["（目前無未到時段）"], limit):
+        yield "open", page
+    if checked_lines:
+        for page in paginate_lines(BOARD_CHECKED_HEADER, checked_lines, limit):
+            yield "checked_in", page
 
+
+def _board_text(open_lines, checked_lines):
+    if not open_lines and not checked_lines:
+        return "📅 今日所有時段已過"
+    text = BOARD_OPEN_HEADER + "\n"
+    text += "\n".join(open_lines) if open_lines else "（目前無未到時段）"
+    if checked_lines:
+        text += "\n\n" + BOARD_CHECKED_HEADER + "\n" + "\n".join(checked_lines)
     return text
 
 
+def generate_latest_shift_list():
+    """完整看板文字（不分頁，可能超過 4096 字；送出請用 board_pages / broadcast_board）"""
+    day = get_day_snapshot()
+    now = get_now()
+    return _board_text(list(iter_board_lines(day, now, "open")), list(iter_board_lines(day, now, "checked_in")))
+
 
 # -------------------------------
 # 工具函數：生成唯一名稱
 # -------------------------------
 def generate_unique_name(bookings, base_name):
-    existing = [b["name"] for b in bookings if isinstance(b, dict)]
+    existing = {b.name for b in bookings}
     if base_name not in existing:
         return base_name
     idx = 2
@@ -376,31 +1984,36 @@ def generate_unique_name(bookings, base_name):
         idx += 1
     return f"{base_name}({idx})"
     
+def notify_promoted(hhmm, promoted):
+    """通知候補遞補成功的業務群（在釋放鎖之後呼叫）"""
+    for entry, name in promoted:
+        if entry.chat_id is not None:
+            send_message(entry.chat_id, f"🎉 候補遞補成功：{name} 已預約 {hhmm}")
+
+
 def merge_shifts(original, new_shifts):
+    by_minute = {s.minute: s for s in original}
     for new_shift in new_shifts:
-        # 先確保 new_shift['time'] 是 datetime.time
-        if isinstance(new_shift.get('time'), str):
-            h, m = map(int, new_shift['time'].split(":"))
-            new_shift['time'] = dt_time(h, m)
-
         # 找出是否已存在同時段
-        shift = next((s for s in original if s['time'] == new_shift['time']), None)
+        shift = by_minute.get(new_shift.minute)
 
         if shift:
             # 合併 bookings（避免重複）
-            for b in new_shift.get('bookings', []):
-                if b not in shift.get('bookings', []):
-                    shift.setdefault('bookings', []).append(b)
+            seen = {(b.name, b.chat_id) for b in shift.bookings}
+            for b in new_shift.bookings:
+                if (b.name, b.chat_id) not in seen:
+                    shift.add_booking(b)
+                    seen.add((b.name, b.chat_id))
 
             # 合併 in_progress（避免重複）
-            for ip in new_shift.get('in_progress', []):
-                if ip not in shift.get('in_progress', []):
-                    shift.setdefault('in_progress', []).append(ip)
+            seen = {(a.name, a.amount, a.waitlist) for a in shift.in_progress}
+            for ip in new_shift.in_progress:
+                if (ip.name, ip.amount, ip.waitlist) not in seen:
+                    shift.add_arrival(ip)
+                    seen.add((ip.name, ip.amount, ip.waitlist))
         else:
-            # 新增 shift 前確保 bookings / in_progress 存在
-            new_shift.setdefault('bookings', [])
-            new_shift.setdefault('in_progress', [])
             original.append(new_shift)
+            by_minute[new_shift.minute] = new_shift
 
     return original
 
@@ -413,24 +2026,283 @@ def chunk_list(lst, n):
     return [lst[i:i + n] for i in range(0, len(lst), n)]
 
 
-def build_shifts_buttons(shifts, row_size=3):
-    btns = [{"text": s["time"], "callback_data": f"reserve|{s['time']}"} for s in shifts]
-    rows = chunk_list(btns, row_size)
-    rows.append([{"text": "取消", "callback_data": "cancel_flow"}])
-    return rows
+def reserve_button_items(shifts):
+    """預約選單的按鈕：未到的時段 + 剩餘名額；額滿的時段按下去是加入候補"""
+    items = []
+    for s in shifts:
+        if not is_future_time(s.minute):
+            continue
+        remaining = s.remaining
+        text = f"{s.time} ({remaining})" if remaining else f"{s.time} {WAITLIST_SUFFIX}"
+        items.append({"text": text, "callback_data": f"reserve_pick|{s.time}"})
+    return items
+
+
+# -------------------------------
+# 分頁按鈕
+# 預約時段（reserve）、客到 / 修改 / 取消的預約清單（arrive / modify / cancel）、
+# 修改到哪個時段（modify_to）。完整清單依 (種類, 群組, 快照版本) 快取，
+# 每一頁在第一次被翻到時才組成並快取；時段清單另外以「分鐘」為 key（過了的時段要消失）。
+# -------------------------------
+KEYBOARD_PAGE_SIZE = 12   # 每頁按鈕數（不含翻頁列與取消）
+KEYBOARD_CACHE_MAX = 512
+KEYBOARD_ROW_SIZE = {"reserve": 3, "arrive": 2, "modify": 1, "cancel": 1, "modify_to": 3}
+BOOKING_PICK_ACTION = {"arrive": "arrive_select", "modify": "modify_pick", "cancel": "cancel_pick"}
+
+keyboard_cache = OrderedDict()  # key -> 完整清單 或 (rows, 頁, 總頁數)
+keyboard_cache_lock = threading.Lock()
+
+
+def _keyboard_cached(key, build):
+    with keyboard_cache_lock:
+        if key in keyboard_cache:
+            keyboard_cache.move_to_end(key)
+            return keyboard_cache[key]
+    value = build()
+    with keyboard_cache_lock:
+        keyboard_cache[key] = value
+        if len(keyboard_cache) > KEYBOARD_CACHE_MAX:
+            keyboard_cache.popitem(last=False)
+    return value
+
+
+def _keyboard_items(kind, chat_id, day, extra):
+    if kind == "reserve":
+        return reserve_button_items(day.shifts)
+    if kind == "modify_to":
+        old_hhmm, old_name = extra
+        return [{"text": s.time, "callback_data": make_callback("modify_to", old_hhmm=old_hhmm, old_name=old_name, new_hhmm=s.time)}
+                for s in day.shifts if is_future_time(s.minute)]
+    action = BOOKING_PICK_ACTION[kind]
+    return [{"text": f"{s.time} {b.name}", "callback_data": make_callback(action, hhmm=s.time, name=b.name)}
+            for s in day.shifts for b in s.bookings if b.chat_id == chat_id]
+
+
+def _page_callback(kind, page, extra):
+    if kind == "modify_to":
+        return make_callback("modify_page", hhmm=extra[0], name=extra[1], page=page)
+    return f"page|{kind}|{page}"
+
+
+def keyboard_page(kind, chat_id, page=0, extra=None):
+    """回傳 (rows, 實際頁碼, 總頁數, 按鈕總數)；rows 是快取物件，不可修改"""
+    version, day = get_versioned_snapshot()
+    now = get_now()
+    # 時段類清單會隨時間變化（過了的時段不顯示）
+    minute = now.hour * 60 + now.minute if kind in ("reserve", "modify_to") else None
+    base_key = (kind, chat_id, version, minute, extra)
+    items = _keyboard_cached(base_key, lambda: _keyboard_items(kind, chat_id, day, extra))
+
+    pages = max(1, -(-len(items) // KEYBOARD_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+
+    def build():
+        start = page * KEYBOARD_PAGE_SIZE
+        rows = chunk_list(items[start:start + KEYBOARD_PAGE_SIZE], KEYBOARD_ROW_SIZE[kind])
+        if pages > 1:
+            nav = []
+            if page > 0:
+                nav.append({"text": "◀ 上一頁", "callback_data": _page_callback(kind, page - 1, extra)})
+            nav.append({"text": f"{page + 1}/{pages}", "callback_data": "noop"})
+            if page < pages - 1:
+                nav.append({"text": "下一頁 ▶", "callback_data": _page_callback(kind, page + 1, extra)})
+            rows.append(nav)
+        rows.append([{"text": "取消", "callback_data": "cancel_flow"}])
+        return rows, page, pages, len(items)
+
+    return _keyboard_cached(base_key + (page,), build)
+
+# -------------------------------
+# 路由表（按鈕 callback、pending 動作、文字指令共用）
+# 以動作名稱查 dict 取得 handler；middleware 依序檢查，回傳非 None 就中止；
+# 每條路由記錄次數、錯誤與耗時（管理員 /routes 查看）
+# -------------------------------
+class UpdateContext:
+    """一個 update 的處理資訊，handler 與 middleware 共用"""
+    __slots__ = ("user_id", "chat_id", "callback_id", "message_id", "action", "args", "text", "pending")
+
+    def __init__(self, user_id, chat_id, callback_id=None, message_id=None, action=None, args=None, text="", pending=None):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.callback_id = callback_id
+        self.message_id = message_id
+        self.action = action
+        self.args = args if args is not None else {}
+        self.text = text
+        self.pending = pending
+
+    def respond(self, msg, buttons=None, answer=True):
+        send_message(self.chat_id, msg, buttons=buttons)
+        if answer:
+            answer_callback(self.callback_id)
+        return {"ok": True}
+
+    def answer(self, text=None):
+        answer_callback(self.callback_id, text)
+        return {"ok": True}
+
+
+class Router:
+    def __init__(self, name, fallback=None):
+        self.name = name
+        self.routes = {}       # key -> {"handler", 選項…}
+        self.middleware = []   # fn(route, ctx)，回傳非 None 即中止
+        self.fallback = fallback
+        self.stats = {}        # key -> {"n", "errors", "total_s", "max_s"}
+        self.lock = threading.Lock()
+
+    def add(self, key, handler, **options):
+        self.routes[key] = dict(options, key=key, handler=handler)
+        self.stats[key] = {"n": 0, "errors": 0, "total_s": 0.0, "max_s": 0.0}
+
+    def route(self, key, **options):
+        def deco(fn):
+            self.add(key, fn, **options)
+            return fn
+        return deco
+
+    def dispatch(self, key, ctx):
+        route = self.routes.get(key)
+        if route is None:
+            return self.fallback(ctx) if self.fallback else None
+        print(f"DEBUG: {self.name} → {key}")
+        for mw in self.middleware:
+            result = mw(route, ctx)
+            if result is not None:
+                return result
+
+        ok = False
+        t0 = time.perf_counter()
+        try:
+            result = route["handler"](ctx)
+            ok = True
+            return result
+        finally:
+            dt = time.perf_counter() - t0
+            with self.lock:
+                st = self.stats[key]
+                st["n"] += 1
+                st["total_s"] += dt
+                st["max_s"] = max(st["max_s"], dt)
+                if not ok:
+                    st["errors"] += 1
+
+
+# -------------------------------
+# 入站限流：依 user_id 與 chat_id 各一個 token bucket，讀（清單 / 選單）與寫（預約、刪除、服務員按鈕）分開計
+# 路由以 write=True 標記寫入（開始寫入流程的按鈕與 pending 文字輸入都算）；
+# 超量的按鈕只回 answerCallbackQuery，訊息指令直接略過，pending 輸入回一句稍後再試（pending 保留，可重新輸入）
+# -------------------------------
+RATE_LIMIT = os.getenv("RATE_LIMIT", "1") != "0"
+RATE_LIMITS = {  # (對象, 種類) -> (容量, 每秒補充)
+    ("user", "read"): (10, 1.0),
+    ("user", "write"): (6, 0.5),
+    ("chat", "read"): (30, 3.0),
+    ("chat", "write"): (30, 2.0),   # 服務員群所有人共用，給寬一點
+}
+RATE_SWEEP_INTERVAL = 60  # 每幾秒清掉已補滿（閒置）的 bucket
+RATE_LIMITED_TEXT = "⏳ 操作太頻繁，請稍後再試"
+
+
+class TokenBuckets:
+    """key -> [剩餘 token, 上次更新時間]；補滿的 bucket 和不存在一樣，定期清掉，表只留最近活躍的對象"""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.rejected = 0
+        self.next_sweep = time.monotonic() + RATE_SWEEP_INTERVAL
+
+    def _level(self, key, now):
+        capacity, rate = self.limits[key[:2]]
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return capacity
+        return min(capacity, bucket[0] + (now - bucket[1]) * rate)
+
+    def allow(self, kind, user_id, chat_id, now=None):
+        """user 與 chat 的 bucket 都有 token 才放行並各扣 1；任一不足則都不扣"""
+        now = time.monotonic() if now is None else now
+        keys = [k for k in (("user", kind, user_id), ("chat", kind, chat_id)) if k[2] is not None]
+        with self.lock:
+            if now >= self.next_sweep:
+                self._sweep(now)
+            levels = [self._level(k, now) for k in keys]
+            if any(level < 1 for level in levels):
+                self.rejected += 1
+                return False
+            for k, level in zip(keys, levels):
+                self.buckets[k] = [level - 1, now]
+            return True
+
+    def _sweep(self, now):
+        for k in [k for k in self.buckets if self._level(k, now) >= self.limits[k[:2]][0]]:
+            del self.buckets[k]
+        self.next_sweep = now + RATE_SWEEP_INTERVAL
+
+
+rate_limiter = TokenBuckets(RATE_LIMITS)
 
 
-def build_bookings_buttons(bookings, chat_id, prefix):
-    btns = [{"text": b.get("name"), "callback_data": f"{prefix}|{b.get('name')}"} for b in bookings]
-    if not btns:
-        btns = [{"text": "（無）", "callback_data": "noop"}]
+def mw_rate_limit(route, ctx):
+    if not RATE_LIMIT:
+        return None
+    kind = "write" if route.get("write") else "read"
+    if rate_limiter.allow(kind, ctx.user_id, ctx.chat_id):
+        return None
+    print(f"DEBUG: 限流 user={ctx.user_id} chat={ctx.chat_id} {kind} {route['key']}")
+    if ctx.callback_id:
+        return ctx.answer(RATE_LIMITED_TEXT)
+    if ctx.pending is not None:
+        send_message(ctx.chat_id, RATE_LIMITED_TEXT)
+    return {"ok": True}
+
+
+def mw_schema(route, ctx):
+    """按鈕欄位不齊（CALLBACK_FIELDS）"""
+    if any(f not in ctx.args for f in CALLBACK_FIELDS.get(route["key"], ())):
+        return ctx.answer("資料錯誤")
+
+
+def mw_admin(route, ctx):
+    if route.get("admin") and ctx.user_id not in ADMIN_IDS:
+        print(f"DEBUG: 非管理員 {ctx.user_id} 使用 {route['key']}")
+        return ctx.answer("⚠️ 僅限管理員") if ctx.callback_id else {"ok": True}
+
+
+def mw_pending_conflict(route, ctx):
+    if route.get("no_pending") and has_pending_for(ctx.user_id):
+        return ctx.answer("⚠️ 你已有進行中的操作，請先完成。")
+
+
+def mw_dedupe(route, ctx):
+    """一次性的服務員群按鈕"""
+    if route.get("dedupe") and staff_button_used(callback_key(ctx.action, ctx.args)):
+        return ctx.answer("⚠️ 此按鈕已被使用過。")
+
+
+callback_router = Router("callback", fallback=lambda ctx: ctx.answer("無效操作。"))
+callback_router.middleware = [mw_rate_limit, mw_schema, mw_admin, mw_pending_conflict, mw_dedupe]
+
+pending_router = Router("pending", fallback=lambda ctx: clear_pending_for(ctx.user_id))
+pending_router.middleware = [mw_rate_limit]
+
+command_router = Router("command", fallback=lambda ctx: print("DEBUG: 未匹配的訊息指令"))
+command_router.middleware = [mw_rate_limit, mw_admin]
 
-    btns_rows = chunk_list(btns, 2)
-    btns_rows.append([{"text": "取消", "callback_data": "cancel_flow"}])
-    return btns_rows
 # -------------------------------
 # 文字訊息處理入口（重構）
 # -------------------------------
+def normalize_command(text):
+    """去掉群組裡點選指令時附帶的 @機器人名稱（/addshift@MyBot 13:00 3 → /addshift 13:00 3），回傳 (指令, 文字)"""
+    command = text.split(None, 1)[0] if text else ""
+    if command.startswith("/") and "@" in command:
+        bare = command.split("@", 1)[0]
+        return bare, bare + text[len(command):]
+    return command, text
+
+
 def handle_text_message(msg):
     text = msg.get("text", "").strip() if msg.get("text") else ""
     chat = msg.get("chat", {})
@@ -453,117 +2325,116 @@ def handle_text_message(msg):
         print("DEBUG: 有 pending，交給 _handle_pending")
         return _handle_pending(user_id, chat_id, text, pending)
 
-    # 2️⃣ 一般指令
-    if text == "/help":
-        print("DEBUG: 執行 /help")
-        return _cmd_help(chat_id)
-    if text == "/list":
-        print("DEBUG: 執行 /list")
-        return _cmd_list(chat_id)
-    # 如果輸入 /id，回傳群組 ID
-    if text == "/id":
-        send_message(chat_id, f"這個群組的 ID 是：{chat_id}")
-        return
-    # 3️⃣ 管理員指令
-    if user_id in ADMIN_IDS:
-        if text.startswith("/addshift"):
-            print("DEBUG: 執行 /addshift")
-            return _add_shift(chat_id, text)
-        elif text.startswith("/updateshift"):
-            print("DEBUG: 執行 /updateshift")
-            return _update_shift(chat_id, text)
-        elif text.startswith("刪除"):
-            print("DEBUG: 執行 刪除")
-            return _delete_shift_entry(chat_id, text)
-
-    print("DEBUG: 未匹配的訊息指令")
+    # 2️⃣ 指令（管理員指令由 mw_admin 擋下）
+    command, text = normalize_command(text)
+    ctx = UpdateContext(user_id, chat_id, text=text)
+    return command_router.dispatch(command, ctx)
+
+
+command_router.add("/help", lambda ctx: _cmd_help(ctx.chat_id))
+command_router.add("/list", lambda ctx: _cmd_list(ctx.chat_id))
+# 如果輸入 /id，回傳群組 ID
+command_router.add("/id", lambda ctx: send_message(ctx.chat_id, f"這個群組的 ID 是：{ctx.chat_id}"))
+command_router.add("/addshift", lambda ctx: _add_shift(ctx.chat_id, ctx.text), admin=True, write=True)
+command_router.add("/updateshift", lambda ctx: _update_shift(ctx.chat_id, ctx.text), admin=True, write=True)
+command_router.add("刪除", lambda ctx: _delete_shift_entry(ctx.chat_id, ctx.text), admin=True, write=True)
+command_router.add("/bulk", lambda ctx: _bulk_admin(ctx.chat_id, ctx.text), admin=True, write=True)
+command_router.add("/profile", lambda ctx: _cmd_profile(ctx.chat_id, ctx.text), admin=True)
+command_router.add("/checkcounts", lambda ctx: _cmd_check_counts(ctx.chat_id), admin=True)
+command_router.add("/routes", lambda ctx: _cmd_routes(ctx.chat_id), admin=True)
+command_router.add("/report", lambda ctx: _cmd_report(ctx.chat_id, ctx.text), admin=True)
+command_router.add("/export", lambda ctx: _cmd_export(ctx.chat_id, ctx.text), admin=True)
 # -------------------------------
 # 管理員刪除功能入口
 # -------------------------------
 def _delete_shift_entry(chat_id, text):
+    if "\n" in text:
+        return _bulk_admin(chat_id, text)
     parts = text.split()
     if len(parts) < 3:
         send_message(chat_id, "❗ 格式錯誤\n請輸入：\n刪除 HH:MM 名稱 / 數量 / all")
         return
 
     hhmm, target = parts[1], " ".join(parts[2:])
-    path = ensure_today_file()
-    data = load_json_file(path)
+    result = {}
 
-    shift = find_shift(data.get("shifts", []), hhmm)
-    if not shift:
-        send_message(chat_id, f"⚠️ 找不到 {hhmm} 的時段")
-        return
+    def callback(data):
+        shift = find_shift(data.shifts, hhmm)
+        if not shift:
+            result["reply"] = (False, f"⚠️ 找不到 {hhmm} 的時段", [])
+            return
+        result["time"] = shift.time
+        result["reply"] = _delete_target(shift, shift.time, target, data)
+
+    safe_modify_today_file(callback)
+    _, msg, promoted = result["reply"]
+    send_message(chat_id, msg)
+    notify_promoted(result.get("time", hhmm), promoted)
 
-    # 根據 target 類型呼叫對應刪除函式
+
+def _delete_target(shift, hhmm, target, data):
+    """根據 target 類型呼叫對應刪除函式；回傳 (是否有變更, 回覆文字, 遞補名單)，須在 safe_modify_today_file 內呼叫"""
     if target.lower() == "all":
-        _delete_all_entries(chat_id, shift, hhmm, data, path)
-    elif target.isdigit():
-        _delete_slots_by_number(chat_id, shift, hhmm, int(target), data, path)
-    else:
-        _delete_entry_by_name(chat_id, shift, hhmm, target, data, path)
+        return _delete_all_entries(shift, hhmm, data)
+    if target.isdigit():
+        return _delete_slots_by_number(shift, hhmm, int(target))
+    return _delete_entry_by_name(shift, hhmm, target, data)
 
 
 # -------------------------------
 # 刪除全部預約（未報到 + 已報到）
 # -------------------------------
-def _delete_all_entries(chat_id, shift, hhmm, data, path):
-    count_b = len(shift.get("bookings", []))
-    count_i = len(shift.get("in_progress", []))
-    shift["bookings"].clear()
-    shift["in_progress"].clear()
-    save_json_file(path, data)
-    send_message(chat_id, f"🧹 已清空 {hhmm} 的所有名單（未報到 {count_b}、已報到 {count_i}）")
+def _delete_all_entries(shift, hhmm, data):
+    count_b = len(shift.bookings)
+    count_i = len(shift.in_progress)
+    shift.clear()
+    promoted = data.promote_waiting(shift)
+    return True, f"🧹 已清空 {hhmm} 的所有名單（未報到 {count_b}、已報到 {count_i}）", promoted
 
 
 # -------------------------------
 # 刪除指定名額數量
 # -------------------------------
-def _delete_slots_by_number(chat_id, shift, hhmm, remove_count, data, path):
-    old_limit = shift.get("limit", 1)
-    shift["limit"] = max(0, old_limit - remove_count)
-    save_json_file(path, data)
-    send_message(chat_id, f"🗑 已刪除 {hhmm} 的 {remove_count} 個名額（原本 {old_limit} → 現在 {shift['limit']}）")
+def _delete_slots_by_number(shift, hhmm, remove_count):
+    old_limit = shift.limit
+    shift.limit = max(0, old_limit - remove_count)
+    return True, f"🗑 已刪除 {hhmm} 的 {remove_count} 個名額（原本 {old_limit} → 現在 {shift.limit}）", []
 
 
 # -------------------------------
 # 刪除指定姓名或候補
 # -------------------------------
-def _delete_entry_by_name(chat_id, shift, hhmm, name, data, path):
+def _delete_entry_by_name(shift, hhmm, name, data):
     removed_from = None
 
     # 嘗試從 bookings 移除
-    for b in list(shift.get("bookings", [])):
-        if b.get("name") == name:
-            shift["bookings"].remove(b)
-            removed_from = "bookings"
-            break
+    booking = shift.find_booking(name)
+    if booking:
+        shift.remove_bookings(lambda b: b is booking)
+        removed_from = "bookings"
 
-    # 嘗試從 in_progress 移除
+    # 嘗試從 in_progress 移除（候補可用「名字(候補)」指定）
     if not removed_from:
-        for i in list(shift.get("in_progress", [])):
-            if (isinstance(i, dict) and i.get("name") == name) or (isinstance(i, str) and i == name):
-                shift["in_progress"].remove(i)
-                removed_from = "in_progress"
-                break
+        arrival = shift.find_arrival(name)
+        if arrival:
+            shift.remove_arrival(arrival)
+            removed_from = "in_progress"
 
     # 嘗試從候補移除
+    if not removed_from and data.remove_waiting(shift.minute, name):
+        removed_from = "候補"
+
     if not removed_from:
-        before_len = len(data.get("候補", []))
-        data["候補"] = [c for c in data.get("候補", []) if not (c.get("time") == hhmm and c.get("name") == name)]
-        if len(data["候補"]) < before_len:
-            removed_from = "候補"
-
-    if removed_from:
-        save_json_file(path, data)
-        type_label = {"bookings": "未報到", "in_progress": "已報到", "候補": "候補"}.get(removed_from, "")
-        send_message(chat_id, f"✅ 已從 {hhmm} 移除 {name}（{type_label}）")
-    else:
-        send_message(chat_id, f"⚠️ {hhmm} 找不到 {name}")
+        return False, f"⚠️ {hhmm} 找不到 {name}", []
+    promoted = data.promote_waiting(shift)
+    type_label = {"bookings": "未報到", "in_progress": "已報到", "候補": "候補"}.get(removed_from, "")
+    return True, f"✅ 已從 {hhmm} 移除 {name}（{type_label}）", promoted
 # -------------------------------
 # 新增時段指令 /addshift
 # -------------------------------
 def _add_shift(chat_id, text):
+    if "\n" in text:
+        return _bulk_admin(chat_id, text)
     parts = text.split()
     if len(parts) < 3:
         send_message(chat_id, "⚠️ 格式：/addshift HH:MM 限制")
@@ -575,12 +2446,18 @@ def _add_shift(chat_id, text):
     except ValueError:
         send_message(chat_id, "⚠️ 限制人數必須為數字")
         return
+    try:
+        minute = parse_hhmm(hhmm)
+    except ValueError:
+        send_message(chat_id, "⚠️ 時間格式必須為 HH:MM")
+        return
+    hhmm = format_hhmm(minute)
 
     def callback(data):
-        if find_shift(data.get("shifts", []), hhmm):
+        if find_shift(data.shifts, minute):
             send_message(chat_id, f"⚠️ {hhmm} 已存在")
             return
-        data["shifts"].append({"time": hhmm, "limit": limit, "bookings": [], "in_progress": []})
+        data.shifts.append(Shift(minute, limit))
         send_message(chat_id, f"✅ 新增 {hhmm} 時段，限制 {limit} 人")
 
     safe_modify_today_file(callback)
@@ -590,6 +2467,8 @@ def _add_shift(chat_id, text):
 # 更新時段限制指令 /updateshift
 # -------------------------------
 def _update_shift(chat_id, text):
+    if "\n" in text:
+        return _bulk_admin(chat_id, text)
     parts = text.split()
     if len(parts) < 3:
         send_message(chat_id, "⚠️ 格式：/updateshift HH:MM 限制")
@@ -602,17 +2481,406 @@ def _update_shift(chat_id, text):
         send_message(chat_id, "⚠️ 限制人數必須為數字")
         return
 
-    path = ensure_today_file()
-    data = load_json_file(path)
+    result = {}
+
+    def callback(data):
+        shift = find_shift(data.shifts, hhmm)
+        if not shift:
+            return
+        shift.limit = limit
+        result["time"] = shift.time
+        result["promoted"] = data.promote_waiting(shift)
 
-    shift = find_shift(data.get("shifts", []), hhmm)
-    if not shift:
+    safe_modify_today_file(callback)
+    if "time" not in result:
         send_message(chat_id, f"⚠️ {hhmm} 不存在")
         return
-
-    shift["limit"] = limit
-    save_json_file(path, data)
     send_message(chat_id, f"✅ {hhmm} 時段限制已更新為 {limit}")
+    notify_promoted(result["time"], result["promoted"])
+
+
+# -------------------------------
+# 批次管理指令（/bulk，或多行的 /addshift、/updateshift、刪除）
+# 每行一項，時間可寫成區間（整點逐小時新增；限制 / 刪除套用到區間內已存在的時段）：
+#   13:00-18:00 add 4        /addshift 19:00 3
+#   13:00-18:00 limit 4      /updateshift 20:00 5
+#   14:00 刪除 all           刪除 15:00 小明
+# 整批先解析，再於同一次 safe_modify_today_file 內依序套用；任何一行失敗則整批不寫入，
+# 成功則只寫一次檔、回一則摘要、更新一次看板
+# -------------------------------
+BULK_OPS = {
+    "/addshift": "add", "add": "add", "新增": "add",
+    "/updateshift": "limit", "limit": "limit", "限制": "limit",
+    "刪除": "delete", "delete": "delete",
+}
+
+
+class BatchError(Exception):
+    """批次中有無法套用的行；丟出時 safe_modify_today_file 不會寫入"""
+
+
+def parse_time_range(text):
+    """'HH:MM' 或 'HH:MM-HH:MM' → (起, 訖) 分鐘數，格式錯誤丟 ValueError"""
+    start, _, end = text.partition("-")
+    start = parse_hhmm(start)
+    end = parse_hhmm(end) if end else start
+    if end < start:
+        raise ValueError(f"invalid range {text!r}")
+    return start, end
+
+
+def parse_bulk_line(line):
+    """一行 → (動作, (起, 訖), 參數)；動作可寫在時間前或後，格式錯誤丟 ValueError（訊息給管理員看）"""
+    parts = line.split()
+    if len(parts) < 3:
+        raise ValueError("格式：HH:MM[-HH:MM] add|limit 人數 / 刪除 all|數量|名稱")
+    if parts[0] in BULK_OPS:
+        op, times, rest = BULK_OPS[parts[0]], parts[1], parts[2:]
+    elif parts[1] in BULK_OPS:
+        op, times, rest = BULK_OPS[parts[1]], parts[0], parts[2:]
+    else:
+        raise ValueError(f"不認得的動作，可用：{' / '.join(sorted(set(BULK_OPS.values())))}")
+    try:
+        span = parse_time_range(times)
+    except ValueError:
+        raise ValueError(f"時間格式必須為 HH:MM 或 HH:MM-HH:MM：{times}")
+    if op == "delete":
+        return op, span, " ".join(rest)
+    try:
+        return op, span, int(rest[0])
+    except ValueError:
+        raise ValueError(f"限制人數必須為數字：{rest[0]}")
+
+
+def parse_bulk(text):
+    """回傳 ([(行號, 動作, (起, 訖), 參數)], [錯誤])；第一行開頭的 /bulk 會略過"""
+    ops, errors = [], []
+    lines = text.splitlines()
+    if lines and lines[0].split()[:1] == ["/bulk"]:
+        lines[0] = lines[0].split(None, 1)[1] if len(lines[0].split()) > 1 else ""
+    for no, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            ops.append((no,) + parse_bulk_line(line))
+        except ValueError as e:
+            errors.append(f"第 {no} 行「{line.strip()}」：{e}")
+    return ops, errors
+
+
+def apply_bulk(data, ops):
+    """依序套用到 data（safe_modify_today_file 的副本）；回傳 (摘要行, {hhmm: 遞補名單})，有錯丟 BatchError(錯誤列表)"""
+    summary, promoted, errors = [], {}, []
+    for no, op, (start, end), arg in ops:
+        label = format_hhmm(start) if start == end else f"{format_hhmm(start)}-{format_hhmm(end)}"
+        if op == "add":
+            existing = {s.minute for s in data.shifts}
+            minutes = range(start, end + 1, 60)
+            clash = [format_hhmm(m) for m in minutes if m in existing]
+            if clash:
+                errors.append(f"第 {no} 行：{'、'.join(clash)} 已存在")
+                continue
+            data.shifts.extend(Shift(m, arg) for m in minutes)
+            summary.append(f"➕ 新增 {label}（{len(minutes)} 個時段），限制 {arg} 人")
+            continue
+
+        shifts = [s for s in data.shifts if start <= s.minute <= end]
+        if not shifts:
+            errors.append(f"第 {no} 行：找不到 {label} 的時段")
+            continue
+        if op == "limit":
+            for s in shifts:
+                s.limit = arg
+                promoted.setdefault(s.time, []).extend(data.promote_waiting(s))
+            summary.append(f"✏️ {label} 時段限制更新為 {arg}（{len(shifts)} 個時段）")
+            continue
+
+        changed = False
+        for s in shifts:
+            ok, msg, moved = _delete_target(s, s.time, arg, data)
+            if ok:
+                changed = True
+                summary.append(msg)
+                promoted.setdefault(s.time, []).extend(moved)
+        if not changed:
+            errors.append(f"第 {no} 行：{label} 找不到 {arg}")
+    if errors:
+        raise BatchError(errors)
+    return summary, promoted
+
+
+def _bulk_admin(chat_id, text):
+    ops, errors = parse_bulk(text)
+    if not ops and not errors:
+        send_message(chat_id, "⚠️ 格式：/bulk 後每行一項，例如\n13:00-18:00 limit 4\n19:00 add 3\n14:00 刪除 all")
+        return
+    if errors:
+        send_message(chat_id, f"❌ 批次未執行（{len(errors)} 行格式錯誤，全部未套用）：\n" + "\n".join(errors))
+        return
+
+    result = {}
+
+    def callback(data):
+        result["summary"], result["promoted"] = apply_bulk(data, ops)
+
+    try:
+        safe_modify_today_file(callback)
+    except BatchError as e:
+        send_message(chat_id, f"❌ 批次未執行（{len(e.args[0])} 項無法套用，全部未套用）：\n" + "\n".join(e.args[0]))
+        return
+    print(f"DEBUG: 批次套用 {len(ops)} 行")
+    send_message(chat_id, f"✅ 批次完成（{len(ops)} 行）：\n" + "\n".join(result["summary"]))
+    for hhmm, promoted in result["promoted"].items():
+        notify_promoted(hhmm, promoted)
+    broadcast_board()
+# -------------------------------
+# 名額計數一致性檢查 /checkcounts
+# -------------------------------
+def _cmd_check_counts(chat_id):
+    result = {}
+
+    def callback(data):
+        result["drift"] = check_capacity_counters(data, repair=True)
+
+    safe_modify_today_file(callback)
+    drift = result.get("drift") or []
+    if not drift:
+        send_message(chat_id, "✅ 各時段名額計數正確")
+        return
+    lines = [f"{t}：計數 {counted} → 實際 {actual}" for t, counted, actual in drift]
+    send_message(chat_id, "⚠️ 名額計數有偏差，已修正：\n" + "\n".join(lines))
+
+
+# -------------------------------
+# 路由統計 /routes
+# -------------------------------
+def _cmd_routes(chat_id):
+    lines = ["📊 路由統計（次數 / 平均 / 最長 / 錯誤）"]
+    for router in (callback_router, pending_router, command_router):
+        with router.lock:
+            rows = [(k, dict(st)) for k, st in router.stats.items() if st["n"]]
+        if not rows:
+            continue
+        lines.append(f"\n【{router.name}】")
+        for key, st in sorted(rows, key=lambda r: -r[1]["n"]):
+            avg_ms = st["total_s"] / st["n"] * 1000
+            lines.append(f"{key}：{st['n']} / {avg_ms:.1f}ms / {st['max_s'] * 1000:.1f}ms / {st['errors']}")
+    send_message(chat_id, "\n".join(lines))
+
+
+# -------------------------------
+# 營收報表 /report [day|week|month] [YYYY-MM-DD]
+# -------------------------------
+REPORT_PERIOD_NAMES = {"day": "日", "week": "週", "month": "月"}
+REPORT_KIND_NAMES = {"arrive": "客到", "client_info": "客資", "complete": "完成服務", "not_consumed": "未消", "double": "雙人服務"}
+
+
+def _format_stats(stats, kinds=LEDGER_KINDS):
+    parts = []
+    for kind in kinds:
+        if kind not in stats:
+            continue
+        count, total = stats[kind]
+        parts.append(f"{REPORT_KIND_NAMES[kind]} {count}" + (f"（{total:g}）" if kind in ("arrive", "client_info", "complete") else ""))
+    return "，".join(parts) or "無"
+
+
+def _cmd_report(chat_id, text):
+    parts = text.split()
+    period = parts[1] if len(parts) > 1 else "day"
+    if period not in REPORT_PERIOD_NAMES:
+        send_message(chat_id, "格式錯誤，請輸入：/report [day|week|month] [YYYY-MM-DD]")
+        return
+    day = None
+    if len(parts) > 2:
+        try:
+            day = datetime.strptime(parts[2], "%Y-%m-%d").date()
+        except ValueError:
+            send_message(chat_id, "日期格式錯誤，請輸入 YYYY-MM-DD")
+            return
+
+    key, bucket = ledger_report(period, day)
+    title = f"📊 {REPORT_PERIOD_NAMES[period]}報表 {key.split(':', 1)[1]}"
+    if not bucket:
+        send_message(chat_id, f"{title}\n（沒有紀錄）")
+        return
+    lines = [title, _format_stats(bucket["total"]), "", "【業務群】"]
+    for gid, stats in sorted(bucket["groups"].items(), key=lambda g: -g[1].get("complete", (0, 0))[1]):
+        lines.append(f"{gid}：{_format_stats(stats)}")
+    if bucket["staff"]:
+        lines += ["", "【服務員】"]
+        for name, stats in sorted(bucket["staff"].items(), key=lambda s: -s[1].get("complete", (0, 0))[1]):
+            lines.append(f"{name}：{_format_stats(stats, ('client_info', 'complete', 'double'))}")
+    send_message(chat_id, "\n".join(lines))
+
+
+# -------------------------------
+# CSV 匯出 /export（以及 HTTP GET /export.csv）
+# 逐日讀每日檔或歸檔、逐行讀帳本，一路用 generator 產生 CSV，記憶體用量與期間長短無關
+# -------------------------------
+EXPORT_TOKEN = TENANT.get("export_token") or os.getenv("EXPORT_TOKEN")   # HTTP 匯出需帶 Authorization: Bearer；未設定則不開放
+EXPORT_MAX_DAYS = 366
+EXPORT_CHUNK_ROWS = 500                    # 每累積幾行送出一段
+EXPORT_COLUMNS = ["date", "time", "kind", "name", "business_chat_id", "staff", "amount", "note"]
+
+
+def parse_export_filters(args):
+    """
+    把 ["2026-10-01", "2026-10-19", "group=-100123", "staff=Alice", "time=13:00-18:00"] 解析成篩選條件，
+    格式錯誤丟 ValueError（訊息可直接回給使用者）
+    """
+    dates, filters = [], {"group": None, "staff": None, "time_range": None}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep:
+            dates.append(datetime.strptime(arg, "%Y-%m-%d").date())
+        elif key == "group":
+            filters["group"] = int(value)
+        elif key == "staff":
+            filters["staff"] = value
+        elif key == "time":
+            try:
+                filters["time_range"] = parse_time_range(value)
+            except ValueError:
+                raise ValueError(f"時間範圍格式錯誤：{value}（HH:MM-HH:MM，起不可晚於訖）")
+        else:
+            raise ValueError(f"不認得的條件 {key}")
+    if not dates or len(dates) > 2:
+        raise ValueError("請輸入日期 YYYY-MM-DD（或起訖兩個日期）")
+    start, end = dates[0], dates[-1]
+    if end < start or (end - start).days >= EXPORT_MAX_DAYS:
+        raise ValueError(f"日期範圍錯誤（最多 {EXPORT_MAX_DAYS} 天）")
+    return start, end, filters
+
+
+def iter_day_raws(start, end):
+    """start ~ end 每一天的原始 dict：優先讀 data/ 的每日檔，否則讀歸檔"""
+    indexes = {}
+    day = start
+    while day <= end:
+        key = day.isoformat()
+        path = data_path_for(key)
+        if os.path.exists(path):
+            yield load_json_file(path)
+        else:
+            month = key[:7]
+            if month not in indexes:
+                indexes = {month: load_archive_index(month)}  # 只留目前月份的索引
+            if key in indexes[month]["days"]:
+                yield load_archived_day(key)
+        day += timedelta(days=1)
+
+
+def iter_ledger(start, end):
+    """帳本中 start ~ end 的每一筆"""
+    if not os.path.exists(LEDGER_FILE):
+        return
+    first, last = start.isoformat(), end.isoformat()
+    with open(LEDGER_FILE, "rb") as f:
+        for raw in f:
+            try:
+                entry = json.loads(raw)
+            except ValueError:
+                continue
+            if first <= entry.get("date", "") <= last:
+                yield entry
+
+
+def iter_export_rows(start, end, group=None, staff=None, time_range=None):
+    """
+    每日檔的預約（booking），加上帳本的報到（arrival）、客資、完成服務、未消、雙人服務。
+    報到要從帳本讀：服務員按「上」之後就從每日檔的 in_progress 移除了。
+    預約與報到沒有服務員，指定 staff 時不會出現
+    """
+    def wanted(hhmm, chat_id, staff_names):
+        if time_range:
+            minute = parse_hhmm(hhmm)
+            if not time_range[0] <= minute <= time_range[1]:
+                return False
+        if group is not None and chat_id != group:
+            return False
+        return staff is None or staff in staff_names
+
+    for raw in iter_day_raws(start, end):
+        day = Day.from_raw(raw)
+        for s in sorted(day.shifts, key=lambda s: s.minute):
+            for b in s.bookings:
+                if wanted(s.time, b.chat_id, ()):
+                    yield [day.date, s.time, "booking", b.name, b.chat_id, "", "", ""]
+
+    for entry in iter_ledger(start, end):
+        if wanted(entry.get("hhmm") or "00:00", entry.get("business_chat_id"), entry.get("staff") or ()):
+            kind = "arrival" if entry["kind"] == "arrive" else entry["kind"]
+            yield [entry["date"], entry.get("hhmm"), kind, entry.get("name"), entry.get("business_chat_id"),
+                   "、".join(entry.get("staff") or []), entry.get("amount") if entry.get("amount") is not None else "",
+                   _export_note(entry)]
+
+
+def _export_note(entry):
+    """note 欄：未消的原因；客資為「客人 年齡」（修正過的加註）"""
+    if entry["kind"] == "client_info":
+        return f"{entry.get('client', '')} {entry.get('age', '')}" + ("（修正）" if entry.get("fix") else "")
+    return entry.get("reason", "")
+
+
+def iter_csv(rows, chunk_rows=EXPORT_CHUNK_ROWS):
+    """把 rows 轉成 UTF-8 CSV（含 BOM，Excel 開中文不會亂碼），每 chunk_rows 行產生一段 bytes"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    buf.write("\ufeff")
+    writer.writerow(EXPORT_COLUMNS)
+    n = 0
+    for row in rows:
+        writer.writerow(row)
+        n += 1
+        if n % chunk_rows == 0:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue().encode("utf-8")
+
+
+def send_document_stream(chat_id, filename, chunks, caption=None):
+    """sendDocument：multipart 內容邊產生邊上傳（chunked transfer），不先組成完整檔案"""
+    boundary = "----tgexport" + os.urandom(8).hex()
+
+    def body():
+        fields = {"chat_id": str(chat_id)}
+        if caption:
+            fields["caption"] = caption
+        for name, value in fields.items():
+            yield (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n{value}\r\n").encode("utf-8")
+        yield (f"--{boundary}\r\nContent-Disposition: form-data; name=\"document\"; filename=\"{filename}\"\r\n"
+               "Content-Type: text/csv\r\n\r\n").encode("utf-8")
+        yield from chunks
+        yield f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+    return http.post(API_URL + "sendDocument", data=body(), headers=headers, timeout=120).json()
+
+
+def _cmd_export(chat_id, text):
+    try:
+        start, end, filters = parse_export_filters(text.split()[1:])
+    except ValueError as e:
+        send_message(chat_id, f"⚠️ {e}\n格式：/export 起日 [訖日] [group=群組ID] [staff=服務員] [time=13:00-18:00]")
+        return
+
+    def run():
+        filename = f"export-{start.isoformat()}_{end.isoformat()}.csv"
+        try:
+            result = send_document_stream(chat_id, filename, iter_csv(iter_export_rows(start, end, **filters)),
+                                          caption=f"📤 {start.isoformat()} ~ {end.isoformat()}")
+            if not result.get("ok"):
+                send_message(chat_id, f"❌ 匯出上傳失敗：{result.get('description')}")
+        except Exception as e:
+            traceback.print_exc()
+            send_message(chat_id, f"❌ 匯出失敗：{e}")
+
+    # 上傳可能很久，不佔住 webhook
+    threading.Thread(target=run, daemon=True, name="export").start()
+
+
 def _cmd_help(chat_id):
     help_text = """
 📌 *Telegram 預約機器人指令說明* 📌
@@ -627,6 +2895,12 @@ def _cmd_help(chat_id):
 - 刪除 13:00 小明
 - /addshift HH:MM 限制
 - /updateshift HH:MM 限制
+- /bulk 後每行一項（整批成功才寫入）：13:00-18:00 limit 4 / 19:00 add 3 / 14:00 刪除 all
+- /profile 30s（分析接下來 30 秒）/ /profile 100u（分析接下來 100 個 update）/ /profile stop
+- /checkcounts 檢查並修正各時段名額計數
+- /routes 各按鈕 / 指令的次數與耗時
+- /report day|week|month [YYYY-MM-DD] 客到、完成服務、未消、雙人服務統計
+- /export 起日 [訖日] [group=群組ID] [staff=服務員] [time=13:00-18:00] 匯出 CSV
 - /STAFF 設定本群為服務員群組
 """
     send_message(chat_id, help_text)
@@ -634,49 +2908,24 @@ def _cmd_help(chat_id):
 def _cmd_list(chat_id):
     print("DEBUG: _cmd_list 被呼叫")
 
-    shift_text = generate_latest_shift_list()
-    print(f"DEBUG: shift_text=\n{shift_text}")
-
-    buttons = [
-        [{"text": "預約", "callback_data": "main|reserve"},
-         {"text": "客到", "callback_data": "main|arrive"}],
-        [{"text": "修改預約", "callback_data": "main|modify"},
-         {"text": "取消預約", "callback_data": "main|cancel"}],
-    ]
-
-    send_message(chat_id, shift_text, buttons=buttons, parse_mode=None)
+    send_board(chat_id)
     print("DEBUG: _cmd_list 發送訊息完成")
 
 # -------------------------------
 # Pending 分流
 # -------------------------------
 def _handle_pending(user_id, chat_id, text, pending):
-    action = pending.get("action")
-
-    if action == "reserve_wait_name":
-        return _pending_reserve_wait_name(user_id, text, pending)
-
-    elif action == "arrive_wait_amount":
-        return _pending_arrive_wait_amount(user_id, text, pending)
-
-    elif action == "input_client":
-        return _pending_input_client(user_id, text, pending)
-
-    elif action == "double_wait_second":
-        return _pending_double_wait_second(user_id, text, pending)
-
-    elif action == "complete_wait_amount":
-        return _pending_complete_wait_amount(user_id, text, pending)
+    ctx = UpdateContext(user_id, chat_id, text=text, pending=pending)
+    return pending_router.dispatch(pending.get("action"), ctx)
 
-    elif action == "not_consumed_wait_reason":
-        return _pending_not_consumed_wait_reason(user_id, text, pending)
 
-    elif action == "modify_wait_name":
-        return _pending_modify_wait_name(user_id, text, pending)
-
-    else:
-        clear_pending_for(user_id)
-        return
+pending_router.add("reserve_wait_name", lambda ctx: _pending_reserve_wait_name(ctx.user_id, ctx.text, ctx.pending), write=True)
+pending_router.add("arrive_wait_amount", lambda ctx: _pending_arrive_wait_amount(ctx.user_id, ctx.text, ctx.pending), write=True)
+pending_router.add("input_client", lambda ctx: _pending_input_client(ctx.user_id, ctx.text, ctx.pending), write=True)
+pending_router.add("double_wait_second", lambda ctx: _pending_double_wait_second(ctx.user_id, ctx.text, ctx.pending), write=True)
+pending_router.add("complete_wait_amount", lambda ctx: _pending_complete_wait_amount(ctx.user_id, ctx.text, ctx.pending), write=True)
+pending_router.add("not_consumed_wait_reason", lambda ctx: _pending_not_consumed_wait_reason(ctx.user_id, ctx.text, ctx.pending), write=True)
+pending_router.add("modify_wait_name", lambda ctx: _pending_modify_wait_name(ctx.user_id, ctx.text, ctx.pending), write=True)
 # -------------------------------
 # Pending 動作
 # -------------------------------
@@ -688,28 +2937,23 @@ def _pending_reserve_wait_name(user_id, text, pending):
     name_input = text.strip()
 
     def callback(data):
-        shift = find_shift(data.get("shifts", []), hhmm)
+        shift = find_shift(data.shifts, hhmm)
         if not shift:
             send_message(group_chat, f"⚠️ 時段 {hhmm} 不存在或已過期。")
             return
 
-        used = len(shift.get("bookings", [])) + len([x for x in shift.get("in_progress", []) if not str(x).endswith("(候補)")])
-        limit = shift.get("limit", 1)
-        if used >= limit:
-            send_message(group_chat, f"⚠️ {hhmm} 已滿額，無法預約。")
+        if shift.used >= shift.limit:
+            position = data.add_waiting(WaitEntry(shift.minute, name_input, group_chat, time.time()))
+            send_message(group_chat, f"⏳ {hhmm} 已滿額，{name_input} 已加入候補（第 {position} 位），有名額會自動遞補。")
             return
 
-        unique_name = generate_unique_name(shift.get("bookings", []), name_input)
-        shift.setdefault("bookings", []).append({"name": unique_name, "chat_id": group_chat})
+        unique_name = generate_unique_name(shift.bookings, name_input)
+        shift.add_booking(Booking(unique_name, group_chat))
         send_message(group_chat, f"✅ {unique_name} 已預約 {hhmm}")
 
     safe_modify_today_file(callback)
 
-    buttons = [
-        [{"text": "預約", "callback_data": "main|reserve"}, {"text": "客到", "callback_data": "main|arrive"}],
-        [{"text": "修改預約", "callback_data": "main|modify"}, {"text": "取消預約", "callback_data": "main|cancel"}],
-    ]
-    broadcast_to_groups(generate_latest_shift_list(), group_type="business", buttons=buttons)
+    broadcast_board()
     clear_pending_for(user_id)
 
 
@@ -726,32 +2970,38 @@ def _pending_arrive_wait_amount(user_id, text, pending):
         send_message(group_chat, "⚠️ 金額格式錯誤，請輸入數字")
         return
 
+    arrived = []
+
     def callback(data):
-        shift = find_shift(data.get("shifts", []), hhmm)
+        shift = find_shift(data.shifts, hhmm)
         if not shift:
             send_message(group_chat, f"⚠️ 找不到時段 {hhmm}")
             return
 
-        booking = next((b for b in shift.get("bookings", []) if b.get("name") == name and b.get("chat_id") == group_chat), None)
+        booking = shift.find_booking(name, group_chat)
         if booking:
-            shift.setdefault("in_progress", []).append({"name": name, "amount": amount})
-            shift["bookings"] = [b for b in shift.get("bookings", []) if not (b.get("name") == name and b.get("chat_id") == group_chat)]
-            send_message(group_chat, f"✅ {hhmm} {name} 已客到，金額：{amount}")
-
-            staff_message = f"🙋‍♀️ 客到通知\n時間：{hhmm}\n業務名：{name}\n金額：{amount}"
-            staff_buttons = [[{"text": "上", "callback_data": f"staff_up|{hhmm}|{name}|{group_chat}"}]]
-            broadcast_to_groups(staff_message, group_type="staff", buttons=staff_buttons)
+            shift.remove_bookings(lambda b: b.name == name and b.chat_id == group_chat)
+            shift.add_arrival(Arrival(name, amount))
+            arrived.append(True)
         else:
             send_message(group_chat, f"⚠️ 找不到預約 {name} 或已被移除")
 
     safe_modify_today_file(callback)
+
+    # 通知在釋放 file_modify_lock 之後才送，慢的群組不會卡住其他寫入
+    if arrived:
+        record_service("arrive", hhmm, name, group_chat, amount=amount)
+        send_message(group_chat, f"✅ {hhmm} {name} 已客到，金額：{amount}")
+        staff_message = f"🙋‍♀️ 客到通知\n時間：{hhmm}\n業務名：{name}\n金額：{amount}"
+        staff_buttons = [[{"text": "上", "callback_data": make_callback("staff_up", hhmm=hhmm, name=name, business_chat_id=group_chat)}]]
+        broadcast_to_groups(staff_message, group_type="staff", buttons=staff_buttons)
     clear_pending_for(user_id)
 
 # 輸入客資    
 def _pending_input_client(user_id, text, pending):
     chat_id = pending.get("chat_id")
     business_chat_id = pending.get("business_chat_id")
-    action_source = pending.get("action")  # 新增這行
+    action_source = pending.get("source") or pending.get("action")  # 修正客資時為 "fix"
 
     # 防呆檢查
     if chat_id is None or business_chat_id is None:
@@ -781,16 +3031,21 @@ def _pending_input_client(user_id, text, pending):
     else:
         prefix = "📌 客資"
 
+    try:
+        quoted = float(amount)
+    except ValueError:
+        quoted = None  # 報價不是數字時照樣通知，只是不計入統計金額
+    record_service("client_info", hhmm, business_name, business_chat_id, amount=quoted, staff=[staff_name],
+                   client=client_name, age=age, fix=action_source == "fix")
+
     msg_business = f"{prefix}\n時間: {hhmm} {client_name}{age} {business_name}{amount}\n服務人員: {staff_name}"
     send_message(business_chat_id, msg_business, parse_mode="HTML")
 
-    staff_buttons = [
-        [
-            {"text": "雙", "callback_data": f"double|{hhmm}|{business_name}|{business_chat_id}|{staff_name}"},
-            {"text": "完成服務", "callback_data": f"complete|{hhmm}|{business_name}|{business_chat_id}|{staff_name}"},
-            {"text": "修正", "callback_data": f"fix|{hhmm}|{business_name}|{business_chat_id}|{staff_name}"}
-        ]
-    ]
+    staff_buttons = [[
+        {"text": text, "callback_data": make_callback(action, hhmm=hhmm, business_name=business_name,
+                                                      business_chat_id=business_chat_id, staff_name=staff_name)}
+        for text, action in (("雙", "double"), ("完成服務", "complete"), ("修正", "fix"))
+    ]]
     send_message(chat_id, msg_business, buttons=staff_buttons, parse_mode="HTML")
 
     clear_pending_for(user_id)
@@ -812,6 +3067,7 @@ def _pending_complete_wait_amount(user_id, text, pending):
         send_message(user_id, "⚠️ 金額格式錯誤，請輸入數字")
         return
 
+    record_service("complete", hhmm, business_name, int(business_chat_id), amount=amount, staff=list(staff_list))
     msg = f"✅ 完成服務通知\n{hhmm} {business_name}\n服務人員: {staff_str}\n金額: {amount}"
     send_message(int(business_chat_id), msg)
     clear_pending_for(user_id)
@@ -823,6 +3079,7 @@ def _pending_not_consumed_wait_reason(user_id, text, pending):
     name = pending["name"]
     business_chat_id = pending["business_chat_id"]
     reason = text.strip()
+    record_service("not_consumed", hhmm, name, int(business_chat_id), reason=reason)
 
     # 發給服務員群（如果 chat_id 存在）
     staff_chat_id = pending.get("chat_id")
@@ -853,38 +3110,36 @@ def _pending_modify_wait_name(user_id, text, pending):
     new_name_input = text.strip()
 
     def callback(data):
-        old_shift = find_shift(data.get("shifts", []), old_hhmm)
+        old_shift = find_shift(data.shifts, old_hhmm)
         if not old_shift:
             send_message(group_chat, f"⚠️ 原時段 {old_hhmm} 不存在。")
             return
 
-        booking = next((b for b in old_shift.get("bookings", []) if b.get("name") == old_name and b.get("chat_id") == group_chat), None)
+        booking = old_shift.find_booking(old_name, group_chat)
         if not booking:
             send_message(group_chat, f"⚠️ 找不到 {old_hhmm} 的預約 {old_name}。")
             return
 
-        new_shift = find_shift(data.get("shifts", []), new_hhmm)
+        new_shift = find_shift(data.shifts, new_hhmm)
         if not new_shift:
             send_message(group_chat, f"⚠️ 新時段 {new_hhmm} 不存在。")
             return
 
-        used_new = len(new_shift.get("bookings", [])) + len([x for x in new_shift.get("in_progress", []) if not str(x).endswith("(候補)")])
-        if used_new >= new_shift.get("limit", 1):
+        if new_shift.used >= new_shift.limit:
             send_message(group_chat, f"⚠️ {new_hhmm} 已滿額，無法修改。")
             return
 
-        old_shift["bookings"] = [b for b in old_shift.get("bookings", []) if not (b.get("name") == old_name and b.get("chat_id") == group_chat)]
-        unique_name = generate_unique_name(new_shift.get("bookings", []), new_name_input)
-        new_shift.setdefault("bookings", []).append({"name": unique_name, "chat_id": group_chat})
+        old_shift.remove_bookings(lambda b: b.name == old_name and b.chat_id == group_chat)
+        unique_name = generate_unique_name(new_shift.bookings, new_name_input)
+        new_shift.add_booking(Booking(unique_name, group_chat))
+        promoted.extend(data.promote_waiting(old_shift))
         send_message(group_chat, f"✅ 已修改：{old_hhmm} {old_name} → {new_hhmm} {unique_name}")
 
+    promoted = []
     safe_modify_today_file(callback)
+    notify_promoted(old_hhmm, promoted)
 
-    buttons = [
-        [{"text": "預約", "callback_data": "main|reserve"}, {"text": "客到", "callback_data": "main|arrive"}],
-        [{"text": "修改預約", "callback_data": "main|modify"}, {"text": "取消預約", "callback_data": "main|cancel"}],
-    ]
-    broadcast_to_groups(generate_latest_shift_list(), group_type="business", buttons=buttons)
+    broadcast_board()
     clear_pending_for(user_id)
 
 
@@ -894,10 +3149,13 @@ def _pending_double_wait_second(user_id, text, pending):
     first_staff = pending["first_staff"]
     second_staff = text.strip()
 
-    double_staffs[hhmm] = [first_staff, second_staff]
-    staff_list = "、".join(double_staffs[hhmm])
-
     business_chat_id = pending.get("business_chat_id")
+    day_state.set_double(hhmm, int(business_chat_id) if business_chat_id else None, pending.get("business_name"),
+                         [first_staff, second_staff])
+    staff_list = f"{first_staff}、{second_staff}"
+
+    record_service("double", hhmm, pending.get("business_name"),
+                   int(business_chat_id) if business_chat_id else None, staff=[first_staff, second_staff])
     if business_chat_id:
         send_message(int(business_chat_id), f"👥 雙人服務更新：{staff_list}")
     clear_pending_for(user_id)
@@ -937,13 +3195,11 @@ def _pending_fix(user_id, text, pending):
     send_message(business_chat_id, msg_business, parse_mode="HTML")
 
     # 發訊息給服務員群，附上按鈕
-    staff_buttons = [
-        [
-            {"text": "雙", "callback_data": f"double|{hhmm}|{business_name}|{business_chat_id}|{staff_name}"},
-            {"text": "完成服務", "callback_data": f"complete|{hhmm}|{business_name}|{business_chat_id}|{staff_name}"},
-            {"text": "修正", "callback_data": f"fix|{hhmm}|{business_name}|{business_chat_id}|{staff_name}"}
-        ]
-    ]
+    staff_buttons = [[
+        {"text": text, "callback_data": make_callback(action, hhmm=hhmm, business_name=business_name,
+                                                      business_chat_id=business_chat_id, staff_name=staff_name)}
+        for text, action in (("雙", "double"), ("完成服務", "complete"), ("修正", "fix"))
+    ]]
 
     send_message(chat_id, msg_business, buttons=staff_buttons, parse_mode="HTML")
 
@@ -953,48 +3209,283 @@ def _pending_fix(user_id, text, pending):
 # -------------------------------
 # 服務員群按「上」 → 從已報到中移除該客人（只刪除，不通知）
 # -------------------------------
-def handle_staff_up(user_id, chat_id, data, callback_id):
-    try:
-        _, hhmm, name, business_chat_id = data.split("|")
-    except ValueError:
+def handle_staff_up(user_id, chat_id, args, callback_id):
+    hhmm, name = args.get("hhmm"), args.get("name")
+    if hhmm is None or name is None:
         answer_callback(callback_id, "⚠️ callback 資料錯誤")
         return
 
-    def callback_func(data_json):
-        shift = find_shift(data_json.get("shifts", []), hhmm)
+    promoted = []
+
+    def callback_func(day):
+        shift = find_shift(day.shifts, hhmm)
         if not shift:
             answer_callback(callback_id, f"⚠️ 找不到時段 {hhmm}")
             return
 
-        removed_item = None
-        in_progress = shift.get("in_progress", [])
-        for i, item in enumerate(in_progress):
-            if isinstance(item, dict) and item.get("name") == name:
-                removed_item = in_progress.pop(i)
-                break
-            elif str(item) == name:
-                removed_item = in_progress.pop(i)
-                break
+        removed_item = shift.find_arrival(name)
+        if removed_item:
+            shift.remove_arrival(removed_item)
 
-        shift["bookings"] = [
-            b for b in shift.get("bookings", [])
-            if (isinstance(b, dict) and b.get("name") != name) or b == name
-        ]
+        shift.remove_bookings(lambda b: b.name == name)
+        promoted.extend(day.promote_waiting(shift))
 
         if removed_item:
             print(f"DEBUG: 已刪除 {hhmm} {name} 從 in_progress")
 
     safe_modify_today_file(callback_func)
     answer_callback(callback_id)
+    notify_promoted(hhmm, promoted)
 
    
 # -------------------------------
 # callback_query 處理（按鈕）
+# 每個動作一個 handler，欄位已由 parse_callback 解析好（ctx.args）
 # -------------------------------
+@callback_router.route("main")
+def _cb_main(ctx):
+    menu = ctx.args["menu"]
+
+    if menu == "reserve":
+        rows = keyboard_page("reserve", ctx.chat_id)[0]
+        return ctx.respond("請選擇要預約的時段：", buttons=rows)
+
+    # actions: arrive / modify / cancel 都是同樣流程
+    if menu not in ("arrive", "modify", "cancel"):
+        return ctx.answer("無效操作。")
+
+    rows, _, _, total = keyboard_page(menu, ctx.chat_id)
+    if not total:
+        if menu == "arrive":
+            return ctx.respond("⚠️ 目前沒有可報到的預約。")
+        elif menu == "modify":
+            return ctx.respond("⚠️ 目前沒有可修改的預約。")
+        elif menu == "cancel":
+            return ctx.respond("⚠️ 目前沒有可取消的預約。")
+
+    if menu == "arrive":
+        return ctx.respond("📋 請選擇要報到的預約：", buttons=rows)
+    elif menu == "modify":
+        return ctx.respond("✏️ 請選擇要修改的預約：", buttons=rows)
+    else:
+        return ctx.respond("❌ 請選擇要取消的預約：", buttons=rows)
+
+
+@callback_router.route("reserve_pick", write=True)
+def _cb_reserve_pick(ctx):
+    hhmm = ctx.args["hhmm"]
+    set_pending_for(ctx.user_id, {"action": "reserve_wait_name", "hhmm": hhmm, "group_chat": ctx.chat_id})
+    shift = find_shift(get_day_snapshot().shifts, hhmm)
+    if shift and not shift.remaining:
+        return ctx.respond(f"✏️ {hhmm} 已滿額，請在此群輸入姓名加入候補，有名額會自動遞補。")
+    return ctx.respond(f"✏️ 請在此群輸入欲預約的/姓名（針對 {hhmm}）。")
+
+
+@callback_router.route("arrive_select", write=True)
+def _cb_arrive_select(ctx):
+    hhmm, name = ctx.args["hhmm"], ctx.args["name"]
+    set_pending_for(ctx.user_id, {"action": "arrive_wait_amount", "hhmm": hhmm, "name": name, "group_chat": ctx.chat_id})
+    return ctx.respond(f"✏️ 請輸入 {hhmm} {name} 的金額（數字）：")
+
+
+@callback_router.route("modify_pick")
+def _cb_modify_pick(ctx):
+    old_hhmm, old_name = ctx.args["hhmm"], ctx.args["name"]
+    rows = keyboard_page("modify_to", ctx.chat_id, extra=(old_hhmm, old_name))[0]
+    return ctx.respond(f"要將 {old_hhmm} {old_name} 修改到哪個時段？", buttons=rows)
+
+
+# 翻頁：直接換掉原訊息的按鈕
+@callback_router.route("page")
+def _cb_page(ctx):
+    if ctx.args["menu"] not in KEYBOARD_ROW_SIZE or ctx.args["menu"] == "modify_to":
+        return ctx.answer("無效操作。")
+    rows = keyboard_page(ctx.args["menu"], ctx.chat_id, ctx.args["page"])[0]
+    return _edit_page(ctx, rows)
+
+
+@callback_router.route("modify_page")
+def _cb_modify_page(ctx):
+    extra = (ctx.args["hhmm"], ctx.args["name"])
+    rows = keyboard_page("modify_to", ctx.chat_id, ctx.args["page"], extra=extra)[0]
+    return _edit_page(ctx, rows)
+
+
+def _edit_page(ctx, rows):
+    if ctx.message_id is None:
+        return ctx.respond("請選擇：", buttons=rows)
+    edit_reply_markup(ctx.chat_id, ctx.message_id, rows)
+    return ctx.answer()
+
+
+@callback_router.route("modify_to", write=True)
+def _cb_modify_to(ctx):
+    old_hhmm, old_name, new_hhmm = ctx.args["old_hhmm"], ctx.args["old_name"], ctx.args["new_hhmm"]
+    set_pending_for(ctx.user_id, {"action": "modify_wait_name", "old_hhmm": old_hhmm, "old_name": old_name, "new_hhmm": new_hhmm, "group_chat": ctx.chat_id})
+    return ctx.respond(f"請輸入新的姓名（或輸入原姓名 `{old_name}` 保留）以完成從 {old_hhmm} → {new_hhmm} 的修改：")
+
+
+@callback_router.route("cancel_pick")
+def _cb_cancel_pick(ctx):
+    hhmm, name = ctx.args["hhmm"], ctx.args["name"]
+    buttons = [[
+        {"text": "確認取消", "callback_data": make_callback("confirm_cancel", hhmm=hhmm, name=name)},
+        {"text": "取消", "callback_data": "cancel_flow"}
+    ]]
+    return ctx.respond(f"確定要取消 {hhmm} {name} 的預約嗎？", buttons=buttons)
+
+
+@callback_router.route("confirm_cancel", write=True)
+def _cb_confirm_cancel(ctx):
+    hhmm, name = ctx.args["hhmm"], ctx.args["name"]
+    result = {}
+
+    def callback(data):
+        s = find_shift(data.shifts, hhmm)
+        if not s:
+            return
+        s.remove_bookings(lambda b: b.name == name and b.chat_id == ctx.chat_id)
+        result["time"] = s.time
+        result["promoted"] = data.promote_waiting(s)
+
+    safe_modify_today_file(callback)
+    if "time" not in result:
+        return ctx.answer("找不到該時段")
+    notify_promoted(result["time"], result["promoted"])
+    broadcast_board()
+    return ctx.respond(f"✅ 已取消 {hhmm} {name} 的預約")
+
+
+@callback_router.route("cancel_flow")
+@callback_router.route("noop")
+def _cb_cancel_flow(ctx):
+    return ctx.answer("已取消")
+
+
+# -------- Staff / Business flow --------
+
+# staff_up -> 通知業務 + 顯示服務員按鈕
+@callback_router.route("staff_up", dedupe=True, write=True)
+def _cb_staff_up(ctx):
+    # 先處理移除 in_progress（answer_callback 在 handle_staff_up 內處理）
+    handle_staff_up(ctx.user_id, ctx.chat_id, ctx.args, ctx.callback_id)
+
+    # 再發通知給業務 + 顯示服務員按鈕
+    hhmm, name, business_chat_id = ctx.args["hhmm"], ctx.args["name"], ctx.args["business_chat_id"]
+    send_message(business_chat_id, f"⬆️ 上 {hhmm} {name}")
+
+    staff_buttons = [[
+        {"text": "輸入客資", "callback_data": make_callback("input_client", **ctx.args)},
+        {"text": "未消", "callback_data": make_callback("not_consumed", **ctx.args)}
+    ]]
+    send_message(ctx.chat_id, f"✅ 已通知業務 {name}", buttons=staff_buttons)
+    return {"ok": True}
+
+
+# 服務員 -> 輸入客資
+@callback_router.route("input_client", dedupe=True, no_pending=True, write=True)
+def _cb_input_client(ctx):
+    set_pending_for(ctx.user_id, {
+        "action": "input_client",
+        "hhmm": ctx.args["hhmm"],
+        "business_name": ctx.args["name"],
+        "business_chat_id": ctx.args["business_chat_id"],
+        "chat_id": ctx.chat_id
+    })
+    send_message(ctx.chat_id, "✏️ 請輸入客稱、年紀、服務人員與金額（格式：小帥 25 小美 3000）")
+    return ctx.answer()
+
+
+# 服務員 -> 未消
+@callback_router.route("not_consumed", dedupe=True, write=True)
+def _cb_not_consumed(ctx):
+    set_pending_for(ctx.user_id, {
+        "action": "not_consumed_wait_reason",
+        "hhmm": ctx.args["hhmm"],
+        "name": ctx.args["name"],
+        "business_chat_id": ctx.args["business_chat_id"],
+        "chat_id": ctx.chat_id
+    })
+    send_message(ctx.chat_id, "✏️ 請輸入未消原因：")
+    return ctx.answer()
+
+
+# 雙人服務（按鈕觸發）
+@callback_router.route("double", dedupe=True, write=True)
+def _cb_double(ctx):
+    first_staff = ctx.args["staff_name"]
+
+    # 設定 pending 等待輸入第二位服務員
+    set_pending_for(ctx.user_id, {
+        "action": "double_wait_second",
+        "hhmm": ctx.args["hhmm"],
+        "business_name": ctx.args["business_name"],
+        "business_chat_id": ctx.args["business_chat_id"],
+        "first_staff": first_staff,
+        "chat_id": ctx.chat_id
+    })
+
+    send_message(ctx.chat_id, f"✏️ 請輸入另一位服務員名字，與 {first_staff} 配合雙人服務")
+    return ctx.answer()
+
+
+# 完成服務
+@callback_router.route("complete", dedupe=True, write=True)
+def _cb_complete(ctx):
+    hhmm, business_name = ctx.args["hhmm"], ctx.args["business_name"]
+
+    # 支援雙人服務
+    staff_list = day_state.get_double(hhmm, ctx.args["business_chat_id"], business_name) or [ctx.args["staff_name"]]
+
+    # 設 pending 等待輸入實際金額
+    set_pending_for(ctx.user_id, {
+        "action": "complete_wait_amount",
+        "hhmm": hhmm,
+        "business_name": business_name,
+        "business_chat_id": ctx.args["business_chat_id"],
+        "staff_list": staff_list,
+        "chat_id": ctx.chat_id
+    })
+
+    send_message(ctx.chat_id, f"✏️ 請輸入 {hhmm} {business_name} 的總金額（數字）：")
+    return ctx.answer()
+
+
+# 修正服務紀錄
+@callback_router.route("fix", no_pending=True, write=True)
+def _cb_fix(ctx):
+    # 設 pending 等待重新輸入客資
+    set_pending_for(ctx.user_id, {
+        "action": "input_client",
+        "hhmm": ctx.args["hhmm"],
+        "business_name": ctx.args["business_name"],
+        "business_chat_id": ctx.args["business_chat_id"],
+        "staff_name": ctx.args["staff_name"],
+        "chat_id": ctx.chat_id,
+        "source": "fix",
+    })
+
+    send_message(ctx.chat_id, f"✏️ 請重新輸入客資（格式：客稱 年齡 服務人員 金額）")
+    return ctx.answer()
+
+
 @app.route("/", methods=["POST"])
 def webhook():
+    if TENANT_HOST:
+        return {"ok": False, "error": "not found"}, 404  # 多租戶模式各店走自己的 webhook_path
+    counted = False
     try:
+        if not accepting_updates.is_set():
+            return {"ok": False}, 503  # 關閉中：Telegram 之後會重送這個 update
+        with inflight_lock:
+            inflight["n"] += 1
+        counted = True
         update = request.get_json()
+        record_update(update)
+
+        if WRITE_QUEUE_POLICY == "shed" and is_overloaded(health_status()):
+            shed_update(update)
+            return {"ok": True}
 
         if "message" in update:
             handle_text_message(update["message"])
@@ -1002,396 +3493,425 @@ def webhook():
 
         if "callback_query" in update:
             cq = update["callback_query"]
-            data = cq.get("data")
-            callback_id = cq.get("id")
-            from_user = cq.get("from", {})
-            user_id = from_user.get("id")
-            chat_id = (cq.get("message", {}) or {}).get("chat", {}).get("id")
-
-            # -------- Helper functions --------
-            def respond(msg, buttons=None, answer=True):
-                if buttons:
-                    send_message(chat_id, msg, buttons=buttons)
-                else:
-                    send_message(chat_id, msg)
-                if answer:
-                    answer_callback(callback_id)
-                return {"ok": True}
-
-            def get_bookings_for_group():
-                path = ensure_today_file()
-                datafile = load_json_file(path)
-                bookings = []
-                for s in datafile.get("shifts", []):
-                    for b in s.get("bookings", []):
-                        if b.get("chat_id") == chat_id:
-                            bookings.append({"time": s["time"], "name": b.get("name")})
-                return bookings, datafile
-
-            # -------- Main actions --------
-            if data and data.startswith("main|"):
-                _, action = data.split("|", 1)
-                path = ensure_today_file()
-                datafile = load_json_file(path)
-
-                if action == "reserve":
-                    shifts = [s for s in datafile.get("shifts", []) if is_future_time(s.get("time", ""))]
-                    rows = []
-                    row = []
-                    for s in shifts:
-                        used = len(s.get("bookings", [])) + len([x for x in s.get("in_progress", []) if not str(x).endswith("(候補)")])
-                        limit = s.get("limit", 1)
-                        text = f"{s['time']} ({limit - used})" if used < limit else f"{s['time']} (滿)"
-                        row.append({"text": text, "callback_data": f"reserve_pick|{s['time']}" if used < limit else "noop"})
-                        if len(row) == 3:
-                            rows.append(row)
-                            row = []
-                    if row: rows.append(row)
-                    rows.append([{"text": "取消", "callback_data": "cancel_flow"}])
-                    return respond("請選擇要預約的時段：", buttons=rows)
-
-                # actions: arrive / modify / cancel 都是同樣流程
-                if action in ("arrive", "modify", "cancel"):
-                    bookings, _ = get_bookings_for_group()
-                    if not bookings:
-                        if action == "arrive":
-                            return respond("⚠️ 目前沒有可報到的預約。")
-                        elif action == "modify":
-                            return respond("⚠️ 目前沒有可修改的預約。")
-                        elif action == "cancel":
-                            return respond("⚠️ 目前沒有可取消的預約。")
-
-                    btns = []
-                    for bk in bookings:
-                        if action == "arrive":
-                            cb_prefix = "arrive_select"
-                            btn_text = f"{bk['time']} {bk['name']}"
-                        elif action == "modify":
-                            cb_prefix = "modify_pick"
-                            btn_text = f"{bk['time']} {bk['name']}"
-                        elif action == "cancel":
-                            cb_prefix = "cancel_pick"
-                            btn_text = f"{bk['time']} {bk['name']}"
-                        btns.append({"text": btn_text, "callback_data": f"{cb_prefix}|{bk['time']}|{bk['name']}"})
-
-                    chunk_size = 2 if action == "arrive" else 1
-                    rows = chunk_list(btns, chunk_size)
-                    rows.append([{"text": "取消", "callback_data": "cancel_flow"}])
-
-                    if action == "arrive":
-                        return respond("📋 請選擇要報到的預約：", buttons=rows)
-                    elif action == "modify":
-                        return respond("✏️ 請選擇要修改的預約：", buttons=rows)
-                    elif action == "cancel":
-                        return respond("❌ 請選擇要取消的預約：", buttons=rows)
-
-
-            # -------- Reserve pick --------
-            if data and data.startswith("reserve_pick|"):
-                _, hhmm = data.split("|", 1)
-                set_pending_for(user_id, {"action": "reserve_wait_name", "hhmm": hhmm, "group_chat": chat_id})
-                return respond(f"✏️ 請在此群輸入欲預約的/姓名（針對 {hhmm}）。")
-
-            # -------- Arrive select --------
-            if data and data.startswith("arrive_select|"):
-                parts = data.split("|", 2)
-                if len(parts) < 3:
-                    return answer_callback(callback_id, "資料錯誤")
-                _, hhmm, name = parts
-                set_pending_for(user_id, {"action": "arrive_wait_amount", "hhmm": hhmm, "name": name, "group_chat": chat_id})
-                return respond(f"✏️ 請輸入 {hhmm} {name} 的金額（數字）：")
-
-            # -------- Modify pick / to --------
-            if data and data.startswith("modify_pick|"):
-                parts = data.split("|", 2)
-                if len(parts) < 3:
-                    return answer_callback(callback_id, "資料錯誤")
-                _, old_hhmm, old_name = parts
-                path = ensure_today_file()
-                datafile = load_json_file(path)
-                shifts = [s for s in datafile.get("shifts", []) if is_future_time(s.get("time",""))]
-                rows, row = [], []
-                for s in shifts:
-                    row.append({"text": s["time"], "callback_data": f"modify_to|{old_hhmm}|{old_name}|{s['time']}"})
-                    if len(row) == 3:
-                        rows.append(row)
-                        row = []
-                if row: rows.append(row)
-                rows.append([{"text": "取消", "callback_data": "cancel_flow"}])
-                return respond(f"要將 {old_hhmm} {old_name} 修改到哪個時段？", buttons=rows)
-
-            if data and data.startswith("modify_to|"):
-                parts = data.split("|", 3)
-                if len(parts) < 4:
-                    return answer_callback(callback_id, "資料錯誤")
-                _, old_hhmm, old_name, new_hhmm = parts
-                set_pending_for(user_id, {"action": "modify_wait_name", "old_hhmm": old_hhmm, "old_name": old_name, "new_hhmm": new_hhmm, "group_chat": chat_id})
-                return respond(f"請輸入新的姓名（或輸入原姓名 `{old_name}` 保留）以完成從 {old_hhmm} → {new_hhmm} 的修改：")
-
-            # -------- Cancel pick / confirm --------
-            if data and data.startswith("cancel_pick|"):
-                _, hhmm, name = data.split("|", 2)
-                buttons = [[
-                    {"text": "確認取消", "callback_data": f"confirm_cancel|{hhmm}|{name}"},
-                    {"text": "取消", "callback_data": "cancel_flow"}
-                ]]
-                return respond(f"確定要取消 {hhmm} {name} 的預約嗎？", buttons=buttons)
-
-            if data and data.startswith("confirm_cancel|"):
-                _, hhmm, name = data.split("|", 2)
-                path = ensure_today_file()
-                datafile = load_json_file(path)
-                s = find_shift(datafile.get("shifts", []), hhmm)
-                if not s:
-                    return answer_callback(callback_id, "找不到該時段")
-                s["bookings"] = [b for b in s.get("bookings", []) if not (b.get("name") == name and b.get("chat_id") == chat_id)]
-                save_json_file(path, datafile)
-                buttons = [
-                    [{"text": "預約", "callback_data": "main|reserve"}, {"text": "客到", "callback_data": "main|arrive"}],
-                    [{"text": "修改預約", "callback_data": "main|modify"}, {"text": "取消預約", "callback_data": "main|cancel"}],
-                ]
-                broadcast_to_groups(generate_latest_shift_list(), group_type="business", buttons=buttons)
-                return respond(f"✅ 已取消 {hhmm} {name} 的預約")
-
-            # -------- Cancel / No-op --------
-            if data in ("cancel_flow", "noop"):
-                return answer_callback(callback_id, "已取消")
-
-            # -------- Staff / Business flow --------
-           
-            # staff_up -> 通知業務 + 顯示服務員按鈕
-            if data and data.startswith("staff_up|"):
-                if staff_button_used(data):
-                    answer_callback(callback_id, "⚠️ 此按鈕已被使用過。")
-                    return {"ok": True}
-
-                # 先處理移除 in_progress
-                handle_staff_up(user_id, chat_id, data, callback_id)
-
-                # 再發通知給業務 + 顯示服務員按鈕
-                _, hhmm, name, business_chat_id = data.split("|", 3)
-                send_message(int(business_chat_id), f"⬆️ 上 {hhmm} {name}")
-
-                staff_buttons = [[
-                    {"text": "輸入客資", "callback_data": f"input_client|{hhmm}|{name}|{business_chat_id}"},
-                    {"text": "未消", "callback_data": f"not_consumed|{hhmm}|{name}|{business_chat_id}"}
-                ]]
-                send_message(chat_id, f"✅ 已通知業務 {name}", buttons=staff_buttons)
-                # answer_callback 已在 handle_staff_up 處理，不需要再呼叫一次
-                return {"ok": True}
-
-                
-            # 服務員 -> 輸入客資
-            if data and data.startswith("input_client|"):
-                if staff_button_used(data):
-                    answer_callback(callback_id, "⚠️ 此按鈕已被使用過。")
-                    return {"ok": True}
-
-                if has_pending_for(user_id):
-                    answer_callback(callback_id, "⚠️ 你已有進行中的操作，請先完成。")
-                    return {"ok": True}
-
-                _, hhmm, name, business_chat_id = data.split("|", 3)
-                set_pending_for(user_id, {
-                    "action": "input_client",
-                    "hhmm": hhmm,
-                    "business_name": name,
-                    "business_chat_id": business_chat_id,
-                    "chat_id": chat_id
-                })
-                send_message(chat_id, "✏️ 請輸入客稱、年紀、服務人員與金額（格式：小帥 25 小美 3000）")
-                answer_callback(callback_id)
-                return {"ok": True}
-
-            # 服務員 -> 未消
-            if data and data.startswith("not_consumed|"):
-                if staff_button_used(data):
-                    answer_callback(callback_id, "⚠️ 此按鈕已被使用過。")
-                    return {"ok": True}
-
-                _, hhmm, name, business_chat_id = data.split("|", 3)
-                set_pending_for(user_id, {
-                    "action": "not_consumed_wait_reason",
-                    "hhmm": hhmm,
-                    "name": name,
-                    "business_chat_id": business_chat_id,
-                    "chat_id": chat_id
-                })
-                send_message(chat_id, "✏️ 請輸入未消原因：")
-                answer_callback(callback_id)
-                return {"ok": True}
-
-            # 雙人服務（按鈕觸發）
-            if data and data.startswith("double|"):
-                if staff_button_used(data):
-                    answer_callback(callback_id, "⚠️ 此按鈕已被使用過。")
-                    return {"ok": True}
-
-                try:
-                    # 新格式：double|hhmm|business_name|business_chat_id|staff_name
-                    _, hhmm, business_name, business_chat_id, first_staff = data.split("|")
-                except ValueError:
-                    # 若舊資料結構（沒有 staff_name），仍相容處理
-                    _, hhmm, business_name, business_chat_id = data.split("|")
-                    first_staff = "未知服務員"
-
-                # 設定 pending 等待輸入第二位服務員
-                set_pending_for(user_id, {
-                    "action": "double_wait_second",
-                    "hhmm": hhmm,
-                    "business_name": business_name,
-                    "business_chat_id": business_chat_id,
-                    "first_staff": first_staff,
-                    "chat_id": chat_id
-                })
-
-                send_message(chat_id, f"✏️ 請輸入另一位服務員名字，與 {first_staff} 配合雙人服務")
-                answer_callback(callback_id)
-                return {"ok": True}
-
-
-            # 完成服務
-            if data and data.startswith("complete|"):
-                if staff_button_used(data):
-                    answer_callback(callback_id, "⚠️ 此按鈕已被使用過。")
-                    return {"ok": True}
-
-                try:
-                    # 新格式：complete|hhmm|business_name|business_chat_id|staff_name
-                    _, hhmm, business_name, business_chat_id, staff_name = data.split("|")
-                except ValueError:
-                    # 若舊格式（沒有 staff_name），仍相容處理
-                    _, hhmm, business_name, business_chat_id = data.split("|")
-                    staff_name = "未知服務員"
-
-                # 支援雙人服務
-                staff_list = double_staffs.get(hhmm, [staff_name])
-                staff_str = "、".join(staff_list)
-
-                # 設 pending 等待輸入實際金額
-                set_pending_for(user_id, {
-                    "action": "complete_wait_amount",
-                    "hhmm": hhmm,
-                    "business_name": business_name,
-                    "business_chat_id": business_chat_id,
-                    "staff_list": staff_list,
-                    "chat_id": chat_id
-                })
-
-                send_message(chat_id, f"✏️ 請輸入 {hhmm} {business_name} 的總金額（數字）：")
-                answer_callback(callback_id)
-                return {"ok": True}
- 
-
-            # 修正服務紀錄
-            if data and data.startswith("fix|"):
-                if has_pending_for(user_id):
-                    answer_callback(callback_id, "⚠️ 你已有進行中的操作，請先完成。")
-                    return {"ok": True}
-
-                try:
-                    # 新格式：fix|hhmm|business_name|business_chat_id|staff_name
-                    _, hhmm, business_name, business_chat_id, staff_name = data.split("|")
-                except ValueError:
-                    # 舊格式相容
-                    _, hhmm, business_name, business_chat_id = data.split("|")
-                    staff_name = "未知服務員"
-
-                # 設 pending 等待重新輸入客資
-                set_pending_for(user_id, {
-                    "action": "input_client",
-                    "hhmm": hhmm,
-                    "business_name": business_name,
-                    "business_chat_id": business_chat_id,
-                    "staff_name": staff_name,
-                    "chat_id": chat_id
-                })
-
-                send_message(chat_id, f"✏️ 請重新輸入客資（格式：客稱 年齡 服務人員 金額）")
-                answer_callback(callback_id)
-                return {"ok": True}
-
-            # fallback
-            return answer_callback(callback_id, "無效操作。")
+            action, args = parse_callback(cq.get("data"))
+            ctx = UpdateContext(
+                user_id=(cq.get("from") or {}).get("id"),
+                chat_id=((cq.get("message") or {}).get("chat") or {}).get("id"),
+                callback_id=cq.get("id"),
+                message_id=(cq.get("message") or {}).get("message_id"),
+                action=action,
+                args=args,
+            )
+            if args is None:
+                ctx.answer("⚠️ 按鈕已過期，請重新操作。")
+            else:
+                callback_router.dispatch(action, ctx)
 
     except Exception:
         traceback.print_exc()
+    finally:
+        if counted:
+            with inflight_lock:
+                inflight["n"] -= 1
+        profile_note_update()
     return {"ok": True}
 
 
+# -------------------------------
+# 背景執行緒與健康檢查（/healthz 存活、/readyz 可接流量）
+# -------------------------------
+HEARTBEAT_INTERVAL = 30   # 背景執行緒至少每幾秒回報一次
+HEARTBEAT_STALE = 120     # 超過幾秒沒回報視為卡住
+OUTBOUND_BACKLOG_MAX = int(os.getenv("OUTBOUND_BACKLOG_MAX", "500"))
+
+# 多租戶時背景執行緒只在主模組啟動，兩張表由各店共用
+background_threads = SHARED.get("background_threads", {})  # 名稱 -> Thread（start_background 啟動的才會檢查）
+heartbeats = SHARED.get("heartbeats", {})                  # 名稱 -> 最後回報時間（monotonic）
+
+
+def heartbeat(name):
+    heartbeats[name] = time.monotonic()
+
+
+def start_background(name, target):
+    t = threading.Thread(target=target, daemon=True, name=name)
+    background_threads[name] = t
+    t.start()
+    return t
+
+
+def health_status():
+    now = time.monotonic()
+    threads = {}
+    for name, t in background_threads.items():
+        beat = heartbeats.get(name)
+        threads[name] = {"alive": t.is_alive(), "last_heartbeat_s": round(now - beat, 1) if beat else None}
+    return {
+        "writer_lag_s": round(write_queue.lag(), 3),
+        "write_queue": write_queue.qsize(),
+        "write_queue_max": WRITE_QUEUE_MAX,
+        "outbound_backlog": broadcast_pool._work_queue.qsize(),
+        "rate_limit": {"buckets": len(rate_limiter.buckets), "rejected": rate_limiter.rejected},
+        "threads": threads,
+    }
+
+
+def is_healthy(status):
+    threads_ok = all(t["alive"] and (t["last_heartbeat_s"] is None or t["last_heartbeat_s"] < HEARTBEAT_STALE)
+                     for t in status["threads"].values())
+    return threads_ok and status["writer_lag_s"] < WRITER_LAG_UNHEALTHY
+
+
+def is_overloaded(status):
+    return (status["write_queue"] >= WRITE_QUEUE_MAX or status["writer_lag_s"] > WRITER_LAG_SHED
+            or status["outbound_backlog"] > OUTBOUND_BACKLOG_MAX)
+
+
+def shed_update(update):
+    """過載時不處理，只回一句忙碌中（按鈕用 answerCallbackQuery，不另外發訊息）"""
+    busy = "⏳ 系統忙碌中，請稍後再試"
+    if "callback_query" in update:
+        answer_callback(update["callback_query"].get("id"), busy)
+    elif (update.get("message") or {}).get("chat", {}).get("id") is not None:
+        send_message(update["message"]["chat"]["id"], busy)
+    print("DEBUG: 過載，略過 update")
+
+
+# -------------------------------
+# 優雅關閉（SIGTERM）與啟動復原
+# 關閉：停止接收 update（回 503 讓 Telegram 重送）→ 等處理中的 update → 送完或保存群發
+# → 寫完所有待寫檔案 → 關閉錄製檔，全部在 SHUTDOWN_DEADLINE 秒內完成
+# -------------------------------
+SHUTDOWN_DEADLINE = float(os.getenv("SHUTDOWN_DEADLINE", "20"))
+OUTBOUND_FILE = os.path.join(DATA_DIR, "outbound.jsonl")   # 來不及送出的群發，啟動時補送
+SHUTDOWN_FILE = os.path.join(DATA_DIR, "shutdown.json")    # 正常關閉時寫入，啟動時據此判斷上次是否正常結束
+
+accepting_updates = threading.Event()
+accepting_updates.set()
+inflight_lock = threading.Lock()
+inflight = {"n": 0}  # 處理中的 webhook 數
+
+
+def _wait_until(cond, deadline, step=0.05):
+    while not cond():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(step)
+    return True
+
+
+def _drain_outbound(deadline):
+    """等群發執行緒池把排隊的訊息送完；逾時的訊息取消並存到 OUTBOUND_FILE，回傳保存筆數
+    多租戶共用執行緒池：每則訊息存到送出它的那家店的 OUTBOUND_FILE（由 send_prepared 所屬模組決定）"""
+    work_queue = broadcast_pool._work_queue
+    _wait_until(lambda: work_queue.qsize() == 0, deadline)
+    saved = {}  # OUTBOUND_FILE -> [行]
+    while True:
+        try:
+            item = work_queue.get_nowait()
+        except queue.Empty:
+            break
+        if item is None or not item.future.cancel():
+            continue
+        if getattr(item.fn, "__name__", "") == "send_prepared":  # 看板同步（_sync_group_board）下次會重送，不必保存
+            chat_id, body = item.args
+            saved.setdefault(item.fn.__globals__["OUTBOUND_FILE"], []).append(
+                json.dumps({"chat_id": chat_id, "body": body.decode("utf-8")}, ensure_ascii=False))
+    for path, lines in saved.items():
+        with open(path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+    return sum(len(lines) for lines in saved.values())
+
+
+def _flush_writes(deadline):
+    """讓背景 writer 寫完；writer 沒在跑時直接在這裡寫。回傳沒寫出去的路徑"""
+    writer = background_threads.get("writer")
+    if writer is not None and writer.is_alive():
+        try:  # 佇列滿了就等到期限為止，停止訊號放不進去也不能卡住關機
+            write_queue.put(None, timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Full:
+            pass
+        writer.join(max(0.0, deadline - time.monotonic()))
+        if writer.is_alive():  # 還卡在寫檔：不能和它搶同一個檔，只回報
+            lost = sorted(write_queue.paths())
+            print(f"[SHUTDOWN] ⚠️ writer 未在期限內寫完，未寫出：{lost or '無'}")
+            return lost
+    lost = []
+    while True:
+        try:
+            task = write_queue.get_nowait()
+        except queue.Empty:
+            break
+        if task is not None and task[1] is not FILE_UPGRADE:
+            if not write_json_atomic(*task):
+                lost.append(task[0])
+            write_queue.written(*task)
+        write_queue.task_done()
+    return lost
+
+
+def save_state_for_shutdown():
+    """存帳本彙總（排進寫檔佇列）、關閉錄製檔；多租戶時每家店各呼叫一次，之後再清空寫檔佇列"""
+    global record_fp
+    with ledger_lock:
+        if ledger["loaded"] and ledger["unsaved"]:
+            save_json_file(LEDGER_ROLLUP_FILE, copy.deepcopy({"offset": ledger["offset"], "rollups": ledger["rollups"]}))
+    with record_lock:
+        if record_fp is not None:
+            record_fp.close()  # gzip 結尾要寫出，重播才讀得完整
+            record_fp = None
+
+
+def graceful_shutdown(deadline_s=SHUTDOWN_DEADLINE):
+    t0 = time.monotonic()
+    deadline = t0 + deadline_s
+    accepting_updates.clear()
+    print(f"[SHUTDOWN] 停止接收 update，處理中 {inflight['n']} 筆")
+    if not _wait_until(lambda: inflight["n"] == 0, t0 + deadline_s / 2):
+        print(f"[SHUTDOWN] ⚠️ 仍有 {inflight['n']} 筆 update 未處理完")
+
+    saved = _drain_outbound(t0 + deadline_s * 0.75)
+    save_state_for_shutdown()
+    lost = _flush_writes(deadline)
+
+    write_json_atomic(SHUTDOWN_FILE, {"at": get_now().isoformat(), "outbound_saved": saved, "lost_writes": lost,
+                                      "elapsed_s": round(time.monotonic() - t0, 3)})
+    print(f"[SHUTDOWN] 完成（{time.monotonic() - t0:.2f}s），保存群發 {saved} 則，未寫出 {lost or '無'}")
+
+
+def _on_signal(signum, frame):
+    graceful_shutdown()
+    sys.exit(0)
+
+
+def recover_on_startup():
+    """啟動時檢查並回報：上次是否正常關閉、殘留暫存檔、今日資料、待處理狀態，並補送保存的群發"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    last = load_json_file(SHUTDOWN_FILE, None)
+    if last:
+        print(f"[STARTUP] 上次正常關閉於 {last.get('at')}，未寫出：{last.get('lost_writes') or '無'}")
+        os.remove(SHUTDOWN_FILE)
+    else:
+        print("[STARTUP] ⚠️ 上次沒有正常關閉（或是第一次啟動）")
+
+    for fname in os.listdir(DATA_DIR):
+        if fname.endswith(".tmp"):  # 寫到一半就中斷；正式檔仍是上一版
+            print(f"[STARTUP] 移除寫到一半的暫存檔 {fname}")
+            os.remove(os.path.join(DATA_DIR, fname))
+        elif fname.endswith(".corrupt"):
+            print(f"[STARTUP] ⚠️ 有隔離的損毀檔 {fname}，請人工檢查")
+
+    path = data_path_for(get_now().date().isoformat())
+    if os.path.exists(path):
+        day = load_day(path)
+        print(f"[STARTUP] 今日 {len(day.shifts)} 個時段、預約 {sum(len(s.bookings) for s in day.shifts)}、"
+              f"已報到 {sum(len(s.in_progress) for s in day.shifts)}、候補 {sum(1 for _ in day.iter_waiting())}")
+    print(f"[STARTUP] 待處理輸入 {len(load_pending())} 位使用者、群組 {len(load_groups())} 個")
+
+    if os.path.exists(OUTBOUND_FILE):
+        resent = failed = 0
+        with open(OUTBOUND_FILE, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                    ok = send_prepared(item["chat_id"], item["body"].encode("utf-8")).get("ok")
+                except Exception as e:
+                    print(f"[STARTUP] 補送失敗: {e}")
+                    ok = False
+                resent += bool(ok)
+                failed += not ok
+        os.remove(OUTBOUND_FILE)
+        print(f"[STARTUP] 補送上次保存的群發 {resent} 則，失敗 {failed} 則")
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    status = health_status()
+    return status, 200 if is_healthy(status) else 503
+
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    status = health_status()
+    status["overloaded"] = is_overloaded(status)
+    return status, 200 if is_healthy(status) and not status["overloaded"] else 503
+
+
+@app.route("/export.csv", methods=["GET"])
+def export_csv():
+    """
+    GET /export.csv?from=YYYY-MM-DD&to=YYYY-MM-DD&group=...&staff=...&time=13:00-18:00
+    帶 Authorization: Bearer <EXPORT_TOKEN>；舊的 ?token= 仍接受，但會留在存取紀錄裡，不建議使用
+    """
+    if TENANT_HOST:
+        return {"ok": False, "error": "not found"}, 404  # 多租戶模式各店走 <webhook_path>/export.csv
+    auth = request.headers.get("Authorization", "")
+    token = auth[len("Bearer "):] if auth.startswith("Bearer ") else request.args.get("token", "")
+    if not EXPORT_TOKEN or not hmac.compare_digest(token.encode("utf-8"), EXPORT_TOKEN.encode("utf-8")):
+        return {"ok": False, "error": "forbidden"}, 403
+    args = [request.args.get("from", "")]
+    if request.args.get("to"):
+        args.append(request.args["to"])
+    args += [f"{k}={request.args[k]}" for k in ("group", "staff", "time") if request.args.get(k)]
+    try:
+        start, end, filters = parse_export_filters(args)
+    except ValueError as e:
+        return {"ok": False, "error": str(e)}, 400
+    filename = f"export-{start.isoformat()}_{end.isoformat()}.csv"
+    return Response(stream_with_context(iter_csv(iter_export_rows(start, end, **filters))), mimetype="text/csv",
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+
 # -------------------------------
 # 自動任務
 # -------------------------------
+def auto_announce_tick(now):
+    """整點公告；有發送回傳 True"""
+    if not (12 <= now.hour <= 22 and now.minute == 0):
+        return False
+    try:
+        broadcast_board()
+        print(f"[AUTO ANNOUNCE] {now} 發送公告")
+    except Exception as e:
+        print(f"❌ [AUTO ANNOUNCE] 發送失敗: {e}")
+    return True
+
+
 def auto_announce():
     while True:
-        now = datetime.now(TZ)
-        if 12 <= now.hour <= 22 and now.minute == 0:
-            try:
-                buttons = [
-                    [{"text": "預約", "callback_data": "main|reserve"}, {"text": "客到", "callback_data": "main|arrive"}],
-                    [{"text": "修改預約", "callback_data": "main|modify"}, {"text": "取消預約", "callback_data": "main|cancel"}],
-                ]
-                broadcast_to_groups(generate_latest_shift_list(), group_type="business", buttons=buttons)
-                print(f"[AUTO ANNOUNCE] {now} 發送公告")
-            except Exception as e:
-                print(f"❌ [AUTO ANNOUNCE] 發送失敗: {e}")
+        heartbeat("announce")
+        if auto_announce_tick(get_now()):
             time.sleep(60)  # 避免整點重複
         else:
             time.sleep(10)  # 其他時間每 10 秒檢查一次
 
 
+def ask_arrivals_tick(now):
+    """整點詢問該時段的預約是否已到"""
+    current_hm = f"{now.hour:02d}:00"
+    today = now.date().isoformat()
+
+    if now.minute == 0 and day_state.mark_asked(today, current_hm):
+        path = data_path_for(today)
+        try:
+            if os.path.exists(path):
+                data = get_day_snapshot(path)
+                check_capacity_counters(data, repair=False)
+                for s in data.shifts:
+                    if s.minute != now.hour * 60:
+                        continue
+                    waiting = []
+                    groups_to_notify = set()
+                    in_prog_names = {a.name for a in s.in_progress}
+                    for b in s.bookings:
+                        if b.name not in in_prog_names:
+                            waiting.append(b.name)
+                            groups_to_notify.add(b.chat_id)
+                    if waiting:
+                        names_text = "、".join(waiting)
+                        text = f"⏰ 現在是 {current_hm}\n請問預約的「{names_text}」到了嗎？\n到了請回覆：客到 {current_hm} 名稱 或使用按鈕 /list → 客到"
+                        for gid in groups_to_notify:
+                            try:
+                                send_message(gid, text)
+                            except Exception as e:
+                                print(f"❌ [ASK ARRIVALS] 發送訊息失敗 gid={gid}: {e}")
+        except Exception as e:
+            print(f"❌ [ASK ARRIVALS] 讀取檔案失敗: {e}")
+
+
 def ask_arrivals_thread():
-    global asked_shifts
     while True:
-        now = datetime.now(TZ)
-        current_hm = f"{now.hour:02d}:00"
-        today = now.date().isoformat()
-        key = f"{today}|{current_hm}"
+        heartbeat("arrivals")
+        ask_arrivals_tick(get_now())
+        time.sleep(10)
 
-        if now.minute == 0 and key not in asked_shifts:
-            path = data_path_for(today)
+# -------------------------------
+# 多租戶：一個行程服務多家店
+# TENANTS_FILE 是 JSON 陣列，每家店：
+#   {"name": "shop1", "token": "...", "webhook_path": "/t/shop1", "admin_ids": [...],
+#    "staff_group_id": -100..., "shift_hours": [13, 23], "data_dir": "data/shop1", "export_token": "..."}
+# 各店的匯出在 <webhook_path>/export.csv；主模組的 / 與 /export.csv 在多租戶模式回 404
+# 每家店各自載入一份本檔（設定、資料目錄、記憶體狀態都獨立），
+# 共用 HTTP 連線池、群發執行緒池、寫檔佇列（一個 writer）與一個排程執行緒
+# -------------------------------
+tenants = {}  # 名稱 -> 該店的模組
+
+
+def load_tenant(cfg):
+    name = cfg["name"]
+    if not cfg.get("token"):
+        raise ValueError(f"❌ 租戶 {name} 未設定 token")
+    spec = importlib.util.spec_from_file_location(f"tenant_{name}", os.path.abspath(__file__))
+    module = importlib.util.module_from_spec(spec)
+    module.TENANT_CONFIG = dict(cfg, data_dir=cfg.get("data_dir") or os.path.join(DATA_DIR, name))
+    module.TENANT_SHARED = {"http": http, "broadcast_pool": broadcast_pool,
+                            "write_queue": write_queue, "FILE_UPGRADE": FILE_UPGRADE,
+                            "background_threads": background_threads, "heartbeats": heartbeats}
+    spec.loader.exec_module(module)
+    webhook_path = cfg.get("webhook_path") or f"/t/{name}"
+    app.add_url_rule(webhook_path, endpoint=f"webhook_{name}", view_func=module.webhook, methods=["POST"])
+    app.add_url_rule(webhook_path.rstrip("/") + "/export.csv", endpoint=f"export_{name}",
+                     view_func=module.export_csv, methods=["GET"])
+    tenants[name] = module
+    return module
+
+
+def load_tenants(path):
+    with open(path, encoding="utf-8") as f:
+        for cfg in json.load(f):
+            load_tenant(cfg)
+    print(f"[TENANTS] 已載入 {len(tenants)} 家店：{sorted(tenants)}")
+    return tenants
+
+
+def tenant_scheduler():
+    """所有店共用的排程：整點公告與客到詢問"""
+    announced = {}  # 店名 -> 上次公告的 (日期, 小時)
+    while True:
+        heartbeat("scheduler")
+        now = get_now()
+        for name, module in list(tenants.items()):
             try:
-                if os.path.exists(path):
-                    data = load_json_file(path)
-                    for s in data.get("shifts", []):
-                        if s.get("time") != current_hm:
-                            continue
-                        waiting = []
-                        groups_to_notify = set()
-                        for b in s.get("bookings", []):
-                            name = b.get("name")
-                            gid = b.get("chat_id")
-                            in_prog_names = [x["name"] if isinstance(x, dict) else x for x in s.get("in_progress", [])]
-                            if name not in in_prog_names:
-                                waiting.append(name)
-                                groups_to_notify.add(gid)
-                        if waiting:
-                            names_text = "、".join(waiting)
-                            text = f"⏰ 現在是 {current_hm}\n請問預約的「{names_text}」到了嗎？\n到了請回覆：客到 {current_hm} 名稱 或使用按鈕 /list → 客到"
-                            for gid in groups_to_notify:
-                                try:
-                                    send_message(gid, text)
-                                except Exception as e:
-                                    print(f"❌ [ASK ARRIVALS] 發送訊息失敗 gid={gid}: {e}")
-                    asked_shifts.add(key)
-            except Exception as e:
-                print(f"❌ [ASK ARRIVALS] 讀取檔案失敗: {e}")
+                if announced.get(name) != (now.date(), now.hour) and module.auto_announce_tick(now):
+                    announced[name] = (now.date(), now.hour)
+                module.ask_arrivals_tick(now)
+            except Exception:
+                traceback.print_exc()
+        time.sleep(10)
 
-        # 每天 00:01 清空
-        if now.hour == 0 and now.minute == 1:
-            asked_shifts.clear()
-            print("[ASK ARRIVALS] 已清空今日記錄")
 
-        time.sleep(10)
+def _on_tenant_signal(signum, frame):
+    """各店先停止接收並等處理中的 update、存帳本彙總、關閉錄製檔，再由共用的 graceful_shutdown 清空群發與寫檔"""
+    deadline = time.monotonic() + SHUTDOWN_DEADLINE / 2
+    for module in tenants.values():
+        module.accepting_updates.clear()
+    _wait_until(lambda: all(m.inflight["n"] == 0 for m in tenants.values()), deadline)
+    for module in tenants.values():
+        module.save_state_for_shutdown()
+    _on_signal(signum, frame)
+
 
 # -------------------------------
 # 啟動背景執行緒 啟動 Flask
 # -------------------------------
-if __name__ == "__main__":
+if __name__ == "__main__" and TENANTS_FILE:
+    load_tenants(TENANTS_FILE)
+    for module in tenants.values():
+        module.recover_on_startup()
+    signal.signal(signal.SIGTERM, _on_tenant_signal)
+    signal.signal(signal.SIGINT, _on_tenant_signal)
+    start_background("scheduler", tenant_scheduler)
+    start_background("writer", background_writer)
+    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)), use_reloader=False)
+
+elif __name__ == "__main__":
+    recover_on_startup()
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
     # 啟動背景執行緒
-    threading.Thread(target=auto_announce, daemon=True).start()
-    threading.Thread(target=ask_arrivals_thread, daemon=True).start()
-    threading.Thread(target=background_writer, daemon=True).start()
+    start_background("announce", auto_announce)
+    start_background("arrivals", ask_arrivals_thread)
+    start_background("writer", background_writer)
     # 關閉 reloader 避免多次啟動
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)), use_reloader=False)
 
@@ -0,0 +1,210 @@
+"""
+重播錄製的 webhook 流量（離線效能回歸 + 正確性檢查）
+
+錄製：在正式環境設定 WEBHOOK_RECORD_FILE=data/capture.jsonl.gz（見 main.py record_update）。
+重播：以固定時鐘（每筆 update 的錄製時間）餵回 webhook()，對象是 fake_telegram.py，
+整點的 ask_arrivals_tick / auto_announce_tick 也依虛擬時間觸發，結果與錄製當下一致。
+
+    python replay.py capture.jsonl.gz                       # 盡快重播
+    python replay.py capture.jsonl.gz --speed 1             # 依原速
+    python replay.py capture.jsonl.gz --speed 60 --seed-dir snapshot/
+    python replay.py capture.jsonl.gz --save-outbound base.jsonl
+    python replay.py capture.jsonl.gz --compare-outbound base.jsonl   # 輸出不同則 exit 1
+"""
+import argparse
+import contextlib
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from fake_telegram import FakeTelegram
+from loadtest import import_bot, percentile
+
+
+def read_capture(path):
+    """讀取壓縮 JSONL；程序中斷造成結尾不完整時，保留已讀到的部分"""
+    records = []
+    opener = gzip.open if path.endswith(".gz") else open
+    try:
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                records.append((float(rec["ts"]), rec["update"]))
+    except EOFError:
+        print(f"⚠️ {path} 結尾不完整，已讀取 {len(records)} 筆", file=sys.stderr)
+    records.sort(key=lambda r: r[0])
+    return records
+
+
+def sync_write_queue(bot):
+    """put 之後等背景執行緒寫完才返回，讓之後讀檔一定讀到最新內容（重播結果可重現）"""
+
+    class SyncWriteQueue(bot.WriteQueue):
+        def put(self, item, block=True, timeout=None):
+            super().put(item, block, timeout)
+            if item is not None:
+                self.join()
+
+    return SyncWriteQueue()
+
+
+def minute_marks(start, end):
+    """(start, end] 之間每個整分鐘"""
+    m = start.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    while m <= end:
+        yield m
+        m += timedelta(minutes=1)
+
+
+def outbound(fake):
+    """依送出順序列出訊息（method, chat_id, text）"""
+    with fake.lock:
+        calls = list(fake.calls)
+    return [{"method": c["method"], "chat_id": c["payload"].get("chat_id"), "text": c["payload"].get("text")}
+            for c in calls
+            if c["status"] == 200 and c["method"] in ("sendMessage", "editMessageText", "editMessageReplyMarkup")]
+
+
+def run(args):
+    records = read_capture(args.capture)
+    if not records:
+        raise SystemExit("capture 沒有任何 update")
+
+    fake = FakeTelegram(latency=args.latency).start()
+    data_root = tempfile.mkdtemp(prefix="replay-")
+    os.environ.setdefault("BROADCAST_WORKERS", "1")  # 群發依序送出，送出順序才可重現
+    bot = import_bot(fake.base_url, data_root)
+    if args.seed_dir:
+        for name in os.listdir(args.seed_dir):
+            src = os.path.join(args.seed_dir, name)
+            if os.path.isfile(src):
+                shutil.copy(src, os.path.join(bot.DATA_DIR, name))
+
+    # 固定時鐘：main 內所有時間判斷都走 get_now()
+    clock = {"now": datetime.fromtimestamp(records[0][0], bot.TZ)}
+    bot.get_now = lambda: clock["now"]
+    if not args.async_writes:
+        bot.write_queue = sync_write_queue(bot)
+    threading.Thread(target=bot.background_writer, daemon=True).start()
+    client = bot.app.test_client()
+
+    latencies = []
+    ticks = 0
+    prev_ts = records[0][0]
+    t_start = time.perf_counter()
+    quiet = open(os.devnull, "w") if not args.verbose else sys.stdout
+    with contextlib.redirect_stdout(quiet):
+        for ts, update in records:
+            if args.speed > 0 and ts > prev_ts:
+                time.sleep((ts - prev_ts) / args.speed)
+            target = datetime.fromtimestamp(ts, bot.TZ)
+            for mark in minute_marks(clock["now"], target):
+                clock["now"] = mark
+                bot.ask_arrivals_tick(mark)
+                bot.auto_announce_tick(mark)
+                ticks += 1
+            clock["now"] = target
+            prev_ts = ts
+
+            t0 = time.perf_counter()
+            client.post("/", json=update)
+            latencies.append(time.perf_counter() - t0)
+            bot.write_queue.join()
+    elapsed = time.perf_counter() - t_start
+
+    sent = outbound(fake)
+    report = {
+        "capture": os.path.abspath(args.capture),
+        "updates": len(records),
+        "span_s": round(records[-1][0] - records[0][0], 1),
+        "speed": args.speed,
+        "minute_ticks": ticks,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_ups": round(len(records) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p95": round(percentile(latencies, 95) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+        },
+        "telegram_calls": fake.counts(),
+    }
+    fake.stop()
+    return report, sent
+
+
+def compare_outbound(sent, baseline):
+    """回傳第一個不同的位置與兩邊內容；完全一致回傳 None"""
+    for i, (a, b) in enumerate(zip(sent, baseline)):
+        if a != b:
+            return i, b, a
+    if len(sent) != len(baseline):
+        i = min(len(sent), len(baseline))
+        return i, baseline[i] if i < len(baseline) else None, sent[i] if i < len(sent) else None
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="重播錄製的 webhook 流量")
+    parser.add_argument("capture", help="錄製檔（.jsonl.gz 或 .jsonl）")
+    parser.add_argument("--speed", type=float, default=0, help="重播倍速，1 = 原速，0 = 不等待（預設）")
+    parser.add_argument("--seed-dir", help="重播前複製到 data/ 的初始資料（例如錄製開始時的 data 快照）")
+    parser.add_argument("--latency", type=float, default=0.0, help="假 Telegram 固定延遲（秒）")
+    parser.add_argument("--save-outbound", help="把送出的訊息存成 JSONL，供之後比對")
+    parser.add_argument("--compare-outbound", help="與先前存下的送出訊息比對")
+    parser.add_argument("--async-writes", action="store_true",
+                        help="維持正式環境的非同步寫檔（較接近實際延遲，但讀寫競態會讓結果無法逐筆重現）")
+    parser.add_argument("--json", help="另存 JSON 報告的路徑")
+    parser.add_argument("--verbose", action="store_true", help="顯示 main.py 的 DEBUG 輸出")
+    args = parser.parse_args()
+
+    args.capture = os.path.abspath(args.capture)
+    args.seed_dir = os.path.abspath(args.seed_dir) if args.seed_dir else None
+    save_path = os.path.abspath(args.save_outbound) if args.save_outbound else None
+    compare_path = os.path.abspath(args.compare_outbound) if args.compare_outbound else None
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    report, sent = run(args)
+    lat = report["latency_ms"]
+    print(f"重播 {report['updates']} 筆（原始跨度 {report['span_s']}s），耗時 {report['elapsed_s']}s，"
+          f"吞吐量 {report['throughput_ups']} updates/s")
+    print(f"延遲 p50={lat['p50']}ms p95={lat['p95']}ms p99={lat['p99']}ms")
+    print(f"Telegram 呼叫：{report['telegram_calls']}")
+
+    if save_path:
+        with open(save_path, "w", encoding="utf-8") as f:
+            for item in sent:
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+        print(f"送出訊息已存到 {save_path}（{len(sent)} 筆）")
+
+    mismatch = None
+    if compare_path:
+        with open(compare_path, encoding="utf-8") as f:
+            baseline = [json.loads(line) for line in f if line.strip()]
+        mismatch = compare_outbound(sent, baseline)
+        report["outbound_match"] = mismatch is None
+        if mismatch is None:
+            print(f"✅ 送出訊息與 {compare_path} 一致（{len(sent)} 筆）")
+        else:
+            i, expected, actual = mismatch
+            print(f"❌ 第 {i} 筆送出訊息不同：\n  預期 {expected}\n  實際 {actual}")
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if mismatch is not None else 0)
+
+
+if __name__ == "__main__":
+    main()